@@ -1,9 +1,10 @@
 from django.contrib import admin, messages
-from django.db.models.aggregates import Count
 from django.db.models.query import QuerySet
 from django.utils.html import format_html, urlencode
 from django.urls import reverse
 from . import models
+from .cache import invalidate_products
+from .images import get_variant_url
 
 
 class InventoryFilter(admin.SimpleListFilter):
@@ -31,7 +32,8 @@ class ProductImageInline(admin.TabularInline):
         # Counting the number of image the product have if it's not empty
         if instance.image.name != '':
             # Taking the product image and convert it to html image
-            return format_html(f'<img src="{instance.image.url}" class="thumbnail" />')
+            # Using the smallest generated variant instead of the full size upload
+            return format_html('<img src="{}" class="thumbnail" />', get_variant_url(instance))
         return ''
 
 @admin.register(models.Product)
@@ -62,7 +64,10 @@ class ProductAdmin(admin.ModelAdmin):
 
     @admin.action(description='Clear inventory')
     def clear_inventory(self, request, queryset):
+        product_ids = list(queryset.values_list('id', flat=True))
+        # update() doesn't send post_save so we invalidate the cached catalog ourselves
         updated_count = queryset.update(inventory=0)
+        invalidate_products(*product_ids)
         self.message_user(
             request,
             f'{updated_count} products were successfully updated.',
@@ -93,22 +98,18 @@ class CollectionAdmin(admin.ModelAdmin):
             }))
         return format_html('<a href="{}">{} Products</a>', url, collection.products_count)
 
-    def get_queryset(self, request):
-        return super().get_queryset(request).annotate(
-            products_count=Count('products')
-        )
-
 
 @admin.register(models.Customer)
 class CustomerAdmin(admin.ModelAdmin):
-    list_display = ['first_name', 'last_name',  'membership', 'orders']
+    list_display = ['first_name', 'last_name',  'membership', 'orders', 'lifetime_spend']
     list_editable = ['membership']
     list_per_page = 10
-    list_select_related = ['user']
+    # The order stats are precomputed in CustomerStats, so sorting on them needs no aggregation
+    list_select_related = ['user', 'stats']
     ordering = ['user__first_name', 'user__last_name']
     search_fields = ['first_name__istartswith', 'last_name__istartswith']
 
-    @admin.display(ordering='orders_count')
+    @admin.display(ordering='stats__orders_count')
     def orders(self, customer):
         url = (
             reverse('admin:store_order_changelist')
@@ -116,12 +117,17 @@ class CustomerAdmin(admin.ModelAdmin):
             + urlencode({
                 'customer__id': str(customer.id)
             }))
-        return format_html('<a href="{}">{} Orders</a>', url, customer.orders_count)
+        return format_html('<a href="{}">{} Orders</a>', url, self.get_stats(customer).orders_count)
 
-    def get_queryset(self, request):
-        return super().get_queryset(request).annotate(
-            orders_count=Count('order')
-        )
+    @admin.display(ordering='stats__lifetime_spend')
+    def lifetime_spend(self, customer):
+        return self.get_stats(customer).lifetime_spend
+
+    def get_stats(self, customer):
+        try:
+            return customer.stats
+        except models.CustomerStats.DoesNotExist:
+            return models.CustomerStats(customer=customer)
 
 
 class OrderItemInline(admin.TabularInline):
@@ -137,3 +143,11 @@ class OrderAdmin(admin.ModelAdmin):
     autocomplete_fields = ['customer']
     inlines = [OrderItemInline]
     list_display = ['id', 'placed_at', 'customer']
+
+
+@admin.register(models.TaxRate)
+class TaxRateAdmin(admin.ModelAdmin):
+    list_display = ['region', 'collection', 'rate']
+    list_filter = ['region']
+    list_select_related = ['collection']
+    autocomplete_fields = ['collection']
@@ -7,3 +7,5 @@ class StoreConfig(AppConfig):
 
     def ready(self) -> None:
         import store.signals.handlers
+        from store.middleware import install_serializer_timer
+        install_serializer_timer()
@@ -0,0 +1,122 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.functional import SimpleLazyObject
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from .backends import get_permission_set
+from .cache import LocalCache
+from .models import Customer
+
+local_principals = LocalCache(settings.STORE_PRINCIPAL_LOCAL_SIZE, settings.STORE_PRINCIPAL_LOCAL_TTL)
+
+
+def principal_key(user_id):
+    return f'store:principal:{user_id}'
+
+
+def load_principal(user_id):
+    user = get_user_model().objects.filter(**{api_settings.USER_ID_FIELD: user_id}).first()
+    if user is None:
+        return None
+    return {
+        'id': user.pk,
+        'is_active': user.is_active,
+        'is_staff': user.is_staff,
+        'is_superuser': user.is_superuser,
+        'customer_id': Customer.objects.filter(user_id=user.pk).values_list('id', flat=True).first(),
+    }
+
+
+def get_principal(user_id):
+    """
+    The compact version of a user that authentication needs, from the local LRU, then Redis,
+    then the database. Returns None if the user doesn't exist.
+    """
+    key = principal_key(user_id)
+    principal = local_principals.get(key)
+    if principal is None:
+        principal = cache.get(key)
+        if principal is None:
+            principal = load_principal(user_id)
+            if principal is None:
+                return None
+            cache.set(key, principal, settings.STORE_PRINCIPAL_CACHE_TIMEOUT)
+        local_principals.set(key, principal)
+    return principal
+
+
+def invalidate_principal(user_id):
+    key = principal_key(user_id)
+
+    def forget():
+        cache.delete(key)
+        local_principals.delete(key)
+    transaction.on_commit(forget)
+
+
+class CachedUser(SimpleLazyObject):
+    """
+    request.user of the JWT requests. The id, flags and customer_id come from the principal, the
+    permissions from the permission set cache, anything else (djoser's /auth/users/me/ for
+    instance) loads the real User once.
+    """
+
+    def __init__(self, principal):
+        user_id = principal['id']
+        super().__init__(lambda: get_user_model().objects.get(pk=user_id))
+        self.__dict__['principal'] = principal
+
+    id = pk = property(lambda self: self.principal['id'])
+    is_active = property(lambda self: self.principal['is_active'])
+    is_staff = property(lambda self: self.principal['is_staff'])
+    is_superuser = property(lambda self: self.principal['is_superuser'])
+    customer_id = property(lambda self: self.principal['customer_id'])
+    is_authenticated = True
+    is_anonymous = False
+
+    # SimpleLazyObject forwards bool() to the wrapped user, and IsAuthenticated / IsAdminUser
+    #start with `request.user and ...`
+    def __bool__(self):
+        return True
+
+    def get_all_permissions(self, obj=None):
+        if not self.is_active or obj is not None:
+            return set()
+        return set(get_permission_set(self.pk, self.is_superuser))
+
+    # Same rules as ModelBackend, which doesn't grant object permissions
+    def has_perm(self, perm, obj=None):
+        if not self.is_active:
+            return False
+        if self.is_superuser:
+            return True
+        return obj is None and perm in get_permission_set(self.pk, self.is_superuser)
+
+    def has_perms(self, perm_list, obj=None):
+        return all(self.has_perm(perm, obj) for perm in perm_list)
+
+    def has_module_perms(self, app_label):
+        if not self.is_active:
+            return False
+        return self.is_superuser or any(
+            perm.startswith(f'{app_label}.') for perm in get_permission_set(self.pk, self.is_superuser))
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    # Same checks as JWTAuthentication.get_user, without loading the user from the database
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+
+        principal = get_principal(user_id)
+        if principal is None:
+            raise AuthenticationFailed(_('User not found'), code='user_not_found')
+        if not principal['is_active']:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+        return CachedUser(principal)
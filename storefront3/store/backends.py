@@ -0,0 +1,67 @@
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import Permission
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from .cache import LocalCache, bump_versions, get_versions, version_key
+
+# Permission sets are stored under a key with two version tokens: one bumped when any group or
+#permission changes (it affects many users), one bumped when a single user's groups, permissions
+#or flags change
+VERSION_NAMESPACE = 'permissions'
+
+local_permissions = LocalCache(settings.STORE_PERMISSIONS_LOCAL_SIZE, settings.STORE_PERMISSIONS_LOCAL_TTL)
+
+
+def load_permission_set(user_id, is_superuser):
+    # One query for the user and group permissions, ModelBackend runs two
+    permissions = Permission.objects.all() if is_superuser else \
+        Permission.objects.filter(Q(user=user_id) | Q(group__user=user_id))
+    return frozenset(
+        f'{app_label}.{codename}'
+        for app_label, codename in permissions.values_list('content_type__app_label', 'codename').distinct())
+
+
+def get_permission_set(user_id, is_superuser):
+    """
+    The 'app_label.codename' permissions of a user, from the local LRU, then Redis, then the
+    database.
+    """
+    permissions = local_permissions.get(user_id)
+    if permissions is None:
+        versions = get_versions(version_key(VERSION_NAMESPACE), version_key(VERSION_NAMESPACE, user_id))
+        key = f'store:permissions:{user_id}:{":".join(versions)}'
+        permissions = cache.get(key)
+        if permissions is None:
+            permissions = load_permission_set(user_id, is_superuser)
+            cache.set(key, permissions, settings.STORE_PERMISSIONS_CACHE_TIMEOUT)
+        local_permissions.set(user_id, permissions)
+    return permissions
+
+
+def invalidate_permissions(*user_ids):
+    # Without user ids every user's permissions are invalidated
+    if user_ids:
+        def forget():
+            for user_id in user_ids:
+                local_permissions.delete(user_id)
+        bump_versions(*[version_key(VERSION_NAMESPACE, user_id) for user_id in user_ids])
+        transaction.on_commit(forget)
+    else:
+        bump_versions(version_key(VERSION_NAMESPACE))
+        transaction.on_commit(local_permissions.clear)
+
+
+class CachedModelBackend(ModelBackend):
+    """
+    ModelBackend reading the permissions from get_permission_set(), so has_perm() is a set
+    lookup instead of two auth_permission queries per request.
+    """
+
+    def get_all_permissions(self, user_obj, obj=None):
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return set()
+        if not hasattr(user_obj, '_perm_cache'):
+            user_obj._perm_cache = get_permission_set(user_obj.pk, user_obj.is_superuser)
+        return user_obj._perm_cache
@@ -0,0 +1,250 @@
+import csv
+import json
+from collections import Counter
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, DecimalField, F, IntegerField, Value, When
+from django.utils import timezone
+from rest_framework import serializers
+from .cache import invalidate_collections, invalidate_products
+from .counters import adjust_products_count
+from .models import Collection, Product
+from .promotions import refresh_effective_prices
+
+BATCH_SIZE = 1000
+EXPORT_FIELDS = ['id', 'title', 'slug', 'description', 'unit_price', 'inventory', 'collection_id']
+
+
+class ProductImportSerializer(serializers.ModelSerializer):
+    # Products that already exist are updated, the others are created
+    id = serializers.IntegerField(required=False)
+    # A plain integer, the collections are checked once per batch instead of one query per row
+    collection_id = serializers.IntegerField()
+
+    class Meta:
+        model = Product
+        fields = ['id', 'title', 'slug', 'description', 'unit_price', 'inventory', 'collection_id']
+
+
+class ProductBulkUpdateSerializer(serializers.ModelSerializer):
+    id = serializers.IntegerField()
+
+    class Meta:
+        model = Product
+        fields = ['id', 'unit_price', 'inventory']
+        extra_kwargs = {
+            'unit_price': {'required': False},
+            'inventory': {'required': False},
+        }
+
+
+def case_for(rows, field, output_field):
+    # CASE id WHEN 1 THEN 9.99 WHEN 2 THEN ... ELSE <current value> END
+    whens = [When(pk=row['id'], then=Value(row[field])) for row in rows if field in row]
+    if not whens:
+        return None
+    return Case(*whens, default=F(field), output_field=output_field)
+
+
+def bulk_update_products(rows, batch_size=None):
+    """
+    Applies [{id, unit_price, inventory}] with one UPDATE ... SET unit_price = CASE id WHEN ...
+    END per batch, all batches inside a single transaction so a pricing job is applied entirely
+    or not at all. Returns the ids that don't exist (nothing is updated in that case).
+    """
+    batch_size = batch_size or settings.STORE_BULK_UPDATE_BATCH_SIZE
+    ids = [row['id'] for row in rows]
+    existing = {}
+    for start in range(0, len(ids), batch_size):
+        existing.update(Product.objects
+                        .filter(pk__in=ids[start:start + batch_size])
+                        .values_list('id', 'collection_id'))
+    missing = sorted(set(ids) - set(existing))
+    if missing:
+        return missing
+
+    now = timezone.now()
+    with transaction.atomic():
+        for batch in iter_batches(rows, batch_size):
+            changes = {
+                'unit_price': case_for(batch, 'unit_price', DecimalField(max_digits=6, decimal_places=2)),
+                'inventory': case_for(batch, 'inventory', IntegerField()),
+            }
+            changes = {field: value for field, value in changes.items() if value is not None}
+            if not changes:
+                continue
+            batch_ids = [row['id'] for row in batch]
+            # update() skips auto_now, so last_update is set explicitly
+            Product.objects.filter(pk__in=batch_ids).update(last_update=now, **changes)
+            if 'unit_price' in changes:
+                refresh_effective_prices(batch_ids)
+            # One cache invalidation per batch, not per product
+            invalidate_products(*batch_ids)
+            invalidate_collections(*{existing[id] for id in batch_ids})
+    return []
+
+
+class ParseError(Exception):
+    pass
+
+
+def iter_lines(stream):
+    # The request stream is read line by line, never as a whole. Invalid UTF-8 is replaced instead
+    #of raising, so one bad line doesn't end the import, the row containing it is rejected below.
+    for line in iter(stream.readline, b''):
+        yield line.decode('utf-8', errors='replace')
+
+
+def check_encoding(text):
+    if '\ufffd' in text:
+        raise ParseError('The row is not valid UTF-8.')
+
+
+def iter_csv(stream):
+    """
+    Yields one dict per row, or a ParseError for a row that can't be parsed, so the caller can
+    report it and carry on with the next rows.
+    """
+    reader = csv.DictReader(iter_lines(stream))
+    while True:
+        try:
+            row = next(reader)
+            check_encoding(''.join(value or '' for value in row.values()))
+        except StopIteration:
+            return
+        except (csv.Error, ParseError) as e:
+            yield ParseError(str(e))
+            continue
+        # Empty cells mean "not given", not an empty value
+        yield {field: value for field, value in row.items() if value != ''}
+
+
+def iter_ndjson(stream):
+    for line in iter_lines(stream):
+        if line.strip():
+            try:
+                check_encoding(line)
+                yield json.loads(line)
+            except (ValueError, ParseError) as e:
+                yield ParseError(str(e))
+
+
+def iter_batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_batch(batch, first_row, result):
+    valid = []
+    rows_by_id = {}
+    for number, row in enumerate(batch, start=first_row):
+        if isinstance(row, ParseError):
+            result['errors'].append({'row': number, 'errors': {'non_field_errors': [str(row)]}})
+            continue
+        serializer = ProductImportSerializer(data=row)
+        if not serializer.is_valid():
+            result['errors'].append({'row': number, 'errors': serializer.errors})
+            continue
+        id = serializer.validated_data.get('id')
+        if id is not None and id in rows_by_id:
+            # bulk_create would fail on the second insert of a new id
+            result['errors'].append(
+                {'row': number, 'errors': {'id': [f'The id {id} was already given on row {rows_by_id[id]}.']}})
+            continue
+        if id is not None:
+            rows_by_id[id] = number
+        valid.append((number, serializer.validated_data))
+
+    collection_ids = set(Collection.objects
+                         .filter(pk__in={data['collection_id'] for _, data in valid})
+                         .values_list('id', flat=True))
+    existing = Product.objects.in_bulk([data['id'] for _, data in valid if 'id' in data])
+
+    to_create, to_update = [], []
+    touched = set(collection_ids) | {product.collection_id for product in existing.values()}
+    # Products added to / moved out of every collection, applied once per batch instead of
+    #recounting the collections
+    counts = Counter()
+    for number, data in valid:
+        if data['collection_id'] not in collection_ids:
+            result['errors'].append(
+                {'row': number, 'errors': {'collection_id': ['No collection with the given ID was found.']}})
+        elif data.get('id') in existing:
+            product = existing[data['id']]
+            counts[product.collection_id] -= 1
+            counts[data['collection_id']] += 1
+            for field, value in data.items():
+                setattr(product, field, value)
+            # bulk_update() skips auto_now
+            product.last_update = timezone.now()
+            to_update.append(product)
+        else:
+            # New products have no promotions yet
+            to_create.append(Product(effective_price=data['unit_price'], **data))
+            counts[data['collection_id']] += 1
+
+    with transaction.atomic():
+        Product.objects.bulk_create(to_create)
+        Product.objects.bulk_update(
+            to_update, [f for f in EXPORT_FIELDS if f != 'id'] + ['last_update'])
+        # bulk_* don't send signals, so the caches and counters are handled once per batch
+        refresh_effective_prices([product.id for product in to_update])
+        invalidate_products(*[product.id for product in to_update])
+        for collection_id, delta in counts.items():
+            adjust_products_count(collection_id, delta)
+        invalidate_collections(*touched)
+
+    result['created'] += len(to_create)
+    result['updated'] += len(to_update)
+
+
+def import_products(stream, content_type, batch_size=BATCH_SIZE):
+    """
+    Imports a CSV (with a header row) or NDJSON stream of products, batch_size rows at a time,
+    so memory doesn't grow with the size of the upload. Invalid rows are reported with their row
+    number and skipped (including the ones that can't be parsed), the valid rows of every batch
+    are saved with bulk_create/bulk_update.
+    """
+    rows = iter_ndjson(stream) if 'ndjson' in content_type else iter_csv(stream)
+    result = {'created': 0, 'updated': 0, 'errors': []}
+    first_row = 1
+    for batch in iter_batches(rows, batch_size):
+        import_batch(batch, first_row, result)
+        first_row += len(batch)
+    return result
+
+
+def iter_products(queryset, chunk_size=BATCH_SIZE):
+    # Walking the primary key in chunks instead of .iterator(), mysqlclient would otherwise load
+    #the whole result set in memory
+    last_id = 0
+    while True:
+        chunk = list(queryset.filter(id__gt=last_id).order_by('id').values_list(*EXPORT_FIELDS)[:chunk_size])
+        if not chunk:
+            return
+        yield from chunk
+        last_id = chunk[-1][0]
+
+
+class Echo:
+    # csv.writer writes into this and we yield what it wrote
+    def write(self, value):
+        return value
+
+
+def export_csv(queryset):
+    writer = csv.writer(Echo())
+    yield writer.writerow(EXPORT_FIELDS)
+    for row in iter_products(queryset):
+        yield writer.writerow(row)
+
+
+def export_ndjson(queryset):
+    for row in iter_products(queryset):
+        yield json.dumps(dict(zip(EXPORT_FIELDS, row)), default=str) + '\n'
@@ -0,0 +1,157 @@
+import threading
+from collections import OrderedDict
+from hashlib import md5
+from time import monotonic, time
+from uuid import uuid4
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework.response import Response
+from . import cachecontrol
+from .cachecontrol import purge
+
+# Catalog responses are cached under keys that embed a version token. Instead of hunting down every
+# cached page that mentions a product we replace the version token, so all the old keys become
+#unreachable and simply expire.
+KEY_PREFIX = 'store:catalog'
+CATALOG_TIMEOUT = 60 * 15
+
+
+def version_key(namespace, pk=None):
+    if pk is None:
+        return f'{KEY_PREFIX}:version:{namespace}'
+    return f'{KEY_PREFIX}:version:{namespace}:{pk}'
+
+
+def get_versions(*keys):
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # A random token (not a counter) so an evicted version can never collide with an old one
+            cache.add(key, uuid4().hex, None)
+            # A cache that doesn't store anything (DummyCache) gets a new version every time
+            versions[key] = cache.get(key) or uuid4().hex
+    return [versions[key] for key in keys]
+
+
+def bump_versions(*keys):
+    # Bumping after commit so a concurrent reader can't cache the old rows under the new version
+    def bump():
+        cache.set_many({key: uuid4().hex for key in keys}, None)
+    transaction.on_commit(bump)
+
+
+def invalidate_products(*product_ids):
+    keys = [version_key('products')] + [version_key('product', pk) for pk in product_ids]
+    bump_versions(*keys)
+    purge(cachecontrol.PRODUCTS, *[cachecontrol.product_key(pk) for pk in product_ids])
+
+
+def invalidate_collections(*collection_ids):
+    keys = [version_key('collections')] + [version_key('collection', pk) for pk in collection_ids]
+    bump_versions(*keys)
+    purge(cachecontrol.COLLECTIONS, *[cachecontrol.collection_key(pk) for pk in collection_ids])
+
+
+def set_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+class CatalogCacheMixin:
+    """
+    Read-through cache for the serialized list and detail responses of a catalog viewset.
+    The key covers the full URL so filters, search, ordering and page all get their own entry.
+    """
+    cache_namespace = None
+    cache_object_namespace = None
+    cache_timeout = CATALOG_TIMEOUT
+
+    def get_cache_key(self, request, versions):
+        url = md5(request.build_absolute_uri().encode('utf-8')).hexdigest()
+        return f'{KEY_PREFIX}:response:{self.cache_namespace}:{":".join(versions)}:{url}'
+
+    def get_cached_response(self, request, versions, render):
+        """
+        Also answers conditional GETs from the cached entry, without serializing anything. The
+        ETag hashes the cache key (the URL and the versions of everything the response shows)
+        and the time the entry was rendered, so once the entry expires the next render gets a
+        new ETag: a version bump that was missed can't keep a client on a stale copy forever.
+        """
+        key = self.get_cache_key(request, versions)
+        entry = cache.get(key)
+        if entry is None:
+            response = render()
+            if response.status_code != 200:
+                return response
+            # Last-Modified is when this representation was rendered: promotions, taxes and images
+            #change it without touching Product.last_update
+            entry = {'data': response.data, 'last_modified': int(time())}
+            cache.set(key, entry, self.cache_timeout)
+        else:
+            response = Response(entry['data'])
+
+        etag = quote_etag(md5(f'{key}:{entry["last_modified"]}'.encode('utf-8')).hexdigest())
+        not_modified = get_conditional_response(
+            request, etag=etag, last_modified=entry['last_modified'])
+        if not_modified is not None:
+            response = not_modified
+        return set_validators(response, etag, entry['last_modified'])
+
+    def list(self, request, *args, **kwargs):
+        versions = get_versions(version_key(self.cache_namespace))
+        return self.get_cached_response(
+            request, versions, lambda: super(CatalogCacheMixin, self).list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        # The versions are bumped with the model ids, /products/007/ must read the one of product 7
+        try:
+            pk = int(kwargs['pk'])
+        except ValueError:
+            return super().retrieve(request, *args, **kwargs)
+        versions = get_versions(version_key(self.cache_object_namespace, pk))
+        return self.get_cached_response(
+            request, versions, lambda: super(CatalogCacheMixin, self).retrieve(request, *args, **kwargs))
+
+
+class LocalCache:
+    """
+    A small per-process LRU with a TTL, in front of Redis for the values read on every request.
+    Entries can't be invalidated across processes, so the TTL must stay short.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,79 @@
+import logging
+from urllib.request import Request, urlopen
+from django.conf import settings
+from django.db import transaction
+from django.utils.cache import patch_cache_control, patch_vary_headers
+
+logger = logging.getLogger(__name__)
+
+# Surrogate keys, the names the reverse proxy tags cached responses with and purges by. They
+#follow the catalog cache namespaces so invalidating one also purges the other.
+PRODUCTS = 'products'
+COLLECTIONS = 'collections'
+TAX_RATES = 'tax_rates'
+
+
+def product_key(product_id):
+    return f'product-{product_id}'
+
+
+def collection_key(collection_id):
+    return f'collection-{collection_id}'
+
+
+def reviews_key(product_id):
+    return f'reviews-{product_id}'
+
+
+class CacheControlMixin:
+    """
+    Declares how long the proxy and the clients may cache each action of a viewset:
+
+        cache_control = {
+            'list': {'max_age': 60, 's_maxage': 300, 'stale_while_revalidate': 60},
+        }
+
+    Only successful GET/HEAD responses of the listed actions get the headers. Anonymous requests
+    are cached publicly, requests with an Authorization header only by the client, and
+    responses always vary on Authorization. get_surrogate_keys() tags the response for purging.
+    """
+    cache_control = {}
+
+    def get_surrogate_keys(self):
+        return []
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        policy = self.cache_control.get(getattr(self, 'action', None))
+        if policy is None or request.method not in ('GET', 'HEAD') or response.status_code not in (200, 304):
+            return response
+
+        patch_vary_headers(response, ['Authorization'])
+        if 'HTTP_AUTHORIZATION' in request.META:
+            patch_cache_control(response, private=True, max_age=policy.get('max_age', 0))
+            return response
+        patch_cache_control(response, public=True, **policy)
+        keys = self.get_surrogate_keys()
+        if keys:
+            response[settings.STORE_SURROGATE_KEY_HEADER] = ' '.join(keys)
+        return response
+
+
+def purge(*keys):
+    # After commit, so the proxy can't fetch the old rows again right after the purge
+    if not settings.STORE_CACHE_PURGE_URL or not keys:
+        return
+
+    def enqueue():
+        from store.tasks import purge_surrogate_keys
+        purge_surrogate_keys.delay(list(keys))
+    transaction.on_commit(enqueue)
+
+
+def send_purge(keys):
+    request = Request(
+        settings.STORE_CACHE_PURGE_URL,
+        method=settings.STORE_CACHE_PURGE_METHOD,
+        headers={settings.STORE_SURROGATE_KEY_HEADER: ' '.join(keys)})
+    with urlopen(request, timeout=10) as response:
+        logger.info('Purged %s: %s', keys, response.status)
@@ -0,0 +1,122 @@
+import logging
+from time import perf_counter, sleep
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from .models import Cart, CartItem, Product
+
+logger = logging.getLogger(__name__)
+
+
+class ProductNotFound(Exception):
+    def __init__(self, product_ids):
+        super().__init__('No product with the given ID was found.')
+        self.product_ids = product_ids
+
+
+def add_cart_items(cart_id, quantities):
+    """
+    Adds {product_id: quantity} to a cart with a single INSERT ... SELECT upsert. The SELECT from
+    the product table only yields the products that exist, and the unique (cart, product)
+    constraint turns a second add of the same product into quantity = quantity + n, so two tabs
+    adding the same item at once can't fail with an IntegrityError.
+
+    Returns the resulting CartItem objects. If a product doesn't exist nothing is added and
+    ProductNotFound is raised.
+    """
+    product_ids = sorted(quantities)
+    cart_item_table = connection.ops.quote_name(CartItem._meta.db_table)
+    product_table = connection.ops.quote_name(Product._meta.db_table)
+    placeholders = ', '.join(['%s'] * len(product_ids))
+    select = (
+        f'SELECT %s, id, CASE id {" ".join(["WHEN %s THEN %s"] * len(product_ids))} END '
+        f'FROM {product_table} WHERE id IN ({placeholders})'
+    )
+    params = [CartItem._meta.get_field('cart').get_db_prep_value(cart_id, connection)]
+    for product_id in product_ids:
+        params += [product_id, quantities[product_id]]
+    params += product_ids
+
+    if connection.vendor == 'mysql':
+        upsert = (
+            f'INSERT INTO {cart_item_table} (cart_id, product_id, quantity) {select} '
+            f'ON DUPLICATE KEY UPDATE quantity = {cart_item_table}.quantity + VALUES(quantity)'
+        )
+    else:
+        # PostgreSQL and SQLite (3.35+) share the ON CONFLICT syntax and RETURNING
+        upsert = (
+            f'INSERT INTO {cart_item_table} (cart_id, product_id, quantity) {select} '
+            f'ON CONFLICT (cart_id, product_id) '
+            f'DO UPDATE SET quantity = {cart_item_table}.quantity + excluded.quantity '
+            f'RETURNING id, product_id, quantity'
+        )
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(upsert, params)
+            if connection.vendor == 'mysql':
+                # No RETURNING on MySQL, the rows are read back through the unique index
+                rows = CartItem.objects \
+                    .filter(cart_id=cart_id, product_id__in=product_ids) \
+                    .values_list('id', 'product_id', 'quantity')
+            else:
+                rows = cursor.fetchall()
+            items = [
+                CartItem(id=id, cart_id=cart_id, product_id=product_id, quantity=quantity)
+                for id, product_id, quantity in rows
+            ]
+
+        missing = set(product_ids) - {item.product_id for item in items}
+        if missing:
+            # Rolling back what was added for the products that do exist
+            raise ProductNotFound(sorted(missing))
+
+    return sorted(items, key=lambda item: item.product_id)
+
+
+def reap_abandoned_carts(ttl=None, batch_size=None, pause=0, dry_run=False):
+    """
+    Deletes the carts created more than `ttl` ago (settings.STORE_CART_TTL by default) and their
+    items. We walk the primary key in bounded batches, each one its own short transaction, so we
+    never hold locks on millions of rows or produce one huge replication event.
+
+    Returns the metrics of the run: carts and items deleted, batches and time per batch.
+    """
+    ttl = ttl or settings.STORE_CART_TTL
+    batch_size = batch_size or settings.STORE_CART_REAPER_BATCH_SIZE
+    cutoff = timezone.now() - ttl
+    stats = {'carts': 0, 'items': 0, 'batches': 0, 'batch_seconds': [], 'dry_run': dry_run}
+
+    last_id = None
+    while True:
+        carts = Cart.objects.filter(created_at__lt=cutoff).order_by('id')
+        if last_id is not None:
+            carts = carts.filter(id__gt=last_id)
+        cart_ids = list(carts.values_list('id', flat=True)[:batch_size])
+        if not cart_ids:
+            break
+        last_id = cart_ids[-1]
+
+        start = perf_counter()
+        if dry_run:
+            items = CartItem.objects.filter(cart_id__in=cart_ids).count()
+            deleted = len(cart_ids)
+        else:
+            with transaction.atomic():
+                items, _ = CartItem.objects.filter(cart_id__in=cart_ids).delete()
+                # Items added since the previous statement are cascaded here
+                _, deleted_per_model = Cart.objects.filter(id__in=cart_ids).delete()
+                deleted = deleted_per_model.get(Cart._meta.label, 0)
+                items += deleted_per_model.get(CartItem._meta.label, 0)
+        elapsed = perf_counter() - start
+
+        stats['carts'] += deleted
+        stats['items'] += items
+        stats['batches'] += 1
+        stats['batch_seconds'].append(elapsed)
+        logger.info('Reaped %s carts and %s items in %.3fs', deleted, items, elapsed)
+
+        if pause:
+            sleep(pause)
+
+    return stats
@@ -0,0 +1,15 @@
+from .models import Customer
+
+
+def get_customer_id(request):
+    """
+    The id of the authenticated user's customer, resolved once per request. JWT requests get it
+    from the cached principal (see store.authentication), the others with one query. Raises
+    Customer.DoesNotExist if the user has no customer.
+    """
+    if not hasattr(request, '_customer_id'):
+        customer_id = getattr(request.user, 'customer_id', None)
+        if customer_id is None:
+            customer_id = Customer.objects.only('id').get(user_id=request.user.id).id
+        request._customer_id = customer_id
+    return request._customer_id
@@ -0,0 +1,128 @@
+from django.db import IntegrityError, transaction
+from django.db.models import Case, Count, DecimalField, ExpressionWrapper, F, Max, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, Greatest
+from .models import Collection, Customer, CustomerStats, Order, OrderItem, Product
+
+
+def adjust_products_count(collection_id, delta):
+    # A single UPDATE ... SET products_count = products_count + delta, no read-modify-write race
+    if collection_id is None or not delta:
+        return
+    if delta > 0:
+        value = F('products_count') + delta
+    else:
+        # Never below zero, products created in bulk weren't counted. products_count is unsigned,
+        #so MySQL would fail on the subtraction itself, GREATEST(products_count - 1, 0) isn't enough
+        value = Case(
+            When(products_count__gt=-delta, then=F('products_count') - (-delta)),
+            default=Value(0))
+    Collection.objects \
+        .filter(pk=collection_id) \
+        .update(products_count=value)
+
+
+def actual_products_count():
+    return Coalesce(
+        Subquery(
+            Product.objects
+            .filter(collection_id=OuterRef('pk'))
+            .order_by()
+            .values('collection_id')
+            .annotate(count=Count('id'))
+            .values('count')),
+        Value(0))
+
+
+def reconcile_products_count(dry_run=False, collection_ids=None):
+    """
+    Fixes collections whose stored products_count drifted from the real number of products
+    (e.g. after bulk_create or raw SQL, which don't send signals). Only checks `collection_ids`
+    if given. Returns the [(collection_id, stored, actual)] that were (or would be) fixed.
+    """
+    collections = Collection.objects.all()
+    if collection_ids is not None:
+        collections = collections.filter(pk__in=collection_ids)
+    drifted = list(
+        collections
+        .annotate(actual=actual_products_count())
+        .exclude(products_count=F('actual'))
+        .values_list('id', 'products_count', 'actual'))
+    if drifted and not dry_run:
+        Collection.objects \
+            .filter(pk__in=[id for id, _, _ in drifted]) \
+            .update(products_count=actual_products_count())
+    return drifted
+
+
+def record_order(order, order_items):
+    """
+    Adds a freshly placed order to its customer's stats. Called from the checkout transaction so
+    the stats and the order are committed together.
+    """
+    total = sum(item.quantity * item.unit_price for item in order_items)
+    items = sum(item.quantity for item in order_items)
+    changes = {
+        'orders_count': F('orders_count') + 1,
+        'items_count': F('items_count') + items,
+        'lifetime_spend': F('lifetime_spend') + total,
+        'last_order_at': Coalesce(Greatest('last_order_at', Value(order.placed_at)), Value(order.placed_at)),
+    }
+    if CustomerStats.objects.filter(customer_id=order.customer_id).update(**changes):
+        return
+    # Customers created before the stats existed (or through bulk_create) may not have a row yet
+    try:
+        with transaction.atomic():
+            CustomerStats.objects.create(
+                customer_id=order.customer_id, orders_count=1, items_count=items,
+                lifetime_spend=total, last_order_at=order.placed_at)
+    except IntegrityError:
+        CustomerStats.objects.filter(customer_id=order.customer_id).update(**changes)
+
+
+def actual_customer_stats():
+    orders = Order.objects.filter(customer_id=OuterRef('pk')).order_by().values('customer_id')
+    items = OrderItem.objects.filter(order__customer_id=OuterRef('pk')).order_by().values('order__customer_id')
+    return {
+        'actual_orders_count': Coalesce(
+            Subquery(orders.annotate(value=Count('id')).values('value')), Value(0)),
+        'actual_last_order_at': Subquery(orders.annotate(value=Max('placed_at')).values('value')),
+        'actual_items_count': Coalesce(
+            Subquery(items.annotate(value=Sum('quantity')).values('value')), Value(0)),
+        'actual_lifetime_spend': Coalesce(
+            Subquery(items.annotate(value=Sum(ExpressionWrapper(
+                F('quantity') * F('unit_price'),
+                output_field=DecimalField(max_digits=12, decimal_places=2)))).values('value')),
+            Value(0),
+            output_field=DecimalField(max_digits=12, decimal_places=2)),
+    }
+
+
+def reconcile_customer_stats(dry_run=False):
+    """
+    Creates the missing CustomerStats rows and recomputes the ones that drifted from the orders.
+    Returns the ids of the customers that were (or would be) fixed.
+    """
+    missing = list(Customer.objects.filter(stats__isnull=True).values_list('id', flat=True))
+    if missing and not dry_run:
+        CustomerStats.objects.bulk_create(
+            [CustomerStats(customer_id=id) for id in missing], ignore_conflicts=True)
+
+    drifted = list(
+        Customer.objects
+        .filter(stats__isnull=False)
+        .annotate(**actual_customer_stats())
+        .filter(
+            ~Q(stats__orders_count=F('actual_orders_count')) |
+            ~Q(stats__items_count=F('actual_items_count')) |
+            ~Q(stats__lifetime_spend=F('actual_lifetime_spend')) |
+            (Q(actual_last_order_at__isnull=False) & ~Q(stats__last_order_at=F('actual_last_order_at'))))
+        .values('id', 'actual_orders_count', 'actual_items_count',
+                'actual_lifetime_spend', 'actual_last_order_at'))
+    if not dry_run:
+        for row in drifted:
+            CustomerStats.objects.filter(customer_id=row['id']).update(
+                orders_count=row['actual_orders_count'],
+                items_count=row['actual_items_count'],
+                lifetime_spend=row['actual_lifetime_spend'],
+                last_order_at=row['actual_last_order_at'])
+    return sorted(set(missing) | {row['id'] for row in drifted})
@@ -1,4 +1,8 @@
+import re
+from django.db import connection
+from django.db.models import FloatField, Func
 from django_filters.rest_framework import FilterSet
+from rest_framework.filters import SearchFilter
 from .models import Product
 
 class ProductFilter(FilterSet):
@@ -6,5 +10,55 @@ class ProductFilter(FilterSet):
     model = Product
     fields = {
       'collection_id': ['exact'],
-      'unit_price': ['gt', 'lt']
-    }
\ No newline at end of file
+      'unit_price': ['gt', 'lt'],
+      'effective_price': ['gt', 'lt'],
+    }
+
+
+class Match(Func):
+  """MySQL MATCH (...) AGAINST (... IN BOOLEAN MODE), the score is 0 for rows that don't match."""
+  template = 'MATCH (%(expressions)s) AGAINST (%%s IN BOOLEAN MODE)'
+  output_field = FloatField()
+
+  def __init__(self, *expressions, query):
+    super().__init__(*expressions)
+    self.query = query
+
+  def as_sql(self, compiler, connection, **extra_context):
+    sql, params = super().as_sql(compiler, connection, **extra_context)
+    return sql, [*params, self.query]
+
+
+class FullTextSearchFilter(SearchFilter):
+  """
+  Drop-in replacement for SearchFilter that uses the FULLTEXT index over the view's search_fields
+  (see migration 0015) instead of LIKE '%term%' scans. Every term must match, as a prefix, and
+  results come back by relevance. On other databases, or for terms shorter than the index
+  tokens, we fall back to the default icontains search.
+  """
+  # InnoDB doesn't index tokens shorter than innodb_ft_min_token_size (3 by default)
+  min_token_size = 3
+
+  def get_boolean_query(self, terms):
+    words = []
+    for term in terms:
+      # Removing the boolean mode operators so users can't build their own expressions
+      words += [word for word in re.split(r'[^\w]+', term) if word]
+    if not words or any(len(word) < self.min_token_size for word in words):
+      return None
+    return ' '.join(f'+{word}*' for word in words)
+
+  def filter_queryset(self, request, queryset, view):
+    search_fields = self.get_search_fields(view, request)
+    search_terms = self.get_search_terms(request)
+    if not search_fields or not search_terms or connection.vendor != 'mysql':
+      return super().filter_queryset(request, queryset, view)
+
+    query = self.get_boolean_query(search_terms)
+    if query is None:
+      return super().filter_queryset(request, queryset, view)
+
+    return queryset \
+      .annotate(relevance=Match(*search_fields, query=query)) \
+      .filter(relevance__gt=0) \
+      .order_by('-relevance', *queryset.model._meta.ordering)
@@ -0,0 +1,73 @@
+from hashlib import sha256
+from io import BytesIO
+from pathlib import PurePosixPath
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+from .cache import invalidate_products
+from .models import ProductImage
+
+# Widths of the responsive variants, wider ones are skipped for smaller originals
+VARIANT_WIDTHS = [160, 320, 640, 1280]
+VARIANT_FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 6}),
+    'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+THUMBNAIL_WIDTH = VARIANT_WIDTHS[0]
+
+
+def render_variant(image, width, image_format, save_options):
+    height = round(image.height * width / image.width)
+    resized = image.resize((width, height), Image.LANCZOS)
+    if image_format == 'JPEG' and resized.mode not in ('RGB', 'L'):
+        resized = resized.convert('RGB')
+    buffer = BytesIO()
+    resized.save(buffer, image_format, **save_options)
+    return buffer.getvalue()
+
+
+def generate_variants(product_image: ProductImage):
+    """
+    Renders the WebP and JPEG variants of an uploaded image and stores them next to the original
+    with content-hashed names (so they can be cached forever). Returns the
+    {format: {width: name}} mapping that is saved in ProductImage.variants.
+    """
+    original = PurePosixPath(product_image.image.name)
+    with product_image.image.open('rb') as file:
+        image = Image.open(file)
+        # Applying the EXIF orientation so phone pictures don't come out rotated
+        image = ImageOps.exif_transpose(image)
+        image.load()
+
+    widths = [width for width in VARIANT_WIDTHS if width < image.width] or [image.width]
+    variants = {}
+    for name, (image_format, save_options) in VARIANT_FORMATS.items():
+        variants[name] = {}
+        for width in widths:
+            content = render_variant(image, width, image_format, save_options)
+            digest = sha256(content).hexdigest()[:12]
+            path = str(original.parent / f'{original.stem}-{width}w-{digest}.{name}')
+            if not default_storage.exists(path):
+                path = default_storage.save(path, ContentFile(content))
+            variants[name][str(width)] = path
+    return variants
+
+
+def process_product_image(image_id):
+    product_image = ProductImage.objects.filter(pk=image_id).first()
+    if product_image is None:
+        return
+    variants = generate_variants(product_image)
+    # update() so we don't go through the save signals again
+    ProductImage.objects.filter(pk=image_id).update(variants=variants)
+    invalidate_products(product_image.product_id)
+
+
+def get_variant_url(product_image: ProductImage, width=THUMBNAIL_WIDTH, image_format='webp'):
+    """URL of the smallest variant at least `width` wide, or the original if there are none yet."""
+    variants = (product_image.variants or {}).get(image_format)
+    if not variants:
+        return product_image.image.url
+    widths = sorted(int(w) for w in variants)
+    chosen = next((w for w in widths if w >= width), widths[-1])
+    return default_storage.url(variants[str(chosen)])
@@ -0,0 +1,52 @@
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from .cache import invalidate_products
+from .models import Product
+
+
+class InsufficientInventory(Exception):
+    def __init__(self, shortages):
+        super().__init__('Not enough inventory for one or more products.')
+        # [{'product_id': ..., 'requested': ..., 'available': ...}]
+        self.shortages = shortages
+
+
+def reserve(quantities):
+    """
+    Takes {product_id: quantity} off the inventory with a single conditional UPDATE, either every
+    product has enough stock and all of them are decremented or none is and InsufficientInventory
+    is raised. Must run inside the caller's transaction.
+
+    The UPDATE scans the primary key index so concurrent checkouts always lock the products in the
+    same order (ascending id) and can't deadlock each other.
+    """
+    if not quantities:
+        return
+    product_ids = sorted(quantities)
+    quantity = Case(
+        *[When(pk=product_id, then=Value(quantities[product_id])) for product_id in product_ids],
+        output_field=IntegerField())
+
+    try:
+        # Savepoint so a partial decrement is undone before we look at what was missing
+        with transaction.atomic():
+            updated = Product.objects \
+                .filter(pk__in=product_ids, inventory__gte=quantity) \
+                .update(inventory=F('inventory') - quantity)
+            if updated != len(product_ids):
+                raise InsufficientInventory([])
+    except InsufficientInventory:
+        available = dict(Product.objects
+                         .filter(pk__in=product_ids)
+                         .values_list('id', 'inventory'))
+        raise InsufficientInventory([
+            {
+                'product_id': product_id,
+                'requested': quantities[product_id],
+                'available': available.get(product_id, 0)
+            }
+            for product_id in product_ids
+            if available.get(product_id, 0) < quantities[product_id]
+        ])
+    # update() doesn't send post_save, the cached product pages show the inventory
+    invalidate_products(*product_ids)
@@ -0,0 +1,44 @@
+from statistics import median
+from time import perf_counter
+from django.db import transaction
+from django.core.management.base import BaseCommand
+from rest_framework.test import APIClient
+from store.models import Cart, CartItem, Collection, Product
+
+
+class Command(BaseCommand):
+    help = 'Measures GET /store/carts/{id}/ latency for carts with 1 to 1,000 lines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lines', nargs='+', type=int, default=[1, 10, 100, 1_000])
+        parser.add_argument('--repeat', type=int, default=10)
+
+    def handle(self, *args, **options):
+        client = APIClient()
+        # Everything is created in a transaction that is rolled back at the end
+        with transaction.atomic():
+            collection = Collection.objects.create(title='Cart benchmark')
+            products = Product.objects.bulk_create([
+                Product(title=f'Product {i}', slug=f'product-{i}', unit_price=i % 100 + 1,
+                        effective_price=i % 100 + 1, inventory=10, collection=collection)
+                for i in range(max(options['lines']))
+            ])
+            if not products[0].pk:
+                products = list(Product.objects.filter(collection=collection).order_by('id'))
+
+            for lines in options['lines']:
+                cart = Cart.objects.create()
+                CartItem.objects.bulk_create([
+                    CartItem(cart=cart, product=product, quantity=i % 5 + 1)
+                    for i, product in enumerate(products[:lines])
+                ])
+                timings = []
+                for _ in range(options['repeat']):
+                    start = perf_counter()
+                    response = client.get(f'/store/carts/{cart.id}/', HTTP_HOST='localhost')
+                    timings.append(perf_counter() - start)
+                self.stdout.write(
+                    f'{lines:>6} lines  {median(timings) * 1000:8.1f}ms  '
+                    f'total_price={response.data["total_price"]}')
+
+            transaction.set_rollback(True)
@@ -0,0 +1,77 @@
+from statistics import median
+from time import perf_counter
+from django.core.management.base import BaseCommand
+from django.db import connection
+from rest_framework.filters import SearchFilter
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from store.counters import reconcile_products_count
+from store.filters import FullTextSearchFilter
+from store.models import Collection, Product
+from store.views import ProductViewSet
+
+WORDS = ['apple', 'banana', 'cherry', 'coffee', 'bread', 'cheese', 'olive', 'pepper',
+         'salmon', 'tomato', 'walnut', 'yogurt', 'organic', 'fresh', 'frozen', 'spicy']
+
+
+class Command(BaseCommand):
+    help = 'Compares product search latency of SearchFilter (LIKE) and FullTextSearchFilter'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[10_000, 100_000, 1_000_000])
+        parser.add_argument('--terms', nargs='+', default=['coffee', 'fresh salmon', 'walnu'])
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--batch-size', type=int, default=5_000)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'mysql':
+            self.stderr.write('FullTextSearchFilter only differs from SearchFilter on MySQL.')
+
+        # InnoDB only makes FULLTEXT changes visible after commit, so the benchmark rows are
+        #committed and removed at the end
+        collection = Collection.objects.create(title='Search benchmark')
+        try:
+            created = 0
+            for size in sorted(options['sizes']):
+                created = self.create_products(collection, created, size, options['batch_size'])
+                for term in options['terms']:
+                    like = self.time_filter(SearchFilter, term, options['repeat'])
+                    fulltext = self.time_filter(FullTextSearchFilter, term, options['repeat'])
+                    self.stdout.write(
+                        f'{size:>10} products  {term!r:<16} '
+                        f'LIKE {like * 1000:8.1f}ms  FULLTEXT {fulltext * 1000:8.1f}ms')
+        finally:
+            self.stdout.write('Removing benchmark products...')
+            while Product.objects.filter(collection=collection).exists():
+                ids = Product.objects.filter(collection=collection) \
+                    .values_list('id', flat=True)[:options['batch_size']]
+                Product.objects.filter(id__in=list(ids)).delete()
+            collection.delete()
+
+    def create_products(self, collection, start, stop, batch_size):
+        for offset in range(start, stop, batch_size):
+            Product.objects.bulk_create([
+                Product(
+                    title=f'{WORDS[i % len(WORDS)].title()} {WORDS[i * 7 % len(WORDS)]} {i}',
+                    slug=f'benchmark-{i}',
+                    description=' '.join(WORDS[(i + k) * 3 % len(WORDS)] for k in range(8)),
+                    unit_price=10,
+                    effective_price=10,
+                    inventory=10,
+                    collection=collection)
+                for i in range(offset, min(offset + batch_size, stop))
+            ])
+        # bulk_create doesn't count the products, the deletes at the end uncount them
+        reconcile_products_count(collection_ids=[collection.id])
+        return stop
+
+    def time_filter(self, filter_class, term, repeat):
+        view = ProductViewSet()
+        request = Request(APIRequestFactory().get('/store/products/', {'search': term}))
+        timings = []
+        for _ in range(repeat):
+            start = perf_counter()
+            queryset = filter_class().filter_queryset(request, Product.objects.all(), view)
+            list(queryset[:10])
+            timings.append(perf_counter() - start)
+        return median(timings)
@@ -0,0 +1,31 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from store.carts import reap_abandoned_carts
+
+
+class Command(BaseCommand):
+    help = 'Deletes abandoned carts (older than settings.STORE_CART_TTL) in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ttl-days', type=int, help='Overrides settings.STORE_CART_TTL')
+        parser.add_argument('--batch-size', type=int)
+        parser.add_argument('--pause', type=float, default=0,
+                            help='Seconds to wait between batches to let replicas catch up')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count what would be deleted')
+
+    def handle(self, *args, **options):
+        ttl = timedelta(days=options['ttl_days']) if options['ttl_days'] else None
+        stats = reap_abandoned_carts(
+            ttl=ttl,
+            batch_size=options['batch_size'],
+            pause=options['pause'],
+            dry_run=options['dry_run'])
+
+        verb = 'Would delete' if stats['dry_run'] else 'Deleted'
+        self.stdout.write(
+            f'{verb} {stats["carts"]} carts and {stats["items"]} items in {stats["batches"]} batches')
+        if stats['batch_seconds']:
+            self.stdout.write(
+                f'Slowest batch: {max(stats["batch_seconds"]):.3f}s, '
+                f'total: {sum(stats["batch_seconds"]):.3f}s')
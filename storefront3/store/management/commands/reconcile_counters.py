@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from store.cache import invalidate_collections
+from store.counters import reconcile_customer_stats, reconcile_products_count
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the denormalized counters (Collection.products_count, CustomerStats) that drifted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report the drift')
+
+    def handle(self, *args, **options):
+        drifted = reconcile_products_count(dry_run=options['dry_run'])
+        for collection_id, stored, actual in drifted:
+            self.stdout.write(f'Collection {collection_id}: products_count {stored} -> {actual}')
+        if drifted and not options['dry_run']:
+            invalidate_collections(*[collection_id for collection_id, _, _ in drifted])
+        verb = 'would be fixed' if options['dry_run'] else 'fixed'
+        self.stdout.write(f'{len(drifted)} collections {verb}')
+
+        customer_ids = reconcile_customer_stats(dry_run=options['dry_run'])
+        self.stdout.write(f'{len(customer_ids)} customer stats {verb}')
@@ -1,21 +1,250 @@
+from decimal import Decimal
+from django.contrib.auth import get_user_model
 from django.core.management.base import BaseCommand
-from django.db import connection
-from pathlib import Path
+from django.db import connection, connections, transaction
+from django.db.models import Max
+from multiprocessing import Pool
+from random import Random
+from uuid import UUID
 import os
 
+from store.counters import reconcile_customer_stats, reconcile_products_count
+from store.models import Cart, CartItem, Collection, Customer, Order, OrderItem, Product
+
+
+def iter_statements(file_path, chunk_size=64 * 1024):
+    """
+    Reads a SQL file in chunks and yields one statement at a time, so we never hold the whole
+    file in memory and never rely on the backend accepting several statements in one execute.
+    Semicolons inside quoted strings and -- , # or /* */ comments don't end a statement, and
+    comments with no statement after them aren't yielded.
+    """
+    statement = []
+    quote = None
+    escaped = False
+    # None, '--' (up to the end of the line) or '/*'
+    comment = None
+    # The previous character outside quotes and comments, or inside a /* */ comment
+    previous = None
+    has_code = False
+    with open(file_path, encoding='utf-8') as file:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            start = 0
+            for i, char in enumerate(chunk):
+                if escaped:
+                    escaped = False
+                elif quote:
+                    if char == '\\':
+                        escaped = True
+                    elif char == quote:
+                        quote = None
+                elif comment == '--':
+                    if char == '\n':
+                        comment = None
+                elif comment == '/*':
+                    # MySQL runs the /*! ... */ comments of mysqldump files
+                    if previous is None and char == '!':
+                        has_code = True
+                    if previous == '*' and char == '/':
+                        comment = None
+                        char = None
+                    previous = char
+                    continue
+                elif char == '#' or (previous == '-' and char == '-'):
+                    comment = '--'
+                elif previous == '/' and char == '*':
+                    comment = '/*'
+                    char = None
+                elif char in ('\'', '"', '`'):
+                    quote = char
+                    has_code = True
+                elif char == ';':
+                    statement.append(chunk[start:i])
+                    sql = ''.join(statement).strip()
+                    if has_code:
+                        yield sql
+                    statement = []
+                    start = i + 1
+                    has_code = False
+                elif not char.isspace() and char not in ('-', '/'):
+                    has_code = True
+                previous = char
+            statement.append(chunk[start:])
+    sql = ''.join(statement).strip()
+    if has_code:
+        yield sql
+
+
+def next_id(model):
+    return (model.objects.aggregate(max_id=Max('id'))['max_id'] or 0) + 1
+
+
+def sample_products(random, plan, max_items=5):
+    products = range(*plan['products'])
+    return random.sample(products, random.randint(1, min(max_items, len(products))))
+
+
+# Each generator creates the rows whose ids are in [start, stop). Ids are assigned by us, not the
+#database, so workers can run in parallel and reference each other's rows without reading them back.
+def generate_products(start, stop, plan):
+    random = Random(start)
+    products = []
+    for id in range(start, stop):
+        unit_price = Decimal(random.randint(100, 99999)) / 100
+        products.append(Product(
+            id=id,
+            title=f'Product {id}',
+            slug=f'product-{id}',
+            description=f'Synthetic product number {id}',
+            unit_price=unit_price,
+            # No promotions yet, bulk_create skips the signal that sets this
+            effective_price=unit_price,
+            inventory=random.randint(0, 100),
+            collection_id=random.randrange(*plan['collections'])))
+    Product.objects.bulk_create(products)
+
+
+def generate_customers(start, stop, plan):
+    User = get_user_model()
+    # bulk_create doesn't send post_save, so the customers are created explicitly below
+    User.objects.bulk_create([
+        User(id=id, username=f'user{id}', email=f'user{id}@domain.com', password='!')
+        for id in range(start, stop)
+    ])
+    Customer.objects.bulk_create([
+        Customer(id=id - plan['users'][0] + plan['customers'][0], user_id=id, phone='-')
+        for id in range(start, stop)
+    ])
+
+
+def generate_orders(start, stop, plan):
+    random = Random(start)
+    Order.objects.bulk_create([
+        Order(id=id, customer_id=random.randrange(*plan['customers']))
+        for id in range(start, stop)
+    ])
+    OrderItem.objects.bulk_create([
+        OrderItem(
+            order_id=id,
+            product_id=product_id,
+            quantity=random.randint(1, 5),
+            unit_price=Decimal(random.randint(100, 99999)) / 100)
+        for id in range(start, stop)
+        for product_id in sample_products(random, plan)
+    ])
+
+
+def generate_carts(start, stop, plan):
+    random = Random(start)
+    carts = [Cart(id=UUID(int=random.getrandbits(128))) for _ in range(start, stop)]
+    Cart.objects.bulk_create(carts)
+    CartItem.objects.bulk_create([
+        CartItem(cart_id=cart.id, product_id=product_id, quantity=random.randint(1, 5))
+        for cart in carts
+        for product_id in sample_products(random, plan)
+    ])
+
+
+GENERATORS = {
+    'products': generate_products,
+    'customers': generate_customers,
+    'orders': generate_orders,
+    'carts': generate_carts,
+}
+
+
+def run_batch(args):
+    name, start, stop, plan = args
+    with transaction.atomic():
+        GENERATORS[name](start, stop, plan)
+    return stop - start
+
 
 class Command(BaseCommand):
     help = 'Populates the database with collections and products'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--synthetic', action='store_true',
+                            help='Generate data instead of loading seed.sql')
+        parser.add_argument('--collections', type=int, default=10)
+        parser.add_argument('--products', type=int, default=1000)
+        parser.add_argument('--customers', type=int, default=0)
+        parser.add_argument('--orders', type=int, default=0)
+        parser.add_argument('--carts', type=int, default=0)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--workers', type=int, default=1)
+
     def handle(self, *args, **options):
         print('Populating the database...')
+        if options['synthetic']:
+            self.generate(options)
+        else:
+            self.load_seed_file(options['batch_size'])
+        # Rows inserted in bulk don't go through the signals that maintain the counters
+        reconcile_products_count()
+        reconcile_customer_stats()
+
+    def load_seed_file(self, batch_size):
         current_dir = os.path.dirname(__file__)
         # Full path to the sql file
         file_path = os.path.join(current_dir, 'seed.sql')
-        # Using path class we read the entire text in this file 
-        sql = Path(file_path).read_text()
 
-        # Opening a connection with our DB
-        with connection.cursor() as cursor:
-            # Executing the sql statement
-            cursor.execute(sql)
+        statements = iter_statements(file_path)
+        while True:
+            # Committing every batch_size statements so the transaction stays small
+            with transaction.atomic(), connection.cursor() as cursor:
+                executed = 0
+                for sql in statements:
+                    cursor.execute(sql)
+                    executed += 1
+                    if executed == batch_size:
+                        break
+            if executed < batch_size:
+                break
+
+    def generate(self, options):
+        plan = {}
+        for name, model in [('collections', Collection), ('products', Product),
+                            ('users', get_user_model()), ('customers', Customer),
+                            ('orders', Order)]:
+            start = next_id(model)
+            count = options['customers'] if name == 'users' else options[name]
+            plan[name] = (start, start + count)
+        if options['products'] and not options['collections']:
+            self.stderr.write('Products need --collections.')
+            return
+        if (options['orders'] or options['carts']) and not options['products']:
+            self.stderr.write('Orders and carts need --products.')
+            return
+        if options['orders'] and not options['customers']:
+            self.stderr.write('Orders need --customers.')
+            return
+
+        Collection.objects.bulk_create([
+            Collection(id=id, title=f'Collection {id}') for id in range(*plan['collections'])
+        ])
+
+        pool = None
+        if options['workers'] > 1:
+            # Forked workers must open their own connections
+            connections.close_all()
+            pool = Pool(options['workers'])
+        try:
+            for name in ['products', 'customers', 'orders', 'carts']:
+                if name == 'carts':
+                    start, stop = 0, options['carts']
+                else:
+                    start, stop = plan['users' if name == 'customers' else name]
+                batches = [
+                    (name, batch_start, min(batch_start + options['batch_size'], stop), plan)
+                    for batch_start in range(start, stop, options['batch_size'])
+                ]
+                results = pool.imap_unordered(run_batch, batches) if pool else map(run_batch, batches)
+                print(f'Created {sum(results)} {name}')
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
@@ -0,0 +1,154 @@
+import json
+import os
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from time import monotonic
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+# Upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+COUNTERS = {
+    'store_http_requests_total': 'Requests handled, by view, route, method and status.',
+    'store_http_sampled_requests_total': 'Requests whose database and render time were measured.',
+    'store_db_queries_total': 'Database queries run by the sampled requests.',
+    'store_db_duration_seconds_total': 'Time the sampled requests spent in the database.',
+    'store_serialize_duration_seconds_total': 'Time the sampled requests spent in serializer.data, queries excluded.',
+    'store_render_duration_seconds_total': 'Time the sampled requests spent rendering the response body.',
+}
+HISTOGRAM = 'store_http_request_duration_seconds'
+
+
+class Registry:
+    """
+    In-memory counters and a latency histogram, shared by the threads of one process.
+
+    /metrics is answered by whichever worker process gets the scrape, so with several workers
+    STORE_METRICS_DIR must be set: every process writes its values to <pid>.json there, at most
+    every STORE_METRICS_FLUSH_INTERVAL seconds, and export() adds up the files of all of them.
+    Without it only a single worker process is supported.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # {(name, labels): value}, labels being a tuple of (label, value) pairs
+        self.counters = defaultdict(float)
+        # {labels: [count per bucket..., +Inf count, sum]}
+        self.histogram = {}
+        self.flushed_at = None
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counters), {labels: list(buckets) for labels, buckets in self.histogram.items()}
+
+    def flush(self):
+        directory = settings.STORE_METRICS_DIR
+        if not directory:
+            return
+        now = monotonic()
+        if self.flushed_at is not None and now - self.flushed_at < settings.STORE_METRICS_FLUSH_INTERVAL:
+            return
+        self.flushed_at = now
+        counters, histogram = self.snapshot()
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{os.getpid()}.json')
+        # Renamed into place so a scrape never reads half a file
+        temp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump({
+                'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+                'histogram': [[labels, buckets] for labels, buckets in histogram.items()],
+            }, file)
+        os.replace(temp_path, path)
+
+    def collect(self):
+        # This process' live values plus the last values flushed by the other processes
+        counters, histogram = self.snapshot()
+        directory = settings.STORE_METRICS_DIR
+        if not directory:
+            return counters, histogram
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            if not name.endswith('.json') or name == f'{os.getpid()}.json':
+                continue
+            try:
+                with open(os.path.join(directory, name)) as file:
+                    values = json.load(file)
+            except (OSError, ValueError):
+                continue
+            for metric, labels, value in values['counters']:
+                key = (metric, to_labels(labels))
+                counters[key] = counters.get(key, 0) + value
+            for labels, buckets in values['histogram']:
+                labels = to_labels(labels)
+                total = histogram.get(labels, [0] * len(buckets))
+                histogram[labels] = [a + b for a, b in zip(total, buckets)]
+        return counters, histogram
+
+    def inc(self, name, labels, value=1):
+        with self.lock:
+            self.counters[(name, labels)] += value
+
+    def observe(self, labels, seconds):
+        with self.lock:
+            buckets = self.histogram.setdefault(labels, [0] * (len(LATENCY_BUCKETS) + 2))
+            buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            buckets[-1] += seconds
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histogram.clear()
+
+    def export(self):
+        # Prometheus text exposition format 0.0.4
+        counters, histogram = self.collect()
+
+        lines = []
+        for name, help in COUNTERS.items():
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} counter')
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f'{name}{format_labels(labels)} {value:g}')
+
+        lines.append(f'# HELP {HISTOGRAM} Request latency, by view and route.')
+        lines.append(f'# TYPE {HISTOGRAM} histogram')
+        for labels, buckets in sorted(histogram.items()):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ['+Inf'], buckets):
+                cumulative += count
+                lines.append(f'{HISTOGRAM}_bucket{format_labels(labels + (("le", str(bound)),))} {cumulative}')
+            lines.append(f'{HISTOGRAM}_count{format_labels(labels)} {cumulative}')
+            lines.append(f'{HISTOGRAM}_sum{format_labels(labels)} {buckets[-1]:g}')
+        return '\n'.join(lines) + '\n'
+
+
+def to_labels(labels):
+    # JSON turned the label tuples into lists
+    return tuple(tuple(label) for label in labels)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+registry = Registry()
+
+
+def metrics_view(request):
+    # Only the scrapers listed in STORE_METRICS_ALLOWED_IPS, the proxy must not forward /metrics
+    if request.META.get('REMOTE_ADDR') not in settings.STORE_METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+    return HttpResponse(registry.export(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,146 @@
+from contextlib import ExitStack
+from contextvars import ContextVar
+from random import random
+from time import perf_counter
+from django.conf import settings
+from django.db import connections
+from .metrics import registry
+
+
+class QueryTimer:
+    # Installed with connection.execute_wrapper(), counts and times every query of the request
+    def __init__(self):
+        self.count = 0
+        self.duration = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += perf_counter() - start
+
+
+class Measures:
+    # What a sampled request spent its time on, besides the total
+    def __init__(self):
+        self.queries = QueryTimer()
+        self.serialize = 0
+        self.render = 0
+        self.serializing = False
+
+
+# The Measures of the sampled request being handled, None outside of them
+current_measures = ContextVar('store_metrics_measures', default=None)
+
+
+def timed_serializer_data(data):
+    """
+    Wraps the BaseSerializer.data property, serializer.data runs inside the views so the
+    middleware can't time it. Only the outermost .data of a sampled request is timed, and the
+    queries it runs are left to the db measure.
+    """
+    def get(serializer):
+        measures = current_measures.get()
+        if measures is None or measures.serializing:
+            return data.fget(serializer)
+        measures.serializing = True
+        start = perf_counter()
+        queries_start = measures.queries.duration
+        try:
+            return data.fget(serializer)
+        finally:
+            measures.serializing = False
+            measures.serialize += perf_counter() - start - (measures.queries.duration - queries_start)
+    return property(get)
+
+
+def install_serializer_timer():
+    # Called once from StoreConfig.ready()
+    from rest_framework.serializers import BaseSerializer
+    BaseSerializer.data = timed_serializer_data(BaseSerializer.data)
+
+
+def get_view_labels(request):
+    """
+    (('view', 'ProductViewSet'), ('route', 'products-list')) for the store.urls router routes,
+    the view function's name for the other ones.
+    """
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return (('view', 'unmatched'), ('route', 'unmatched'))
+    view = getattr(match.func, 'cls', match.func).__name__
+    return (('view', view), ('route', match.url_name or view))
+
+
+class RequestMetricsMiddleware:
+    """
+    Records the latency of every request, and for a STORE_METRICS_SAMPLE_RATE fraction of them
+    the database queries, database time, serialization time and render time. They're exported
+    by store.metrics and, when STORE_METRICS_SERVER_TIMING is set, sent back in a Server-Timing
+    header.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = perf_counter()
+        sampled = random() < settings.STORE_METRICS_SAMPLE_RATE
+        if not sampled:
+            response = self.get_response(request)
+            self.record(request, response, start)
+            registry.flush()
+            return response
+
+        measures = request._metrics = Measures()
+        token = current_measures.set(measures)
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(measures.queries))
+                response = self.get_response(request)
+        finally:
+            current_measures.reset(token)
+
+        total = self.record(request, response, start)
+        queries = measures.queries
+        labels = get_view_labels(request)
+        registry.inc('store_http_sampled_requests_total', labels)
+        registry.inc('store_db_queries_total', labels, queries.count)
+        registry.inc('store_db_duration_seconds_total', labels, queries.duration)
+        registry.inc('store_serialize_duration_seconds_total', labels, measures.serialize)
+        registry.inc('store_render_duration_seconds_total', labels, measures.render)
+        registry.flush()
+
+        if settings.STORE_METRICS_SERVER_TIMING:
+            app = max(total - queries.duration - measures.serialize - measures.render, 0)
+            response['Server-Timing'] = ', '.join([
+                f'db;dur={queries.duration * 1000:.1f};desc="{queries.count} queries"',
+                f'serialize;dur={measures.serialize * 1000:.1f}',
+                f'app;dur={app * 1000:.1f}',
+                f'render;dur={measures.render * 1000:.1f}',
+                f'total;dur={total * 1000:.1f}',
+            ])
+        return response
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered right after this hook, the post render callback tells when
+        #the rendering ended
+        measures = getattr(request, '_metrics', None)
+        if measures is not None:
+            start = perf_counter()
+
+            def rendered(response):
+                measures.render += perf_counter() - start
+            response.add_post_render_callback(rendered)
+        return response
+
+    def record(self, request, response, start):
+        total = perf_counter() - start
+        labels = get_view_labels(request)
+        registry.inc('store_http_requests_total',
+                     labels + (('method', request.method), ('status', str(response.status_code))))
+        registry.observe(labels, total)
+        return total
@@ -0,0 +1,27 @@
+from django.db import migrations
+
+INDEX_NAME = 'store_product_title_description_ft'
+
+
+# FULLTEXT indexes are MySQL specific so on other backends the migration does nothing and
+#FullTextSearchFilter falls back to SearchFilter
+def create_fulltext_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'mysql':
+        schema_editor.execute(
+            f'CREATE FULLTEXT INDEX {INDEX_NAME} ON store_product (title, description)')
+
+
+def drop_fulltext_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'mysql':
+        schema_editor.execute(f'DROP INDEX {INDEX_NAME} ON store_product')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0014_productimage'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fulltext_index, drop_fulltext_index),
+    ]
@@ -0,0 +1,33 @@
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def populate_products_count(apps, schema_editor):
+    Collection = apps.get_model('store', 'Collection')
+    Product = apps.get_model('store', 'Product')
+    Collection.objects.update(products_count=Coalesce(
+        Subquery(
+            Product.objects
+            .filter(collection_id=OuterRef('pk'))
+            .order_by()
+            .values('collection_id')
+            .annotate(count=Count('id'))
+            .values('count')),
+        Value(0)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0017_productimageupload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='collection',
+            name='products_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(populate_products_count, migrations.RunPython.noop),
+    ]
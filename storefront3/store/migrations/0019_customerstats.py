@@ -0,0 +1,60 @@
+from django.db import migrations, models
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Max, Sum
+import django.db.models.deletion
+
+
+def populate_customer_stats(apps, schema_editor):
+    Customer = apps.get_model('store', 'Customer')
+    CustomerStats = apps.get_model('store', 'CustomerStats')
+    OrderItem = apps.get_model('store', 'OrderItem')
+    Order = apps.get_model('store', 'Order')
+
+    orders = {
+        row['customer_id']: row
+        for row in Order.objects.order_by().values('customer_id').annotate(
+            orders_count=Count('id'), last_order_at=Max('placed_at'))
+    }
+    items = {
+        row['order__customer_id']: row
+        for row in OrderItem.objects.order_by().values('order__customer_id').annotate(
+            items_count=Sum('quantity'),
+            lifetime_spend=Sum(ExpressionWrapper(
+                F('quantity') * F('unit_price'),
+                output_field=DecimalField(max_digits=12, decimal_places=2))))
+    }
+    customer_ids = Customer.objects.values_list('id', flat=True).iterator()
+    batch = []
+    for customer_id in customer_ids:
+        order = orders.get(customer_id, {})
+        item = items.get(customer_id, {})
+        batch.append(CustomerStats(
+            customer_id=customer_id,
+            orders_count=order.get('orders_count', 0),
+            last_order_at=order.get('last_order_at'),
+            items_count=item.get('items_count') or 0,
+            lifetime_spend=item.get('lifetime_spend') or 0))
+        if len(batch) == 1000:
+            CustomerStats.objects.bulk_create(batch)
+            batch = []
+    CustomerStats.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0018_collection_products_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CustomerStats',
+            fields=[
+                ('customer', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='store.customer')),
+                ('orders_count', models.PositiveIntegerField(db_index=True, default=0)),
+                ('items_count', models.PositiveIntegerField(default=0)),
+                ('lifetime_spend', models.DecimalField(db_index=True, decimal_places=2, default=0, max_digits=12)),
+                ('last_order_at', models.DateTimeField(blank=True, db_index=True, null=True)),
+            ],
+        ),
+        migrations.RunPython(populate_customer_stats, migrations.RunPython.noop),
+    ]
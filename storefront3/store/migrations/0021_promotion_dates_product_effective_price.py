@@ -0,0 +1,48 @@
+from django.db import migrations, models
+from django.db.models import DecimalField, ExpressionWrapper, F, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Cast, Coalesce
+
+
+def populate_effective_price(apps, schema_editor):
+    Product = apps.get_model('store', 'Product')
+    Promotion = apps.get_model('store', 'Promotion')
+    # No promotion has a start/end date yet, so all of them are active
+    best_discount = Promotion.objects \
+        .filter(product=OuterRef('pk')) \
+        .order_by() \
+        .values('product') \
+        .annotate(discount=Max('discount')) \
+        .values('discount')
+    Product.objects.update(effective_price=ExpressionWrapper(
+        F('unit_price') * (Value(1) - Coalesce(
+            Cast(Subquery(best_discount), DecimalField(max_digits=5, decimal_places=4)),
+            Value(0),
+            output_field=DecimalField(max_digits=5, decimal_places=4))),
+        output_field=DecimalField(max_digits=6, decimal_places=2)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0020_sales_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='promotion',
+            name='starts_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='promotion',
+            name='ends_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='effective_price',
+            field=models.DecimalField(db_index=True, decimal_places=2, default=0, editable=False, max_digits=6),
+            preserve_default=False,
+        ),
+        migrations.RunPython(populate_effective_price, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0021_promotion_dates_product_effective_price'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaxRate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('region', models.CharField(max_length=32)),
+                ('rate', models.DecimalField(decimal_places=4, max_digits=5)),
+                ('collection', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='store.collection')),
+            ],
+            options={
+                'unique_together': {('region', 'collection')},
+            },
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='unit_tax',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=6),
+        ),
+    ]
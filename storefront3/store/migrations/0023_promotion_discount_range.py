@@ -0,0 +1,17 @@
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0022_taxrate_orderitem_unit_tax'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='promotion',
+            name='discount',
+            field=models.FloatField(validators=[django.core.validators.MinValueValidator(0), django.core.validators.MaxValueValidator(1)]),
+        ),
+    ]
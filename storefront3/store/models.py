@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.conf import settings
-from django.core.validators import MinValueValidator
+from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
 from uuid import uuid4
 
@@ -9,13 +9,35 @@ from store.validators import validate_file_size
 
 class Promotion(models.Model):
     description = models.CharField(max_length=255)
-    discount = models.FloatField()
+    # Fraction of the price taken off, 0.2 is 20% off
+    discount = models.FloatField(validators=[MinValueValidator(0), MaxValueValidator(1)])
+    # An empty start/end means the promotion has no start/end date
+    starts_at = models.DateTimeField(null=True, blank=True)
+    ends_at = models.DateTimeField(null=True, blank=True)
+
+
+class TaxRate(models.Model):
+    region = models.CharField(max_length=32)
+    # An empty collection is the region's rate for every collection without its own rate
+    collection = models.ForeignKey(
+        'Collection', on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    # Fraction of the price, 0.2 is 20%
+    rate = models.DecimalField(max_digits=5, decimal_places=4)
+
+    def __str__(self) -> str:
+        return f'{self.region} {self.rate}'
+
+    class Meta:
+        unique_together = [['region', 'collection']]
 
 
 class Collection(models.Model):
     title = models.CharField(max_length=255)
     featured_product = models.ForeignKey(
         'Product', on_delete=models.SET_NULL, null=True, related_name='+', blank=True)
+    # Denormalized count of products, kept up to date by store.signals.handlers and fixed by the
+    #reconcile_counters command
+    products_count = models.PositiveIntegerField(default=0, editable=False)
 
     def __str__(self) -> str:
         return self.title
@@ -32,6 +54,12 @@ class Product(models.Model):
         max_digits=6,
         decimal_places=2,
         validators=[MinValueValidator(1)])
+    # unit_price with the best active promotion applied, precomputed by store.promotions
+    effective_price = models.DecimalField(
+        max_digits=6,
+        decimal_places=2,
+        db_index=True,
+        editable=False)
     inventory = models.IntegerField(validators=[MinValueValidator(0)])
     last_update = models.DateTimeField(auto_now=True)
     collection = models.ForeignKey(
@@ -52,6 +80,22 @@ class ProductImage(models.Model):
         upload_to='store/images',
         validators=[validate_file_size]
         )
+    # Resized WebP/JPEG copies generated by store.images, {format: {width: file name}}
+    variants = models.JSONField(default=dict, blank=True)
+
+
+# An image being uploaded in chunks (see store.uploads), the bytes live in a temp file until the
+#upload is completed and turned into a ProductImage
+class ProductImageUpload(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid4)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    filename = models.CharField(max_length=255)
+    size = models.PositiveIntegerField()
+    received = models.PositiveIntegerField(default=0)
+    # Filled in as soon as the received bytes contain the image header
+    width = models.PositiveIntegerField(null=True)
+    height = models.PositiveIntegerField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
 
 
 class Customer(models.Model):
@@ -89,6 +133,24 @@ class Customer(models.Model):
         ]
 
 
+# Precomputed per customer, updated by store.counters.record_order when an order is placed
+class CustomerStats(models.Model):
+    customer = models.OneToOneField(
+        Customer, on_delete=models.CASCADE, primary_key=True, related_name='stats')
+    orders_count = models.PositiveIntegerField(default=0, db_index=True)
+    items_count = models.PositiveIntegerField(default=0)
+    lifetime_spend = models.DecimalField(max_digits=12, decimal_places=2, default=0, db_index=True)
+    last_order_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    @property
+    def average_basket_size(self):
+        return self.items_count / self.orders_count if self.orders_count else 0
+
+    @property
+    def average_order_value(self):
+        return round(self.lifetime_spend / self.orders_count, 2) if self.orders_count else 0
+
+
 class Order(models.Model):
     PAYMENT_STATUS_PENDING = 'P'
     PAYMENT_STATUS_COMPLETE = 'C'
@@ -116,6 +178,8 @@ class OrderItem(models.Model):
         Product, on_delete=models.PROTECT, related_name='orderitems')
     quantity = models.PositiveSmallIntegerField()
     unit_price = models.DecimalField(max_digits=6, decimal_places=2)
+    # Tax charged per unit, with the rate in effect when the order was placed
+    unit_tax = models.DecimalField(max_digits=6, decimal_places=2, default=0)
 
 
 class Address(models.Model):
@@ -148,3 +212,41 @@ class Review(models.Model):
     name = models.CharField(max_length=255)
     description = models.TextField()
     date = models.DateField(auto_now_add=True)
+
+
+# Daily sales rollups, materialized from OrderItem by store.reports.refresh_rollups so the
+#reporting endpoints never aggregate the raw order items
+class DailyProductSales(models.Model):
+    date = models.DateField()
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    quantity = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = [['date', 'product']]
+
+
+class DailyCollectionSales(models.Model):
+    date = models.DateField()
+    collection = models.ForeignKey(Collection, on_delete=models.CASCADE, related_name='+')
+    quantity = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = [['date', 'collection']]
+
+
+class DailyCustomerSales(models.Model):
+    date = models.DateField()
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='+')
+    orders_count = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = [['date', 'customer']]
+
+
+# Highest OrderItem id already added to the rollups
+class RollupCheckpoint(models.Model):
+    name = models.CharField(max_length=50, primary_key=True)
+    last_order_item_id = models.BigIntegerField(default=0)
@@ -1,4 +1,173 @@
-from rest_framework.pagination import PageNumberPagination
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+import json
+
+from django.db import connection
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.filters import OrderingFilter
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 
 class DefaultPagination(PageNumberPagination):
-  page_size = 10
\ No newline at end of file
+  page_size = 10
+
+
+class KeysetPagination(BasePagination):
+  """
+  Keyset (seek) pagination. Instead of COUNT(*) + OFFSET, every page is fetched with a
+  WHERE clause on the sort key of the last row we returned, so page 1000 costs the same as page 1.
+  The cursor is an opaque base64 token holding the sort values of the boundary row.
+  """
+  page_size = 10
+  cursor_query_param = 'cursor'
+  # Clients opt in to an (approximate) total with ?include_count=1
+  count_query_param = 'include_count'
+  invalid_cursor_message = 'Invalid cursor'
+
+  def paginate_queryset(self, queryset, request, view=None):
+    self.request = request
+    self.base_url = request.build_absolute_uri()
+    self.ordering = self.get_ordering(request, queryset, view)
+    self.fields = [self.get_field(queryset.model, name) for name, _ in self.ordering]
+    self.count = self.get_approximate_count(request, queryset)
+
+    cursor = self.decode_cursor(request)
+    reverse = cursor is not None and cursor['reverse']
+
+    ordering = [(name, not desc if reverse else desc) for name, desc in self.ordering]
+    queryset = queryset.order_by(*[('-' if desc else '') + name for name, desc in ordering])
+    if cursor is not None:
+      queryset = queryset.filter(self.build_seek_filter(ordering, cursor['values']))
+
+    # Fetching one extra row tells us if there is another page without counting
+    rows = list(queryset[:self.page_size + 1])
+    has_more = len(rows) > self.page_size
+    rows = rows[:self.page_size]
+    if reverse:
+      rows.reverse()
+
+    self.page = rows
+    self.has_next = has_more if not reverse else cursor is not None
+    self.has_previous = cursor is not None if not reverse else has_more
+    return rows
+
+  def get_paginated_response(self, data):
+    response = OrderedDict([
+      ('next', self.get_next_link()),
+      ('previous', self.get_previous_link()),
+      ('results', data),
+    ])
+    if self.count is not None:
+      response['count'] = self.count
+      response.move_to_end('count', last=False)
+    return Response(response)
+
+  def get_paginated_response_schema(self, schema):
+    return {
+      'type': 'object',
+      'properties': {
+        'count': {'type': 'integer', 'nullable': True},
+        'next': {'type': 'string', 'nullable': True},
+        'previous': {'type': 'string', 'nullable': True},
+        'results': schema,
+      },
+    }
+
+  def get_ordering(self, request, queryset, view):
+    """
+    Uses the ordering requested through OrderingFilter (e.g. ?ordering=-unit_price), otherwise
+    the model's Meta.ordering. The primary key is always appended so the key is unique and
+    rows with equal prices/titles never get skipped or repeated across pages.
+    """
+    ordering = None
+    for backend in getattr(view, 'filter_backends', []):
+      if issubclass(backend, OrderingFilter):
+        ordering = backend().get_ordering(request, queryset, view)
+        break
+    if not ordering:
+      # Not queryset.query.order_by, that one can point to annotations such as search relevance
+      ordering = queryset.model._meta.ordering or ['pk']
+
+    result = []
+    for item in ordering:
+      if not isinstance(item, str):
+        raise ValueError('KeysetPagination only supports ordering by field names.')
+      desc = item.startswith('-')
+      name = item.lstrip('-')
+      if name == 'pk':
+        name = queryset.model._meta.pk.name
+      if name not in [n for n, _ in result]:
+        result.append((name, desc))
+
+    pk_name = queryset.model._meta.pk.name
+    if pk_name not in [n for n, _ in result]:
+      result.append((pk_name, False))
+    return result
+
+  def get_field(self, model, name):
+    field = model._meta.get_field(name)
+    if field.null:
+      raise ValueError(f'KeysetPagination cannot order by nullable field "{name}".')
+    return field
+
+  def build_seek_filter(self, ordering, values):
+    # (a, b, id) > (x, y, z)  ==>  a > x OR (a = x AND b > y) OR (a = x AND b = y AND id > z)
+    seek = Q()
+    equal = {}
+    for (name, desc), value in zip(ordering, values):
+      lookup = f'{name}__lt' if desc else f'{name}__gt'
+      seek |= Q(**equal, **{lookup: value})
+      equal[name] = value
+    return seek
+
+  def get_approximate_count(self, request, queryset):
+    if request.query_params.get(self.count_query_param) not in ('1', 'true'):
+      return None
+    # For an unfiltered listing MySQL keeps an estimated row count in the table statistics,
+    # which is good enough for a "~N products" label and doesn't scan the table
+    if connection.vendor == 'mysql' and not queryset.query.where:
+      with connection.cursor() as cursor:
+        cursor.execute(
+          'SELECT TABLE_ROWS FROM information_schema.TABLES '
+          'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s',
+          [queryset.model._meta.db_table])
+        row = cursor.fetchone()
+        if row is not None:
+          return row[0]
+    return queryset.order_by().count()
+
+  def decode_cursor(self, request):
+    encoded = request.query_params.get(self.cursor_query_param)
+    if not encoded:
+      return None
+    try:
+      payload = json.loads(b64decode(encoded.encode('ascii')).decode('utf-8'))
+      values = payload['v']
+      if len(values) != len(self.fields):
+        raise ValueError
+      return {
+        'values': [field.to_python(value) for field, value in zip(self.fields, values)],
+        'reverse': bool(payload.get('r')),
+      }
+    except Exception:
+      raise NotFound(self.invalid_cursor_message)
+
+  def encode_cursor(self, row, reverse):
+    values = [field.value_to_string(row) for field in self.fields]
+    payload = json.dumps({'v': values, 'r': int(reverse)}, separators=(',', ':'))
+    encoded = b64encode(payload.encode('utf-8')).decode('ascii')
+    return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+  def get_next_link(self):
+    if not self.has_next or not self.page:
+      return None
+    return self.encode_cursor(self.page[-1], reverse=False)
+
+  def get_previous_link(self):
+    if not self.has_previous:
+      return None
+    if not self.page:
+      return remove_query_param(self.base_url, self.cursor_query_param)
+    return self.encode_cursor(self.page[0], reverse=True)
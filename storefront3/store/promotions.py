@@ -0,0 +1,64 @@
+from django.db.models import DecimalField, ExpressionWrapper, F, Max, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Cast, Coalesce, Round
+from django.utils import timezone
+from .cache import invalidate_products
+from .models import Product, Promotion
+
+
+def active_promotions(now=None):
+    now = now or timezone.now()
+    return Promotion.objects.filter(
+        Q(starts_at__isnull=True) | Q(starts_at__lte=now),
+        Q(ends_at__isnull=True) | Q(ends_at__gt=now))
+
+
+def effective_price(now=None):
+    """
+    unit_price * (1 - best active discount) as an expression, evaluated by the database in the
+    same UPDATE that stores it. Promotions don't stack, the biggest discount wins.
+    """
+    best_discount = active_promotions(now) \
+        .filter(product=OuterRef('pk')) \
+        .order_by() \
+        .values('product') \
+        .annotate(discount=Max('discount')) \
+        .values('discount')
+    discount = Coalesce(
+        Cast(Subquery(best_discount), DecimalField(max_digits=5, decimal_places=4)),
+        Value(0),
+        output_field=DecimalField(max_digits=5, decimal_places=4))
+    # Rounded to the cent here, not by the column: SQLite would keep all the decimals
+    return Round(
+        ExpressionWrapper(
+            F('unit_price') * (Value(1) - discount),
+            output_field=DecimalField(max_digits=10, decimal_places=6)),
+        2,
+        output_field=DecimalField(max_digits=6, decimal_places=2))
+
+
+def refresh_effective_prices(product_ids=None):
+    """Recomputes Product.effective_price, for the given products or the whole catalog."""
+    products = Product.objects.all()
+    if product_ids is not None:
+        if not product_ids:
+            return 0
+        products = products.filter(pk__in=product_ids)
+    return products.update(effective_price=effective_price())
+
+
+def refresh_scheduled_promotions(window):
+    """
+    Promotions with dates start and end without anybody saving them, so this runs periodically
+    and refreshes the products of the promotions that started or ended in the last `window`.
+    """
+    now = timezone.now()
+    changed = Q(starts_at__gt=now - window, starts_at__lte=now) | \
+        Q(ends_at__gt=now - window, ends_at__lte=now)
+    product_ids = list(
+        Product.objects
+        .filter(promotions__in=Promotion.objects.filter(changed))
+        .values_list('id', flat=True)
+        .distinct())
+    refresh_effective_prices(product_ids)
+    invalidate_products(*product_ids)
+    return product_ids
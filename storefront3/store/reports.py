@@ -0,0 +1,155 @@
+from datetime import timedelta
+from django.db import transaction
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Max, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from .models import DailyCollectionSales, DailyCustomerSales, DailyProductSales, OrderItem, RollupCheckpoint
+
+CHECKPOINT = 'sales'
+BATCH_SIZE = 10_000
+# Order items are only rolled up once their order is this old, so a checkout that got its ids
+#before another one but committed after it is not skipped by the checkpoint
+SAFETY_LAG = timedelta(minutes=2)
+
+revenue = Sum(ExpressionWrapper(
+    F('quantity') * F('unit_price'),
+    output_field=DecimalField(max_digits=14, decimal_places=2)))
+
+
+def add_to_rollup(model, key, rows, values):
+    """
+    Adds the aggregated `rows` to the existing rollup rows of `model`, matched on ('date', key),
+    and creates the ones that don't exist yet. `values` maps the rollup fields to the row keys
+    holding the amounts. Two queries plus the writes.
+    """
+    if not rows:
+        return
+    existing = {
+        (rollup.date, getattr(rollup, key)): rollup
+        for rollup in model.objects.filter(
+            date__in={row['date'] for row in rows},
+            **{f'{key}__in': {row[key] for row in rows}})
+    }
+    to_update, to_create = [], []
+    for row in rows:
+        rollup = existing.get((row['date'], row[key]))
+        if rollup is None:
+            to_create.append(model(
+                date=row['date'], **{key: row[key]},
+                **{field: row[value] for field, value in values.items()}))
+        else:
+            for field, value in values.items():
+                setattr(rollup, field, getattr(rollup, field) + row[value])
+            to_update.append(rollup)
+    model.objects.bulk_update(to_update, list(values), batch_size=1000)
+    model.objects.bulk_create(to_create, batch_size=1000)
+
+
+def get_batch_upper_id(last_id, cutoff, batch_size):
+    """
+    The highest order item id of the next batch, or None if there's nothing to roll up yet.
+    The batch stops before the first item still inside the safety lag: the checkpoint never moves
+    past an item that isn't rolled up, so items of orders that commit late aren't skipped.
+    """
+    rows = list(
+        OrderItem.objects
+        .filter(id__gt=last_id)
+        .order_by('id')
+        .values_list('id', 'order_id', 'order__placed_at')[:batch_size])
+    for index, (_, _, placed_at) in enumerate(rows):
+        if placed_at >= cutoff:
+            rows = rows[:index]
+            break
+
+    while rows:
+        last_order_id = rows[-1][1]
+        # Including the rest of the last order so its items are never split across batches,
+        #otherwise the order would be counted twice in DailyCustomerSales.orders_count
+        upper_id = OrderItem.objects.filter(order_id=last_order_id).aggregate(id=Max('id'))['id']
+        if upper_id == rows[-1][0] or not OrderItem.objects.filter(
+                id__gt=rows[-1][0], id__lte=upper_id, order__placed_at__gte=cutoff).exists():
+            return upper_id
+        # The rest of that order comes after an item inside the lag, the order waits for the next run
+        first = next(index for index, row in enumerate(rows) if row[1] == last_order_id)
+        rows = rows[:first]
+    return None
+
+
+def refresh_rollups(batch_size=BATCH_SIZE):
+    """
+    Adds the order items placed since the last run to the daily rollups, batch_size items per
+    transaction. The checkpoint row is locked so two runs never add the same items twice.
+    Returns the number of order items processed.
+    """
+    processed = 0
+    cutoff = timezone.now() - SAFETY_LAG
+    while True:
+        with transaction.atomic():
+            checkpoint, _ = RollupCheckpoint.objects \
+                .select_for_update() \
+                .get_or_create(name=CHECKPOINT)
+            last_id = checkpoint.last_order_item_id
+
+            upper_id = get_batch_upper_id(last_id, cutoff, batch_size)
+            if upper_id is None:
+                return processed
+
+            items = OrderItem.objects \
+                .filter(id__gt=last_id, id__lte=upper_id) \
+                .annotate(date=TruncDate('order__placed_at')) \
+                .order_by()
+
+            # The aggregates can't be named after OrderItem fields, F('quantity') in `revenue`
+            #would then resolve to the quantity aggregate
+            add_to_rollup(
+                DailyProductSales, 'product_id',
+                list(items.values('date', 'product_id').annotate(
+                    total_quantity=Sum('quantity'), total_revenue=revenue)),
+                {'quantity': 'total_quantity', 'revenue': 'total_revenue'})
+            add_to_rollup(
+                DailyCollectionSales, 'collection_id',
+                list(items.values('date', collection_id=F('product__collection_id')).annotate(
+                    total_quantity=Sum('quantity'), total_revenue=revenue)),
+                {'quantity': 'total_quantity', 'revenue': 'total_revenue'})
+            add_to_rollup(
+                DailyCustomerSales, 'customer_id',
+                list(items.values('date', customer_id=F('order__customer_id')).annotate(
+                    total_orders=Count('order_id', distinct=True), total_revenue=revenue)),
+                {'orders_count': 'total_orders', 'revenue': 'total_revenue'})
+
+            processed += items.count()
+            checkpoint.last_order_item_id = upper_id
+            checkpoint.save(update_fields=['last_order_item_id'])
+
+
+# Range queries, answered from the rollups only
+def sales_by_product(start, end, ordering='-revenue', limit=100):
+    return DailyProductSales.objects \
+        .filter(date__range=(start, end)) \
+        .values('product_id', title=F('product__title')) \
+        .annotate(quantity=Sum('quantity'), revenue=Sum('revenue')) \
+        .order_by(ordering)[:limit]
+
+
+def sales_by_collection(start, end, ordering='-revenue', limit=100):
+    return DailyCollectionSales.objects \
+        .filter(date__range=(start, end)) \
+        .values('collection_id', title=F('collection__title')) \
+        .annotate(quantity=Sum('quantity'), revenue=Sum('revenue')) \
+        .order_by(ordering)[:limit]
+
+
+def sales_by_customer(start, end, ordering='-revenue', limit=100):
+    return DailyCustomerSales.objects \
+        .filter(date__range=(start, end)) \
+        .values('customer_id') \
+        .annotate(orders_count=Sum('orders_count'), revenue=Sum('revenue')) \
+        .order_by(ordering)[:limit]
+
+
+def sales_by_day(start, end):
+    return DailyProductSales.objects \
+        .filter(date__range=(start, end)) \
+        .values('date') \
+        .annotate(quantity=Sum('quantity'), revenue=Sum('revenue')) \
+        .order_by('date')
@@ -1,8 +1,17 @@
 from decimal import Decimal
+from django.conf import settings
+from django.core.files.storage import default_storage
 from django.db import transaction
+from django.db.models import Manager
 from rest_framework import serializers
-from .signals import order_created
-from .models import Cart, CartItem, Customer, Order, OrderItem, Product, Collection, ProductImage, Review
+from .carts import ProductNotFound, add_cart_items
+from .context import get_customer_id
+from .counters import record_order
+from .inventory import reserve
+from .signals.dispatch import publish
+from .tax import compute_taxes, get_tax_region
+from .tasks import generate_image_variants
+from .models import Cart, CartItem, Customer, CustomerStats, Order, OrderItem, Product, Collection, ProductImage, ProductImageUpload, Review
 
 
 class CollectionSerializer(serializers.ModelSerializer):
@@ -14,15 +23,53 @@ class CollectionSerializer(serializers.ModelSerializer):
 
 # Serializer for uploading an image
 class ProductImageSerializer(serializers.ModelSerializer):
+    # {'webp': '<url> 160w, <url> 320w, ...', 'jpeg': ...}, empty until the variants are generated
+    srcset = serializers.SerializerMethodField()
+
     # Overwriting the create method so we grab the product ID from the context and use it to create a ProductImage obj 
     def create(self, validated_data):
         product_id = self.context['product_id']
         # Explicitly creating the product image obj
-        return ProductImage.objects.create(product_id=product_id, **validated_data)
+        product_image = ProductImage.objects.create(product_id=product_id, **validated_data)
+        # Resizing happens in a Celery task, once the image row is committed
+        transaction.on_commit(lambda: generate_image_variants.delay(product_image.id))
+        return product_image
+
+    def get_srcset(self, product_image: ProductImage):
+        request = self.context.get('request')
+        srcset = {}
+        for image_format, variants in (product_image.variants or {}).items():
+            candidates = []
+            for width, name in sorted(variants.items(), key=lambda item: int(item[0])):
+                url = default_storage.url(name)
+                if request is not None:
+                    url = request.build_absolute_uri(url)
+                candidates.append(f'{url} {width}w')
+            srcset[image_format] = ', '.join(candidates)
+        return srcset
 
     class Meta:
         model = ProductImage
-        fields = ['id', 'image']
+        fields = ['id', 'image', 'srcset']
+
+class ProductImageUploadSerializer(serializers.ModelSerializer):
+    # The offset the next chunk has to start at
+    offset = serializers.IntegerField(source='received', read_only=True)
+
+    class Meta:
+        model = ProductImageUpload
+        fields = ['id', 'filename', 'size', 'offset']
+        read_only_fields = ['id']
+
+
+class ProductListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        products = list(data.all() if isinstance(data, Manager) else data)
+        region = get_tax_region(self.context.get('request'))
+        taxes = compute_taxes([(product.collection_id, product.effective_price) for product in products], region)
+        self.child.taxes = {product.id: tax for product, tax in zip(products, taxes)}
+        return super().to_representation(products)
+
 
 class ProductSerializer(serializers.ModelSerializer):
     # Adding the "images" field to fields parameter and defining it above here setting many to True bc product c/h many 
@@ -32,13 +79,20 @@ class ProductSerializer(serializers.ModelSerializer):
     class Meta:
         model = Product
         fields = ['id', 'title', 'description', 'slug', 'inventory',
-                  'unit_price', 'price_with_tax', 'collection', 'images']
+                  'unit_price', 'effective_price', 'price_with_tax', 'collection', 'images']
+        list_serializer_class = ProductListSerializer
 
     price_with_tax = serializers.SerializerMethodField(
         method_name='calculate_tax')
 
+    # On the promoted price, like the carts and orders
     def calculate_tax(self, product: Product):
-        return product.unit_price * Decimal(1.1)
+        # Computed for the whole page by ProductListSerializer, this is only for a single product
+        taxes = getattr(self, 'taxes', None)
+        if taxes is None or product.id not in taxes:
+            region = get_tax_region(self.context.get('request'))
+            taxes = {product.id: compute_taxes([(product.collection_id, product.effective_price)], region)[0]}
+        return product.effective_price + taxes[product.id]
 
 
 class ReviewSerializer(serializers.ModelSerializer):
@@ -54,15 +108,13 @@ class ReviewSerializer(serializers.ModelSerializer):
 class SimpleProductSerializer(serializers.ModelSerializer):
     class Meta:
         model = Product
-        fields = ['id', 'title', 'unit_price']
+        fields = ['id', 'title', 'unit_price', 'effective_price']
 
 
 class CartItemSerializer(serializers.ModelSerializer):
     product = SimpleProductSerializer()
-    total_price = serializers.SerializerMethodField()
-
-    def get_total_price(self, cart_item: CartItem):
-        return cart_item.quantity * cart_item.product.unit_price
+    # Annotated by CartItemViewSet/CartViewSet as quantity * product__effective_price
+    total_price = serializers.DecimalField(max_digits=12, decimal_places=2, read_only=True)
 
     class Meta:
         model = CartItem
@@ -74,37 +126,39 @@ class CartSerializer(serializers.ModelSerializer):
     items = CartItemSerializer(many=True, read_only=True)
     total_price = serializers.SerializerMethodField()
 
+    total_tax = serializers.SerializerMethodField()
+
     def get_total_price(self, cart):
-        return sum([item.quantity * item.product.unit_price for item in cart.items.all()])
+        # Annotated by CartViewSet, only a cart that was just created (so it's empty) doesn't have it
+        return getattr(cart, 'total_price', 0)
+
+    def get_total_tax(self, cart):
+        # The items and their products are prefetched, so this doesn't query anything
+        region = get_tax_region(self.context.get('request'))
+        return sum(compute_taxes(
+            [(item.product.collection_id, item.quantity * item.product.effective_price)
+             for item in cart.items.all()],
+            region), Decimal(0))
 
     class Meta:
         model = Cart
-        fields = ['id', 'items', 'total_price']
+        fields = ['id', 'items', 'total_price', 'total_tax']
 
 
 class AddCartItemSerializer(serializers.ModelSerializer):
     product_id = serializers.IntegerField()
 
-    def validate_product_id(self, value):
-        if not Product.objects.filter(pk=value).exists():
-            raise serializers.ValidationError(
-                'No product with the given ID was found.')
-        return value
-
+    # The product is validated by the upsert itself, it only inserts rows for existing products
     def save(self, **kwargs):
         cart_id = self.context['cart_id']
         product_id = self.validated_data['product_id']
         quantity = self.validated_data['quantity']
 
         try:
-            cart_item = CartItem.objects.get(
-                cart_id=cart_id, product_id=product_id)
-            cart_item.quantity += quantity
-            cart_item.save()
-            self.instance = cart_item
-        except CartItem.DoesNotExist:
-            self.instance = CartItem.objects.create(
-                cart_id=cart_id, **self.validated_data)
+            self.instance = add_cart_items(cart_id, {product_id: quantity})[0]
+        except ProductNotFound:
+            raise serializers.ValidationError(
+                {'product_id': ['No product with the given ID was found.']})
 
         return self.instance
 
@@ -113,6 +167,27 @@ class AddCartItemSerializer(serializers.ModelSerializer):
         fields = ['id', 'product_id', 'quantity']
 
 
+class BulkAddCartItemSerializer(serializers.Serializer):
+    items = AddCartItemSerializer(many=True, allow_empty=False)
+
+    def save(self, **kwargs):
+        quantities = {}
+        for item in self.validated_data['items']:
+            quantities[item['product_id']] = \
+                quantities.get(item['product_id'], 0) + item['quantity']
+
+        try:
+            self.instance = add_cart_items(self.context['cart_id'], quantities)
+        except ProductNotFound as e:
+            raise serializers.ValidationError(
+                {'product_id': [f'No product with the ID {id} was found.' for id in e.product_ids]})
+
+        return self.instance
+
+    def to_representation(self, instance):
+        return {'items': AddCartItemSerializer(instance, many=True).data}
+
+
 class UpdateCartItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = CartItem
@@ -127,12 +202,22 @@ class CustomerSerializer(serializers.ModelSerializer):
         fields = ['id', 'user_id', 'phone', 'birth_date', 'membership']
 
 
+class CustomerStatsSerializer(serializers.ModelSerializer):
+    average_basket_size = serializers.FloatField(read_only=True)
+    average_order_value = serializers.DecimalField(max_digits=12, decimal_places=2, read_only=True)
+
+    class Meta:
+        model = CustomerStats
+        fields = ['orders_count', 'items_count', 'lifetime_spend', 'last_order_at',
+                  'average_basket_size', 'average_order_value']
+
+
 class OrderItemSerializer(serializers.ModelSerializer):
     product = SimpleProductSerializer()
 
     class Meta:
         model = OrderItem
-        fields = ['id', 'product', 'unit_price', 'quantity']
+        fields = ['id', 'product', 'unit_price', 'unit_tax', 'quantity']
 
 
 class OrderSerializer(serializers.ModelSerializer):
@@ -164,25 +249,48 @@ class CreateOrderSerializer(serializers.Serializer):
         with transaction.atomic():
             cart_id = self.validated_data['cart_id']
 
-            customer = Customer.objects.get(
-                user_id=self.context['user_id'])
-            order = Order.objects.create(customer=customer)
+            # Resolved once per request, the view may already have done it
+            order = Order.objects.create(customer_id=get_customer_id(self.context['request']))
 
             cart_items = CartItem.objects \
                 .select_related('product') \
                 .filter(cart_id=cart_id)
+
+            # InsufficientInventory rolls the order back, OrderViewSet turns it into a 409
+            reserve({item.product_id: item.quantity for item in cart_items})
+
+            cart_items = list(cart_items)
+            unit_taxes = compute_taxes(
+                [(item.product.collection_id, item.product.effective_price) for item in cart_items],
+                self.context.get('tax_region', settings.STORE_DEFAULT_TAX_REGION))
             order_items = [
                 OrderItem(
                     order=order,
                     product=item.product,
-                    unit_price=item.product.unit_price,
+                    # Promotions are already applied in the precomputed effective price
+                    unit_price=item.product.effective_price,
+                    unit_tax=unit_tax,
                     quantity=item.quantity
-                ) for item in cart_items
+                ) for item, unit_tax in zip(cart_items, unit_taxes)
             ]
             OrderItem.objects.bulk_create(order_items)
+            record_order(order, order_items)
 
             Cart.objects.filter(pk=cart_id).delete()
 
-            order_created.send_robust(self.__class__, order=order)
+            # Receivers run in a Celery task once the transaction commits, not on this request
+            publish('order_created', order)
+
+            return order
+
+class ReportQuerySerializer(serializers.Serializer):
+    start = serializers.DateField()
+    end = serializers.DateField()
+    ordering = serializers.ChoiceField(
+        choices=['revenue', '-revenue', 'quantity', '-quantity'], default='-revenue')
+    limit = serializers.IntegerField(min_value=1, max_value=1000, default=100)
 
-            return order
\ No newline at end of file
+    def validate(self, data):
+        if data['start'] > data['end']:
+            raise serializers.ValidationError('start must be before end.')
+        return data
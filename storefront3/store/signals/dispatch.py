@@ -0,0 +1,72 @@
+import logging
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from store.signals import order_created
+
+logger = logging.getLogger(__name__)
+
+# Signals that are delivered asynchronously. Events only carry the primary key of the instance
+#so they can be sent to Celery, the receivers still get the instance under the given keyword.
+ASYNC_SIGNALS = {
+    'order_created': (order_created, 'store.Order', 'order'),
+}
+
+
+class EventBatch:
+    """All events published inside the same transaction, sent as a single Celery task on commit."""
+
+    def __init__(self):
+        self.events = []
+
+    def __call__(self):
+        if not self.events:
+            return
+        if getattr(settings, 'STORE_EVENTS_EAGER', False):
+            deliver(self.events)
+        else:
+            from store.tasks import deliver_events
+            deliver_events.delay(self.events)
+
+
+def get_batch():
+    connection = transaction.get_connection()
+    savepoint_ids = set(connection.savepoint_ids)
+    # Reusing the batch registered in this same savepoint, if it's rolled back Django drops the
+    #callback and the batch goes away with it
+    for sids, func, *_ in connection.run_on_commit:
+        if isinstance(func, EventBatch) and sids == savepoint_ids:
+            return func
+    batch = EventBatch()
+    transaction.on_commit(batch)
+    return batch
+
+
+def publish(name, instance):
+    if name not in ASYNC_SIGNALS:
+        raise ValueError(f'Unknown event "{name}".')
+    event = [name, instance.pk]
+    if not transaction.get_connection().in_atomic_block:
+        batch = EventBatch()
+        batch.events.append(event)
+        batch()
+    else:
+        get_batch().events.append(event)
+
+
+def deliver(events):
+    ids_by_name = {}
+    for name, pk in events:
+        ids_by_name.setdefault(name, []).append(pk)
+
+    for name, ids in ids_by_name.items():
+        signal, model_name, kwarg = ASYNC_SIGNALS[name]
+        model = apps.get_model(model_name)
+        instances = model.objects.in_bulk(ids)
+        for pk in ids:
+            if pk not in instances:
+                logger.warning('Skipping %s event, %s %s no longer exists.', name, model_name, pk)
+                continue
+            for receiver, response in signal.send_robust(model, **{kwarg: instances[pk]}):
+                if isinstance(response, Exception):
+                    logger.error('%s receiver %r failed', name, receiver, exc_info=response)
@@ -1,9 +1,179 @@
 from django.conf import settings
-from django.db.models.signals import post_save
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group, Permission
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
 from django.dispatch import receiver
-from store.models import Customer
+from store.authentication import invalidate_principal
+from store.backends import invalidate_permissions
+from store.cache import invalidate_collections, invalidate_products
+from store.cachecontrol import purge, reviews_key
+from store.counters import adjust_products_count, reconcile_products_count
+from store.promotions import refresh_effective_prices
+from store.tax import invalidate_tax_rates
+from store.models import Collection, Customer, CustomerStats, Product, ProductImage, Promotion, Review, TaxRate
 
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
 def create_customer_for_new_user(sender, **kwargs):
   if kwargs['created']:
-    Customer.objects.create(user=kwargs['instance'])
\ No newline at end of file
+    Customer.objects.create(user=kwargs['instance'])
+
+@receiver(post_save, sender=Customer)
+def create_stats_for_new_customer(sender, **kwargs):
+  if kwargs['created']:
+    CustomerStats.objects.create(customer=kwargs['instance'])
+
+
+@receiver(pre_save, sender=Product)
+def remember_product_collection(sender, instance, **kwargs):
+  # Moving a product changes the products_count of the collection it leaves as well, and a new
+  #price changes the effective price
+  instance._previous_collection_id = None
+  instance._previous_unit_price = None
+  if instance.pk:
+    products = Product.objects.filter(pk=instance.pk)
+    # Locking the row so two concurrent moves of the same product don't both read the old
+    #collection (only possible inside a transaction)
+    if transaction.get_connection().in_atomic_block:
+      products = products.select_for_update()
+    previous = products \
+      .values_list('collection_id', 'unit_price') \
+      .first()
+    if previous is not None:
+      instance._previous_collection_id, instance._previous_unit_price = previous
+  if instance.effective_price is None:
+    instance.effective_price = instance.unit_price
+
+# Catalog cache invalidation
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product(sender, instance, **kwargs):
+  invalidate_products(instance.pk)
+  collection_ids = {instance.collection_id, getattr(instance, '_previous_collection_id', None)}
+  invalidate_collections(*[pk for pk in collection_ids if pk is not None])
+
+# Collection.products_count
+@receiver(post_save, sender=Product)
+def count_saved_product(sender, instance, created, **kwargs):
+  previous_collection_id = getattr(instance, '_previous_collection_id', None)
+  if created:
+    adjust_products_count(instance.collection_id, 1)
+  elif previous_collection_id != instance.collection_id:
+    # Recounting both collections instead of -1/+1, so a move that raced another one can't
+    #leave them drifted
+    reconcile_products_count(
+      collection_ids=[id for id in (previous_collection_id, instance.collection_id) if id is not None])
+
+@receiver(post_delete, sender=Product)
+def count_deleted_product(sender, instance, **kwargs):
+  adjust_products_count(instance.collection_id, -1)
+
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+def invalidate_product_image(sender, instance, **kwargs):
+  invalidate_products(instance.product_id)
+
+@receiver(post_save, sender=Collection)
+@receiver(post_delete, sender=Collection)
+def invalidate_collection(sender, instance, **kwargs):
+  invalidate_collections(instance.pk)
+
+# Effective prices
+@receiver(post_save, sender=Product)
+def refresh_product_effective_price(sender, instance, created, **kwargs):
+  if not created and instance.unit_price != getattr(instance, '_previous_unit_price', None):
+    refresh_effective_prices([instance.pk])
+    instance.refresh_from_db(fields=['effective_price'])
+
+@receiver(post_save, sender=Promotion)
+def refresh_promotion_prices(sender, instance, **kwargs):
+  refresh_effective_prices(list(instance.product_set.values_list('id', flat=True)))
+
+# pre_delete bc once the promotion is gone so are its links to the products
+@receiver(pre_delete, sender=Promotion)
+def remember_promotion_products(sender, instance, **kwargs):
+  instance._product_ids = list(instance.product_set.values_list('id', flat=True))
+  invalidate_products(*instance._product_ids)
+
+@receiver(post_delete, sender=Promotion)
+def refresh_deleted_promotion_prices(sender, instance, **kwargs):
+  refresh_effective_prices(getattr(instance, '_product_ids', []))
+
+@receiver(post_save, sender=Promotion)
+def invalidate_promotion(sender, instance, **kwargs):
+  invalidate_products(*instance.product_set.values_list('id', flat=True))
+
+@receiver(m2m_changed, sender=Product.promotions.through)
+def promotions_changed(sender, instance, action, reverse, pk_set, **kwargs):
+  if action == 'pre_clear':
+    # Remembering who loses the promotions, after the clear they're gone
+    instance._cleared_ids = [instance.pk] if not reverse else \
+      list(instance.product_set.values_list('id', flat=True))
+    return
+  if action not in ('post_add', 'post_remove', 'post_clear'):
+    return
+  if not reverse:
+    product_ids = [instance.pk]
+  elif action == 'post_clear':
+    product_ids = getattr(instance, '_cleared_ids', [])
+  else:
+    product_ids = list(pk_set)
+  refresh_effective_prices(product_ids)
+  invalidate_products(*product_ids)
+
+
+@receiver(post_save, sender=TaxRate)
+@receiver(post_delete, sender=TaxRate)
+def tax_rates_changed(sender, **kwargs):
+  invalidate_tax_rates()
+
+
+# The cached principals hold the user's flags, permissions and customer id
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def invalidate_user_principal(sender, instance, **kwargs):
+  invalidate_principal(instance.pk)
+
+@receiver(post_save, sender=Customer)
+@receiver(post_delete, sender=Customer)
+def invalidate_customer_principal(sender, instance, **kwargs):
+  invalidate_principal(instance.user_id)
+
+# Permission sets: a user's own changes bump that user's version, group and permission changes
+#bump the version shared by everybody
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def invalidate_user_permissions(sender, instance, created, **kwargs):
+  # is_active/is_superuser decide what the permission set is
+  if not created:
+    invalidate_permissions(instance.pk)
+
+@receiver(m2m_changed, sender=get_user_model().groups.through)
+@receiver(m2m_changed, sender=get_user_model().user_permissions.through)
+def user_permissions_changed(sender, instance, action, reverse, pk_set, **kwargs):
+  if action not in ('post_add', 'post_remove', 'post_clear'):
+    return
+  if not reverse:
+    invalidate_permissions(instance.pk)
+  elif action == 'post_clear' or not pk_set:
+    # The users aren't known after a clear from the group/permission side
+    invalidate_permissions()
+  else:
+    invalidate_permissions(*pk_set)
+
+@receiver(m2m_changed, sender=Group.permissions.through)
+def group_permissions_changed(sender, action, **kwargs):
+  if action in ('post_add', 'post_remove', 'post_clear'):
+    invalidate_permissions()
+
+@receiver(post_save, sender=Permission)
+@receiver(post_delete, sender=Permission)
+@receiver(post_delete, sender=Group)
+def permissions_changed(sender, **kwargs):
+  invalidate_permissions()
+
+
+# Reviews aren't in the catalog cache, only the proxy caches them
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def purge_reviews(sender, instance, **kwargs):
+  purge(reviews_key(instance.product_id))
@@ -0,0 +1,53 @@
+from datetime import timedelta
+from celery import shared_task
+from store.cachecontrol import send_purge
+from store.images import process_product_image
+from store.promotions import refresh_scheduled_promotions
+from store.reports import refresh_rollups
+from store.carts import reap_abandoned_carts as reap
+from store.signals import dispatch
+
+
+@shared_task
+def deliver_events(events):
+    dispatch.deliver(events)
+
+
+@shared_task
+def reap_abandoned_carts():
+    stats = reap()
+    # Returned so the metrics end up in the task result / flower
+    return {
+        'carts': stats['carts'],
+        'items': stats['items'],
+        'batches': stats['batches'],
+        'max_batch_seconds': max(stats['batch_seconds'], default=0),
+    }
+
+
+@shared_task
+def generate_image_variants(image_id):
+    process_product_image(image_id)
+
+
+@shared_task
+def reap_image_uploads():
+    # store.uploads imports this module to queue generate_image_variants
+    from store.uploads import reap_expired_uploads
+    return reap_expired_uploads()
+
+
+@shared_task
+def refresh_sales_rollups():
+    return refresh_rollups()
+
+
+@shared_task
+def refresh_promotion_prices():
+    # Overlapping the beat interval so a late run doesn't miss a promotion that started
+    return len(refresh_scheduled_promotions(window=timedelta(minutes=10)))
+
+
+@shared_task(autoretry_for=(OSError,), retry_backoff=True, max_retries=5)
+def purge_surrogate_keys(keys):
+    send_purge(keys)
@@ -0,0 +1,86 @@
+import threading
+from decimal import ROUND_HALF_UP, Decimal
+from time import monotonic
+from django.conf import settings
+from django.db import transaction
+from .cache import bump_versions, get_versions, version_key
+from .cachecontrol import TAX_RATES, purge
+from .models import TaxRate
+
+CENT = Decimal('0.01')
+# The table's version token lives next to the catalog versions, ProductViewSet puts it in the keys
+#of its cached pages
+VERSION_NAMESPACE = 'tax_rates'
+
+
+class RateTable:
+    def __init__(self, rates, version):
+        # {(region, collection_id or None): rate}
+        self.rates = rates
+        self.version = version
+
+    def rate(self, region, collection_id):
+        rates = self.rates
+        if (region, collection_id) in rates:
+            return rates[(region, collection_id)]
+        if (region, None) in rates:
+            return rates[(region, None)]
+        return settings.STORE_DEFAULT_TAX_RATE
+
+
+# Process-local copy of the table. We only ask Redis whether it changed once every
+#STORE_TAX_RATES_TTL seconds, and only reload from the database when it did.
+_table = None
+_checked_at = 0
+_lock = threading.Lock()
+
+
+def get_rate_table():
+    global _table, _checked_at
+    if _table is not None and monotonic() - _checked_at < settings.STORE_TAX_RATES_TTL:
+        return _table
+    with _lock:
+        version, = get_versions(version_key(VERSION_NAMESPACE))
+        if _table is None or _table.version != version:
+            rates = {
+                (region, collection_id): rate
+                for region, collection_id, rate
+                in TaxRate.objects.values_list('region', 'collection_id', 'rate')
+            }
+            _table = RateTable(rates, version)
+        _checked_at = monotonic()
+        return _table
+
+
+def invalidate_tax_rates():
+    def expire():
+        global _checked_at
+        _checked_at = 0
+    bump_versions(version_key(VERSION_NAMESPACE))
+    purge(TAX_RATES)
+    # This process sees the new rates right after the commit, the others within STORE_TAX_RATES_TTL
+    transaction.on_commit(expire)
+
+
+def get_tax_region(request):
+    if request is not None:
+        region = request.query_params.get('tax_region')
+        if region:
+            return region
+    return settings.STORE_DEFAULT_TAX_REGION
+
+
+def compute_taxes(amounts, region):
+    """
+    Takes [(collection_id, amount), ...] and returns the tax of every amount, rounded to the
+    cent. The table is read once and each collection's rate is looked up once, however many
+    amounts there are.
+    """
+    table = get_rate_table()
+    rates = {}
+    taxes = []
+    for collection_id, amount in amounts:
+        if collection_id not in rates:
+            rates[collection_id] = table.rate(region, collection_id)
+        taxes.append((amount * rates[collection_id]).quantize(CENT, rounding=ROUND_HALF_UP))
+    return taxes
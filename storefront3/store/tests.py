@@ -1,3 +1,1442 @@
-from django.test import TestCase
+import json
+import os
+import re
+import shutil
+import tempfile
+from base64 import b64encode
+from datetime import timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group, Permission
+from django.core.files.base import ContentFile
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+import threading
+from unittest import mock
+from django.db import connection
+from django.db.models import QuerySet
+from django.test import SimpleTestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory, APITestCase
+from rest_framework_simplejwt.tokens import AccessToken
+from . import bulk
+from .authentication import local_principals
+from .backends import local_permissions
+from .carts import reap_abandoned_carts
+from .counters import reconcile_customer_stats
+from .filters import FullTextSearchFilter
+from .images import VARIANT_WIDTHS, generate_variants, process_product_image
+from .management.commands.seed_db import iter_statements
+from .metrics import registry
+from .promotions import refresh_scheduled_promotions
+from .reports import refresh_rollups
+from .tax import compute_taxes, get_rate_table
+from .views import CollectionViewSet
+from .uploads import UploadError, append_chunk, get_part_path, reap_expired_uploads
+from .signals import order_created
+from .models import Cart, CartItem, Collection, Customer, CustomerStats, DailyCollectionSales, DailyCustomerSales, DailyProductSales, Order, OrderItem, Product, ProductImage, ProductImageUpload, Promotion, Review, RollupCheckpoint, TaxRate
 
-# Create your tests here.
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class StoreTestCase(APITestCase):
+    """
+    Runs on a locmem cache instead of Redis, emptied before every test along with the process
+    local caches. The version tokens never expire and the on_commit bumps don't run inside a
+    TestCase, so otherwise cached responses and principals would leak from one test to the next.
+    """
+
+    def setUp(self):
+        cache.clear()
+        local_principals.clear()
+        local_permissions.clear()
+
+
+# Caching is turned off so we measure what a cache miss costs
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+class QueryCountTestCase(StoreTestCase):
+    """
+    Query-count regression suite for the store.urls endpoints. Every test requests an endpoint,
+    adds more rows that the response nests (orders, items, images...) and requests it again.
+    The number of queries must not change, otherwise we introduced an N+1.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.collection = Collection.objects.create(title='Collection')
+        self.user = get_user_model().objects.create_user(
+            username='user', email='user@domain.com', password='secret')
+        self.customer = Customer.objects.get(user=self.user)
+        self.admin = get_user_model().objects.create_user(
+            username='admin', email='admin@domain.com', password='secret', is_staff=True)
+        # The tax rate table is loaded once per process, not per request
+        get_rate_table()
+
+    def create_product(self):
+        count = Product.objects.count()
+        return Product.objects.create(
+            title=f'Product {count}', slug=f'product-{count}', unit_price=10,
+            inventory=100, collection=self.collection)
+
+    def create_order(self, customer, items=1):
+        order = Order.objects.create(customer=customer)
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=self.create_product(), quantity=1, unit_price=10)
+            for _ in range(items)
+        ])
+        return order
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+            # Streaming responses only run their queries while the content is consumed
+            content = b''.join(response.streaming_content) if response.streaming else response.content
+        self.assertEqual(response.status_code, 200, content)
+        return len(context.captured_queries)
+
+    def assertConstantQueries(self, url, grow, times=5):
+        grow()
+        expected = self.count_queries(url)
+        for _ in range(times):
+            grow()
+        self.assertEqual(self.count_queries(url), expected)
+
+    def test_product_list(self):
+        def grow():
+            product = self.create_product()
+            ProductImage.objects.create(product=product, image='store/images/test.jpg')
+        self.assertConstantQueries('/store/products/', grow)
+
+    def test_product_detail(self):
+        product = self.create_product()
+        self.assertConstantQueries(
+            f'/store/products/{product.id}/',
+            lambda: ProductImage.objects.create(product=product, image='store/images/test.jpg'))
+
+    def test_collection_list(self):
+        def grow():
+            self.create_product()
+            Collection.objects.create(title='Other')
+        self.assertConstantQueries('/store/collections/', grow)
+
+    def test_collection_detail(self):
+        self.assertConstantQueries(
+            f'/store/collections/{self.collection.id}/', self.create_product)
+
+    def test_review_list(self):
+        product = self.create_product()
+        self.assertConstantQueries(
+            f'/store/products/{product.id}/reviews/',
+            lambda: Review.objects.create(product=product, name='a', description='b'))
+
+    def test_image_list(self):
+        product = self.create_product()
+        self.assertConstantQueries(
+            f'/store/products/{product.id}/images/',
+            lambda: ProductImage.objects.create(product=product, image='store/images/test.jpg'))
+
+    def test_cart_detail(self):
+        cart = Cart.objects.create()
+        self.assertConstantQueries(
+            f'/store/carts/{cart.id}/',
+            lambda: CartItem.objects.create(cart=cart, product=self.create_product(), quantity=1))
+
+    def test_cart_item_list(self):
+        cart = Cart.objects.create()
+        self.assertConstantQueries(
+            f'/store/carts/{cart.id}/items/',
+            lambda: CartItem.objects.create(cart=cart, product=self.create_product(), quantity=1))
+
+    def test_customer_list(self):
+        self.client.force_authenticate(self.admin)
+        count = [0]
+
+        def grow():
+            count[0] += 1
+            get_user_model().objects.create_user(
+                username=f'user{count[0]}', email=f'user{count[0]}@domain.com', password='secret')
+        self.assertConstantQueries('/store/customers/', grow)
+
+    def test_customer_me(self):
+        self.client.force_authenticate(self.user)
+        self.assertConstantQueries(
+            '/store/customers/me/', lambda: self.create_order(self.customer))
+
+    def test_customer_history(self):
+        superuser = get_user_model().objects.create_superuser(
+            username='superuser', email='superuser@domain.com', password='secret')
+        self.client.force_authenticate(superuser)
+        self.assertConstantQueries(
+            f'/store/customers/{self.customer.id}/history/',
+            lambda: self.create_order(self.customer, items=3))
+
+    def test_order_list_for_customer(self):
+        self.client.force_authenticate(self.user)
+        self.assertConstantQueries(
+            '/store/orders/', lambda: self.create_order(self.customer, items=3))
+
+    def test_order_list_for_staff(self):
+        self.client.force_authenticate(self.admin)
+        self.assertConstantQueries(
+            '/store/orders/', lambda: self.create_order(self.customer, items=3))
+
+    def test_order_detail(self):
+        self.client.force_authenticate(self.user)
+        order = self.create_order(self.customer)
+
+        def grow():
+            OrderItem.objects.create(
+                order=order, product=self.create_product(), quantity=1, unit_price=10)
+        self.assertConstantQueries(f'/store/orders/{order.id}/', grow)
+
+    def test_order_create(self):
+        self.client.force_authenticate(self.user)
+
+        def checkout(items):
+            cart = Cart.objects.create()
+            for _ in range(items):
+                CartItem.objects.create(cart=cart, product=self.create_product(), quantity=1)
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.post('/store/orders/', {'cart_id': str(cart.id)})
+            self.assertEqual(response.status_code, 200, response.content)
+            return len(context.captured_queries)
+
+        self.assertEqual(checkout(items=5), checkout(items=1))
+
+    def test_cart_item_bulk_add(self):
+        def add(items):
+            cart = Cart.objects.create()
+            data = {'items': [
+                {'product_id': self.create_product().id, 'quantity': 1} for _ in range(items)]}
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.post(f'/store/carts/{cart.id}/items/bulk/', data, format='json')
+            self.assertEqual(response.status_code, 201, response.content)
+            return len(context.captured_queries)
+
+        self.assertEqual(add(items=5), add(items=1))
+
+    def test_product_export(self):
+        self.client.force_authenticate(self.admin)
+        self.assertConstantQueries('/store/products/export/', self.create_product)
+        self.assertConstantQueries('/store/products/export/?export_format=ndjson', self.create_product)
+
+    def grow_rollups(self):
+        today = timezone.now().date()
+        product = self.create_product()
+        collection = Collection.objects.create(title='Other')
+        customer = Customer.objects.get(user=get_user_model().objects.create_user(
+            username=f'user{product.id}', email=f'user{product.id}@domain.com', password='secret'))
+        DailyProductSales.objects.create(date=today, product=product, quantity=1, revenue=10)
+        DailyCollectionSales.objects.create(date=today, collection=collection, quantity=1, revenue=10)
+        DailyCustomerSales.objects.create(date=today, customer=customer, orders_count=1, revenue=10)
+
+    def test_reports(self):
+        self.client.force_authenticate(self.admin)
+        today = timezone.now().date()
+        for report in ['products', 'collections', 'customers', 'daily']:
+            with self.subTest(report=report):
+                self.assertConstantQueries(
+                    f'/store/reports/{report}/?start={today}&end={today}', self.grow_rollups)
+
+    def test_chunked_upload(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings = override_settings(
+            MEDIA_ROOT=media_root, STORE_IMAGE_UPLOAD_DIR=os.path.join(media_root, 'uploads'))
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        product = self.create_product()
+        url = f'/store/products/{product.id}/images/uploads/'
+        file = BytesIO()
+        Image.new('RGB', (64, 48), 'red').save(file, 'PNG')
+        image = file.getvalue()
+
+        def upload(chunks):
+            upload_id = self.client.post(url, {'filename': 'red.png', 'size': len(image)}).data['id']
+            get_queries = self.count_queries(f'{url}{upload_id}/')
+            size = -(-len(image) // chunks)
+            counts = []
+            for offset in range(0, len(image), size):
+                with CaptureQueriesContext(connection) as context:
+                    response = self.client.generic(
+                        'PATCH', f'{url}{upload_id}/', image[offset:offset + size],
+                        content_type='application/octet-stream', HTTP_UPLOAD_OFFSET=str(offset))
+                self.assertEqual(response.status_code, 200, response.content)
+                counts.append(len(context.captured_queries))
+            with mock.patch('store.uploads.generate_image_variants'), \
+                    CaptureQueriesContext(connection) as context:
+                response = self.client.post(f'{url}{upload_id}/complete/')
+            self.assertEqual(response.status_code, 201, response.content)
+            return get_queries, set(counts), len(context.captured_queries)
+
+        # Every chunk costs the same, and completing doesn't depend on how many chunks were sent
+        expected = upload(chunks=1)
+        self.assertEqual(upload(chunks=4), expected)
+        self.assertEqual(len(expected[1]), 1)
+
+
+@override_settings(STORE_EVENTS_EAGER=True)
+class OrderCreatedEventTestCase(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = get_user_model().objects.create_user(
+            username='user', email='user@domain.com', password='secret')
+        collection = Collection.objects.create(title='Collection')
+        self.product = Product.objects.create(
+            title='Product', slug='product', unit_price=10, inventory=100, collection=collection)
+        self.received = []
+        order_created.connect(self.receiver)
+        self.addCleanup(order_created.disconnect, self.receiver)
+
+    def receiver(self, sender, **kwargs):
+        self.received.append(kwargs['order'].id)
+
+    def test_receivers_run_after_commit(self):
+        self.client.force_authenticate(self.user)
+        cart = Cart.objects.create()
+        CartItem.objects.create(cart=cart, product=self.product, quantity=1)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post('/store/orders/', {'cart_id': str(cart.id)})
+            self.assertEqual(self.received, [])
+
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.received, [response.data['id']])
+
+
+class EffectivePriceTestCase(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        collection = Collection.objects.create(title='Collection')
+        self.product = Product.objects.create(
+            title='Product', slug='product', unit_price=10, inventory=100, collection=collection)
+
+    def assertEffectivePrice(self, price):
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.effective_price, Decimal(price))
+
+    def test_best_active_promotion_wins(self):
+        self.assertEffectivePrice('10.00')
+        small = Promotion.objects.create(description='Small', discount=0.1)
+        big = Promotion.objects.create(description='Big', discount=0.25)
+        self.product.promotions.add(small, big)
+        self.assertEffectivePrice('7.50')
+
+        big.delete()
+        self.assertEffectivePrice('9.00')
+
+        self.product.unit_price = 20
+        self.product.save()
+        self.assertEffectivePrice('18.00')
+
+    def test_scheduled_promotions(self):
+        now = timezone.now()
+        later = Promotion.objects.create(
+            description='Later', discount=0.5, starts_at=now + timedelta(minutes=1))
+        self.product.promotions.add(later)
+        self.assertEffectivePrice('10.00')
+
+        Promotion.objects.filter(pk=later.pk).update(starts_at=now - timedelta(minutes=1))
+        refresh_scheduled_promotions(window=timedelta(minutes=10))
+        self.assertEffectivePrice('5.00')
+
+    def test_prices_are_rounded_to_the_cent(self):
+        self.product.unit_price = Decimal('19.99')
+        self.product.save()
+        self.product.promotions.add(Promotion.objects.create(description='Third off', discount=0.33))
+        self.assertEffectivePrice('13.39')
+        self.assertEqual(self.product.effective_price.as_tuple().exponent, -2)
+
+    def test_discounts_are_fractions(self):
+        for discount in [-0.1, 1.5, 20]:
+            with self.assertRaises(ValidationError):
+                Promotion(description='Wrong', discount=discount).full_clean()
+        Promotion(description='Free', discount=1).full_clean()
+
+
+class TaxTestCase(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.books = Collection.objects.create(title='Books')
+        self.food = Collection.objects.create(title='Food')
+
+    def test_collection_rate_then_region_rate_then_default(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            TaxRate.objects.create(region='fr', rate=Decimal('0.2'))
+            TaxRate.objects.create(region='fr', collection=self.books, rate=Decimal('0.055'))
+
+        amounts = [(self.books.id, Decimal('10')), (self.food.id, Decimal('10')), (self.books.id, Decimal('1'))]
+        self.assertEqual(
+            compute_taxes(amounts, 'fr'), [Decimal('0.55'), Decimal('2.00'), Decimal('0.06')])
+        self.assertEqual(
+            compute_taxes(amounts, 'unknown'), [Decimal('1.00'), Decimal('1.00'), Decimal('0.10')])
+
+    def test_changed_rates_are_reloaded(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            rate = TaxRate.objects.create(region='fr', rate=Decimal('0.2'))
+        self.assertEqual(compute_taxes([(self.food.id, Decimal('10'))], 'fr'), [Decimal('2.00')])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            rate.rate = Decimal('0.1')
+            rate.save()
+        self.assertEqual(compute_taxes([(self.food.id, Decimal('10'))], 'fr'), [Decimal('1.00')])
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}},
+    STORE_METRICS_SAMPLE_RATE=1, STORE_METRICS_SERVER_TIMING=True)
+class RequestMetricsTestCase(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        Collection.objects.create(title='Collection')
+        registry.reset()
+
+    def test_sampled_request_is_measured(self):
+        response = self.client.get('/store/collections/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertRegex(response['Server-Timing'], r'db;dur=[0-9.]+;desc="[1-9][0-9]* queries"')
+        metrics = registry.export()
+        labels = 'view="CollectionViewSet",route="collection-list"'
+        self.assertIn(f'store_http_requests_total{{{labels},method="GET",status="200"}} 1', metrics)
+        self.assertIn(f'store_http_sampled_requests_total{{{labels}}} 1', metrics)
+        self.assertIn(f'store_http_request_duration_seconds_count{{{labels}}} 1', metrics)
+
+    def test_serialization_is_measured_apart_from_the_view(self):
+        # Every clock reading is a second after the previous one, so no measure rounds to 0
+        with mock.patch('store.middleware.perf_counter', side_effect=range(1000)):
+            response = self.client.get('/store/collections/')
+        self.assertRegex(response['Server-Timing'], r'serialize;dur=[1-9][0-9.]*')
+        self.assertIn('store_serialize_duration_seconds_total{view="CollectionViewSet"', registry.export())
+
+    def test_processes_add_up_their_flushed_metrics(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        labels = (('view', 'CollectionViewSet'), ('route', 'collection-list'))
+        with override_settings(STORE_METRICS_DIR=directory, STORE_METRICS_FLUSH_INTERVAL=0):
+            registry.inc('store_db_queries_total', labels, 3)
+            registry.observe(labels, 0.02)
+            registry.flush()
+            # What another worker flushed
+            with open(os.path.join(directory, f'{os.getpid()}.json')) as file:
+                other = file.read()
+            with open(os.path.join(directory, '1.json'), 'w') as file:
+                file.write(other)
+            registry.inc('store_db_queries_total', labels, 1)
+            metrics = registry.export()
+
+        labels = 'view="CollectionViewSet",route="collection-list"'
+        self.assertIn(f'store_db_queries_total{{{labels}}} 7', metrics)
+        self.assertIn(f'store_http_request_duration_seconds_count{{{labels}}} 2', metrics)
+
+    def test_metrics_endpoint_is_closed_by_default(self):
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='127.0.0.1').status_code, 403)
+
+    @override_settings(STORE_METRICS_ALLOWED_IPS=['10.0.0.5'])
+    def test_metrics_endpoint_allows_the_listed_scrapers(self):
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.5').status_code, 200)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='127.0.0.1').status_code, 403)
+
+
+class CachedJWTAuthenticationTestCase(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = get_user_model().objects.create_user(
+            username='user', email='user@domain.com', password='secret')
+        self.client.credentials(HTTP_AUTHORIZATION=f'JWT {AccessToken.for_user(self.user)}')
+
+    def get_orders(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/store/orders/')
+        self.assertEqual(response.status_code, 200, response.content)
+        return [query['sql'] for query in context.captured_queries]
+
+    def test_user_and_customer_are_not_loaded_again(self):
+        self.get_orders()
+        queries = self.get_orders()
+        self.assertEqual(len(queries), 1, queries)
+        self.assertIn('store_order', queries[0])
+
+    def test_order_create_does_not_look_up_the_customer(self):
+        collection = Collection.objects.create(title='Collection')
+        product = Product.objects.create(
+            title='Product', slug='product', unit_price=10, inventory=100, collection=collection)
+        cart = Cart.objects.create()
+        CartItem.objects.create(cart=cart, product=product, quantity=1)
+        self.get_orders()
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post('/store/orders/', {'cart_id': str(cart.id)})
+        self.assertEqual(response.status_code, 200, response.content)
+        customer_queries = [
+            query['sql'] for query in context.captured_queries
+            if re.search(r'FROM [`"]store_customer[`"]', query['sql'])]
+        self.assertEqual(customer_queries, [])
+
+    def test_saving_the_user_invalidates_the_principal(self):
+        self.get_orders()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save()
+        self.assertEqual(self.client.get('/store/orders/').status_code, 401)
+
+
+class PermissionSetCacheTestCase(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = get_user_model().objects.create_user(
+            username='user', email='user@domain.com', password='secret')
+        self.group = Group.objects.create(name='Support')
+        self.group.permissions.add(Permission.objects.get(codename='view_history'))
+        self.user.groups.add(self.group)
+        self.client.credentials(HTTP_AUTHORIZATION=f'JWT {AccessToken.for_user(self.user)}')
+        self.url = f'/store/customers/{self.user.customer.id}/history/'
+
+    def get_history(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.url)
+        return response.status_code, [query['sql'] for query in context.captured_queries]
+
+    def test_permissions_are_not_queried_again(self):
+        status, _ = self.get_history()
+        self.assertEqual(status, 200)
+        status, queries = self.get_history()
+        self.assertEqual(status, 200)
+        self.assertFalse([sql for sql in queries if 'auth_permission' in sql], queries)
+
+    def test_group_changes_invalidate_the_permission_sets(self):
+        self.assertEqual(self.get_history()[0], 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.group.permissions.clear()
+        self.assertEqual(self.get_history()[0], 403)
+
+    def test_model_backend_uses_the_cache(self):
+        self.assertTrue(get_user_model().objects.get(pk=self.user.pk).has_perm('store.view_history'))
+        user = get_user_model().objects.get(pk=self.user.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(user.has_perm('store.view_history'))
+
+
+class ConditionalGetTestCase(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.collection = Collection.objects.create(title='Collection')
+
+    def test_if_none_match(self):
+        url = f'/store/collections/{self.collection.id}/'
+        etag = self.client.get(url)['ETag']
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.collection.title = 'Renamed'
+            self.collection.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_etags_do_not_outlive_the_cached_entry(self):
+        url = f'/store/collections/{self.collection.id}/'
+        # Nothing is kept, every request renders the collection again
+        with mock.patch.object(CollectionViewSet, 'cache_timeout', 0):
+            with mock.patch('store.cache.time', return_value=1_000_000):
+                etag = self.client.get(url)['ETag']
+            with mock.patch('store.cache.time', return_value=1_000_060):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_if_modified_since(self):
+        last_modified = self.client.get('/store/collections/')['Last-Modified']
+        response = self.client.get('/store/collections/', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+class CacheControlTestCase(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.collection = Collection.objects.create(title='Collection')
+
+    def test_anonymous_reads_are_public(self):
+        response = self.client.get(f'/store/collections/{self.collection.id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('public', response['Cache-Control'])
+        self.assertIn('s-maxage=3600', response['Cache-Control'])
+        self.assertIn('Authorization', response['Vary'])
+        self.assertEqual(response['Surrogate-Key'], f'collection-{self.collection.id}')
+
+    def test_authenticated_reads_are_private(self):
+        user = get_user_model().objects.create_user(
+            username='user', email='user@domain.com', password='secret')
+        self.client.credentials(HTTP_AUTHORIZATION=f'JWT {AccessToken.for_user(user)}')
+        response = self.client.get('/store/collections/')
+        self.assertIn('private', response['Cache-Control'])
+        self.assertNotIn('s-maxage', response['Cache-Control'])
+        self.assertFalse(response.has_header('Surrogate-Key'))
+
+    def test_keys_use_the_ids_not_the_url_text(self):
+        product = Product.objects.create(
+            title='Product', slug='product', unit_price=10, inventory=1, collection=self.collection)
+        response = self.client.get(f'/store/collections/00{self.collection.id}/')
+        self.assertEqual(response['Surrogate-Key'], f'collection-{self.collection.id}')
+        response = self.client.get(f'/store/products/00{product.id}/')
+        self.assertIn(f'product-{product.id}', response['Surrogate-Key'].split())
+        response = self.client.get(f'/store/products/00{product.id}/reviews/')
+        self.assertEqual(response['Surrogate-Key'], f'reviews-{product.id}')
+        response = self.client.get(f'/store/products/00{product.id}/images/')
+        self.assertEqual(response['Surrogate-Key'], f'product-{product.id}')
+
+    @override_settings(STORE_CACHE_PURGE_URL='http://localhost:6081/')
+    def test_changes_purge_their_keys(self):
+        with mock.patch('store.tasks.purge_surrogate_keys.delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.collection.title = 'Renamed'
+                self.collection.save()
+        delay.assert_called_with(['collections', f'collection-{self.collection.id}'])
+
+
+# The transactions really commit here, the order_created receivers run in-process instead of
+#through the Celery broker
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    STORE_EVENTS_EAGER=True)
+class InventoryReservationTestCase(TransactionTestCase):
+    """
+    Many customers check out the same products at the same time. Every checkout either gets
+    all of its items or fails, and the inventory never goes below zero.
+    """
+    checkouts = 20
+    inventory = 7
+
+    def setUp(self):
+        cache.clear()
+        collection = Collection.objects.create(title='Collection')
+        self.products = [
+            Product.objects.create(
+                title=f'Product {i}', slug=f'product-{i}', unit_price=10,
+                inventory=self.inventory, collection=collection)
+            for i in range(3)
+        ]
+        self.users = [
+            get_user_model().objects.create_user(
+                username=f'user{i}', email=f'user{i}@domain.com', password='secret')
+            for i in range(self.checkouts)
+        ]
+
+    def create_cart(self, index):
+        cart = Cart.objects.create()
+        # Products added in a different order per cart to exercise the lock ordering
+        products = self.products if index % 2 else list(reversed(self.products))
+        for product in products:
+            CartItem.objects.create(cart=cart, product=product, quantity=1)
+        return cart
+
+    # Relies on the row locks of the reservation, SQLite locks the whole database instead
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_concurrent_checkouts_do_not_oversell(self):
+        carts = [self.create_cart(i) for i in range(self.checkouts)]
+        statuses = []
+        barrier = threading.Barrier(self.checkouts)
+
+        def checkout(user, cart):
+            client = APIClient()
+            client.force_authenticate(user)
+            try:
+                barrier.wait()
+                response = client.post('/store/orders/', {'cart_id': str(cart.id)})
+                statuses.append(response.status_code)
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=checkout, args=(user, cart))
+            for user, cart in zip(self.users, carts)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(statuses.count(200), self.inventory)
+        self.assertEqual(statuses.count(409), self.checkouts - self.inventory)
+        for product in self.products:
+            product.refresh_from_db()
+            self.assertEqual(product.inventory, 0)
+        self.assertEqual(Order.objects.count(), self.inventory)
+
+    def test_shortages_are_reported_per_item(self):
+        client = APIClient()
+        client.force_authenticate(self.users[0])
+        cart = Cart.objects.create()
+        CartItem.objects.create(cart=cart, product=self.products[0], quantity=1)
+        CartItem.objects.create(cart=cart, product=self.products[1], quantity=self.inventory + 1)
+
+        response = client.post('/store/orders/', {'cart_id': str(cart.id)})
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data['items'], [{
+            'product_id': self.products[1].id,
+            'requested': self.inventory + 1,
+            'available': self.inventory,
+        }])
+        self.products[0].refresh_from_db()
+        self.assertEqual(self.products[0].inventory, self.inventory)
+        self.assertFalse(Order.objects.exists())
+
+
+class CatalogCacheTestCase(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.collection = Collection.objects.create(title='Collection')
+        self.product = Product.objects.create(
+            title='Product', slug='product', unit_price=10, inventory=100, collection=self.collection)
+
+    def test_list_is_served_from_cache_until_a_save_commits(self):
+        self.assertEqual(self.client.get('/store/collections/').data[0]['title'], 'Collection')
+
+        # update() sends no signal, so the cached response is still served
+        Collection.objects.filter(pk=self.collection.pk).update(title='Updated')
+        self.assertEqual(self.client.get('/store/collections/').data[0]['title'], 'Collection')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.collection.title = 'Renamed'
+            self.collection.save()
+        self.assertEqual(self.client.get('/store/collections/').data[0]['title'], 'Renamed')
+
+    def test_detail_is_served_from_cache_until_a_save_commits(self):
+        url = f'/store/products/{self.product.id}/'
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).data['title'], 'Product')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.title = 'Renamed'
+            self.product.save()
+        self.assertEqual(self.client.get(url).data['title'], 'Renamed')
+
+    def test_detail_urls_with_a_padded_id_are_invalidated_too(self):
+        url = f'/store/products/00{self.product.id}/'
+        self.assertEqual(self.client.get(url).data['unit_price'], 10)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.unit_price = 99
+            self.product.save()
+        self.assertEqual(self.client.get(url).data['unit_price'], 99)
+        self.assertEqual(self.client.get('/store/products/not-an-id/').status_code, 404)
+
+
+class SalesRollupTestCase(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.collection = Collection.objects.create(title='Collection')
+        self.product = Product.objects.create(
+            title='Product', slug='product', unit_price=10, inventory=100, collection=self.collection)
+        user = get_user_model().objects.create_user(
+            username='user', email='user@domain.com', password='secret')
+        self.customer = Customer.objects.get(user=user)
+
+    def place_order(self, age, items=1):
+        order = Order.objects.create(customer=self.customer)
+        Order.objects.filter(pk=order.pk).update(placed_at=timezone.now() - age)
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=self.product, quantity=1, unit_price=10)
+            for _ in range(items)
+        ])
+        return order
+
+    def age(self, order):
+        Order.objects.filter(pk=order.pk).update(placed_at=timezone.now() - timedelta(hours=1))
+
+    def checkpoint(self):
+        return RollupCheckpoint.objects.get(name='sales').last_order_item_id
+
+    def test_items_inside_the_lag_wait(self):
+        old = self.place_order(timedelta(hours=1))
+        recent = self.place_order(timedelta(seconds=10))
+
+        self.assertEqual(refresh_rollups(), 1)
+        self.assertEqual(self.checkpoint(), old.items.get().id)
+
+        self.age(recent)
+        self.assertEqual(refresh_rollups(), 1)
+        self.assertEqual(DailyProductSales.objects.get().quantity, 2)
+        self.assertEqual(DailyCustomerSales.objects.get().orders_count, 2)
+
+    def test_checkpoint_stops_at_the_first_item_inside_the_lag(self):
+        # The lower ids belong to an order still inside the lag, the later order must wait for it
+        recent = self.place_order(timedelta(seconds=10))
+        self.place_order(timedelta(hours=1))
+
+        self.assertEqual(refresh_rollups(), 0)
+        self.assertFalse(DailyProductSales.objects.exists())
+
+        self.age(recent)
+        self.assertEqual(refresh_rollups(), 2)
+        self.assertEqual(DailyProductSales.objects.get().quantity, 2)
+
+    def test_orders_are_not_split_across_batches(self):
+        self.place_order(timedelta(hours=1), items=3)
+        self.place_order(timedelta(hours=1), items=2)
+
+        self.assertEqual(refresh_rollups(batch_size=1), 5)
+        self.assertEqual(DailyCustomerSales.objects.get().orders_count, 2)
+        self.assertEqual(DailyProductSales.objects.get().quantity, 5)
+        self.assertEqual(refresh_rollups(), 0)
+
+
+class ProductsCountTestCase(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.collection = Collection.objects.create(title='Collection')
+        self.other = Collection.objects.create(title='Other')
+
+    def products_count(self, collection):
+        collection.refresh_from_db()
+        return collection.products_count
+
+    def test_counts_follow_creates_moves_and_deletes(self):
+        product = Product.objects.create(
+            title='Product', slug='product', unit_price=10, inventory=1, collection=self.collection)
+        self.assertEqual(self.products_count(self.collection), 1)
+
+        product.collection = self.other
+        product.save()
+        self.assertEqual(self.products_count(self.collection), 0)
+        self.assertEqual(self.products_count(self.other), 1)
+
+        product.delete()
+        self.assertEqual(self.products_count(self.other), 0)
+
+    def test_deleting_uncounted_products_does_not_go_below_zero(self):
+        Product.objects.bulk_create([
+            Product(title=f'Product {i}', slug=f'product-{i}', unit_price=10, effective_price=10,
+                    inventory=1, collection=self.collection)
+            for i in range(3)
+        ])
+        Product.objects.all().delete()
+        self.assertEqual(self.products_count(self.collection), 0)
+
+
+class ProductImportTestCase(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.collection = Collection.objects.create(title='Collection')
+
+    def import_products(self, lines, content_type, batch_size=10):
+        return bulk.import_products(BytesIO(b'\n'.join(lines) + b'\n'), content_type, batch_size)
+
+    def test_bad_csv_rows_are_reported_and_skipped(self):
+        id = str(self.collection.id).encode()
+        result = self.import_products([
+            b'title,slug,unit_price,inventory,collection_id',
+            b'Apple,apple,1.50,10,' + id,
+            b'Bad price,bad-price,abc,10,' + id,
+            b'Bad \xff encoding,bad-encoding,1,10,' + id,
+            b'Null\0byte,null,1,10,' + id,
+            b'Pear,pear,2.00,5,' + id,
+        ], 'text/csv', batch_size=2)
+
+        self.assertEqual(result['created'], 2)
+        self.assertEqual([error['row'] for error in result['errors']], [2, 3, 4])
+        self.assertIn('unit_price', result['errors'][0]['errors'])
+        self.assertEqual(
+            sorted(Product.objects.values_list('slug', flat=True)), ['apple', 'pear'])
+
+    def test_bad_ndjson_lines_are_reported_and_skipped(self):
+        def row(slug):
+            return json.dumps({'title': slug, 'slug': slug, 'unit_price': '1.00',
+                               'inventory': 1, 'collection_id': self.collection.id}).encode()
+        result = self.import_products(
+            [row('first'), b'{"title": "truncated', row('second'), b'', row('third')],
+            'application/x-ndjson', batch_size=2)
+
+        self.assertEqual(result['created'], 3)
+        self.assertEqual([error['row'] for error in result['errors']], [2])
+        self.assertEqual(self.collection.products.count(), 3)
+
+    def test_repeated_new_ids_are_reported_instead_of_failing_the_batch(self):
+        def row(id, slug):
+            return json.dumps({'id': id, 'title': slug, 'slug': slug, 'unit_price': '1.00',
+                               'inventory': 1, 'collection_id': self.collection.id}).encode()
+        result = self.import_products(
+            [row(500, 'first'), row(500, 'again'), row(501, 'other')], 'application/x-ndjson')
+
+        self.assertEqual(result['created'], 2)
+        self.assertEqual(result['errors'], [
+            {'row': 2, 'errors': {'id': ['The id 500 was already given on row 1.']}}])
+        self.assertEqual(Product.objects.get(pk=500).slug, 'first')
+
+    def test_products_count_follows_created_and_moved_products(self):
+        other = Collection.objects.create(title='Other')
+        product = Product.objects.create(
+            title='Moved', slug='moved', unit_price=1, inventory=1, collection=self.collection)
+        rows = [json.dumps({'title': f'New {i}', 'slug': f'new-{i}', 'unit_price': '1.00',
+                            'inventory': 1, 'collection_id': self.collection.id}).encode()
+                for i in range(3)]
+        rows.append(json.dumps({'id': product.id, 'title': 'Moved', 'slug': 'moved', 'unit_price': '1.00',
+                                'inventory': 1, 'collection_id': other.id}).encode())
+        result = self.import_products(rows, 'application/x-ndjson', batch_size=2)
+
+        self.assertEqual((result['created'], result['updated']), (3, 1))
+        self.collection.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual((self.collection.products_count, other.products_count), (3, 1))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+class PriceWithTaxTestCase(StoreTestCase):
+    def test_price_with_tax_uses_the_promoted_price(self):
+        collection = Collection.objects.create(title='Collection')
+        product = Product.objects.create(
+            title='Product', slug='product', unit_price=20, inventory=1, collection=collection)
+        product.promotions.add(Promotion.objects.create(description='Half off', discount=0.5))
+
+        # Default rate, 10%
+        self.assertEqual(self.client.get(f'/store/products/{product.id}/').data['price_with_tax'], Decimal('11.00'))
+        self.assertEqual(self.client.get('/store/products/').data['results'][0]['price_with_tax'], Decimal('11.00'))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+class ChunkedUploadTestCase(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        self.upload_dir = os.path.join(media_root, 'uploads')
+        settings = override_settings(MEDIA_ROOT=media_root, STORE_IMAGE_UPLOAD_DIR=self.upload_dir)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        collection = Collection.objects.create(title='Collection')
+        self.product = Product.objects.create(
+            title='Product', slug='product', unit_price=10, inventory=1, collection=collection)
+        self.url = f'/store/products/{self.product.id}/images/uploads/'
+        file = BytesIO()
+        Image.new('RGB', (64, 48), 'red').save(file, 'PNG')
+        self.image = file.getvalue()
+
+    def start(self):
+        response = self.client.post(self.url, {'filename': 'red.png', 'size': len(self.image)})
+        self.assertEqual(response.status_code, 201, response.data)
+        return response.data['id']
+
+    def send(self, upload_id, offset, data):
+        return self.client.generic(
+            'PATCH', f'{self.url}{upload_id}/', data,
+            content_type='application/octet-stream', HTTP_UPLOAD_OFFSET=str(offset))
+
+    def test_chunks_are_appended_and_the_upload_completed(self):
+        upload_id = self.start()
+        half = len(self.image) // 2
+        self.assertEqual(self.send(upload_id, 0, self.image[:half]).data['offset'], half)
+        self.assertEqual(self.client.get(f'{self.url}{upload_id}/').data['offset'], half)
+        self.assertEqual(self.send(upload_id, half, self.image[half:]).data['offset'], len(self.image))
+
+        with mock.patch('store.uploads.generate_image_variants'):
+            response = self.client.post(f'{self.url}{upload_id}/complete/')
+        self.assertEqual(response.status_code, 201, response.data)
+        product_image = ProductImage.objects.get(product=self.product)
+        with product_image.image.open('rb') as file:
+            self.assertEqual(file.read(), self.image)
+        self.assertFalse(ProductImageUpload.objects.exists())
+        self.assertEqual(os.listdir(self.upload_dir), [])
+
+    def test_a_chunk_at_the_wrong_offset_is_rejected(self):
+        upload_id = self.start()
+        self.send(upload_id, 0, self.image[:10])
+
+        response = self.send(upload_id, 5, self.image[5:20])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(ProductImageUpload.objects.get().received, 10)
+
+        # Resuming from the offset the server returned
+        self.assertEqual(self.send(upload_id, 10, self.image[10:]).status_code, 200)
+
+    def test_the_row_is_only_locked_after_the_chunk_was_received(self):
+        upload_id = self.start()
+        calls = []
+        select_for_update = QuerySet.select_for_update
+
+        def locking(queryset, *args, **kwargs):
+            calls.append('lock')
+            return select_for_update(queryset, *args, **kwargs)
+
+        class Stream(BytesIO):
+            def read(stream, size=-1):
+                calls.append('read')
+                return super().read(size)
+
+        with mock.patch.object(QuerySet, 'select_for_update', locking):
+            upload = append_chunk(upload_id, 0, Stream(self.image[:10]), 10)
+        self.assertEqual(upload.received, 10)
+        self.assertEqual(calls[-1], 'lock')
+        self.assertNotIn('lock', calls[:-1])
+        self.assertEqual(os.listdir(self.upload_dir), [f'{upload_id}.part'])
+
+    def test_a_chunk_sent_twice_at_once_is_only_appended_once(self):
+        upload_id = self.start()
+
+        class Stream(BytesIO):
+            def read(stream, size=-1):
+                # The other request gets the lock first, while we're still receiving
+                ProductImageUpload.objects.filter(pk=upload_id).update(received=10)
+                return super().read(size)
+
+        with self.assertRaises(UploadError) as context:
+            append_chunk(upload_id, 0, Stream(self.image[:10]), 10)
+        self.assertEqual(context.exception.status, 409)
+        self.assertEqual(os.listdir(self.upload_dir), [f'{upload_id}.part'])
+
+    def test_an_incomplete_upload_cannot_be_completed(self):
+        upload_id = self.start()
+        self.send(upload_id, 0, self.image[:10])
+        self.assertEqual(self.client.post(f'{self.url}{upload_id}/complete/').status_code, 400)
+        self.assertFalse(ProductImage.objects.exists())
+
+    def test_reaper_deletes_expired_uploads_and_orphan_files(self):
+        expired = ProductImageUpload.objects.get(pk=self.start())
+        fresh = ProductImageUpload.objects.get(pk=self.start())
+        ProductImageUpload.objects.filter(pk=expired.pk).update(
+            created_at=timezone.now() - timedelta(days=2))
+        # A part file whose upload row is gone, old enough to be reaped
+        orphan = ProductImageUpload(product=self.product)
+        open(get_part_path(orphan), 'wb').close()
+        old = (timezone.now() - timedelta(days=2)).timestamp()
+        os.utime(get_part_path(orphan), (old, old))
+
+        # The chunk of a request that died before moving it to the .part file
+        chunk = os.path.join(self.upload_dir, f'{fresh.id}.0123.chunk')
+        open(chunk, 'wb').close()
+        os.utime(chunk, (old, old))
+
+        self.assertEqual(reap_expired_uploads(timedelta(days=1)), {'uploads': 1, 'files': 3})
+        self.assertFalse(os.path.exists(chunk))
+        self.assertEqual(list(ProductImageUpload.objects.values_list('id', flat=True)), [fresh.id])
+        self.assertFalse(os.path.exists(get_part_path(expired)))
+        self.assertFalse(os.path.exists(get_part_path(orphan)))
+        self.assertTrue(os.path.exists(get_part_path(fresh)))
+        self.assertEqual(self.client.get(f'{self.url}{expired.id}/').status_code, 404)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+class ProductBulkUpdateTestCase(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        collection = Collection.objects.create(title='Collection')
+        self.products = [
+            Product.objects.create(title=f'Product {i}', slug=f'product-{i}', unit_price=10,
+                                   inventory=5, collection=collection)
+            for i in range(3)
+        ]
+        self.client.force_authenticate(get_user_model().objects.create_user(
+            username='admin', email='admin@domain.com', password='secret', is_staff=True))
+
+    def bulk_update(self, rows, query=''):
+        return self.client.patch(f'/store/products/bulk/{query}', rows, format='json')
+
+    def test_only_the_given_fields_are_updated(self):
+        first, second, third = self.products
+        response = self.bulk_update([
+            {'id': first.id, 'unit_price': '7.50'},
+            {'id': second.id, 'inventory': 0},
+        ], '?batch_size=1')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.data, {'updated': 2})
+
+        for product in self.products:
+            product.refresh_from_db()
+        self.assertEqual((first.unit_price, first.effective_price, first.inventory),
+                         (Decimal('7.50'), Decimal('7.50'), 5))
+        self.assertEqual((second.unit_price, second.inventory), (Decimal('10'), 0))
+        self.assertEqual((third.unit_price, third.inventory), (Decimal('10'), 5))
+
+    def test_missing_ids_fail_the_whole_update(self):
+        response = self.bulk_update([
+            {'id': self.products[0].id, 'unit_price': '1.00'},
+            {'id': 999, 'unit_price': '1.00'},
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['ids'], [999])
+        self.assertFalse(Product.objects.filter(unit_price=1).exists())
+
+    def test_batch_size_must_be_positive(self):
+        for batch_size in ['0', '-1', 'abc']:
+            response = self.bulk_update(
+                [{'id': self.products[0].id, 'unit_price': '1.00'}], f'?batch_size={batch_size}')
+            self.assertEqual(response.status_code, 400)
+        self.assertFalse(Product.objects.filter(unit_price=1).exists())
+
+
+class CartReaperTestCase(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        collection = Collection.objects.create(title='Collection')
+        self.product = Product.objects.create(
+            title='Product', slug='product', unit_price=10, inventory=1, collection=collection)
+
+    def create_cart(self, age, items=0):
+        cart = Cart.objects.create()
+        Cart.objects.filter(pk=cart.pk).update(created_at=timezone.now() - age)
+        if items:
+            CartItem.objects.create(cart=cart, product=self.product, quantity=items)
+        return cart
+
+    def test_only_carts_older_than_the_ttl_are_deleted(self):
+        self.create_cart(timedelta(days=31), items=2)
+        self.create_cart(timedelta(days=40))
+        kept = self.create_cart(timedelta(days=29), items=1)
+
+        stats = reap_abandoned_carts(ttl=timedelta(days=30), batch_size=1)
+        self.assertEqual((stats['carts'], stats['items'], stats['batches']), (2, 1, 2))
+        self.assertEqual(list(Cart.objects.values_list('id', flat=True)), [kept.id])
+        self.assertEqual(CartItem.objects.get().cart_id, kept.id)
+
+    def test_dry_run_only_counts(self):
+        self.create_cart(timedelta(days=31), items=2)
+        self.create_cart(timedelta(days=1))
+
+        out = StringIO()
+        call_command('reap_carts', '--dry-run', '--ttl-days=30', stdout=out)
+        self.assertIn('Would delete 1 carts and 1 items in 1 batches', out.getvalue())
+        self.assertEqual(Cart.objects.count(), 2)
+        self.assertEqual(CartItem.objects.count(), 1)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+class FullTextSearchTestCase(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        collection = Collection.objects.create(title='Collection')
+        for title in ['Green apple', 'Red apple', 'Pear']:
+            Product.objects.create(title=title, slug=title.lower().replace(' ', '-'), unit_price=10,
+                                   inventory=1, collection=collection)
+
+    def test_terms_become_required_prefixes(self):
+        search = FullTextSearchFilter()
+        self.assertEqual(search.get_boolean_query(['red', 'apple']), '+red* +apple*')
+        # The boolean mode operators are stripped, not passed through
+        self.assertEqual(search.get_boolean_query(['-red', '"apple*"', '(pear)']), '+red* +apple* +pear*')
+        self.assertIsNone(search.get_boolean_query(['+-*']))
+
+    def test_short_terms_fall_back_to_like(self):
+        self.assertIsNone(FullTextSearchFilter().get_boolean_query(['red', 'ap']))
+        titles = [product['title'] for product in self.client.get('/store/products/?search=red ap').data['results']]
+        self.assertEqual(titles, ['Red apple'])
+
+    def test_mysql_uses_match_against(self):
+        request = Request(APIRequestFactory().get('/store/products/', {'search': 'apple'}))
+        view = mock.Mock(search_fields=['title', 'description'])
+        with mock.patch('store.filters.connection', vendor='mysql'):
+            queryset = FullTextSearchFilter().filter_queryset(request, Product.objects.all(), view)
+        sql, params = queryset.query.sql_with_params()
+        self.assertIn('MATCH (', sql)
+        self.assertIn('IN BOOLEAN MODE', sql)
+        self.assertIn('+apple*', params)
+        self.assertEqual(queryset.query.order_by[0], '-relevance')
+
+        with mock.patch('store.filters.connection', vendor='mysql'):
+            request = Request(APIRequestFactory().get('/store/products/', {'search': 'ap'}))
+            queryset = FullTextSearchFilter().filter_queryset(request, Product.objects.all(), view)
+        self.assertNotIn('MATCH (', str(queryset.query))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+class CartItemUpsertTestCase(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        collection = Collection.objects.create(title='Collection')
+        self.products = [
+            Product.objects.create(title=f'Product {i}', slug=f'product-{i}', unit_price=10,
+                                   inventory=10, collection=collection)
+            for i in range(2)
+        ]
+        self.cart = Cart.objects.create()
+        self.url = f'/store/carts/{self.cart.id}/items/'
+
+    def quantities(self):
+        return dict(CartItem.objects.filter(cart=self.cart).values_list('product_id', 'quantity'))
+
+    def test_adding_a_product_again_increments_its_quantity(self):
+        product = self.products[0]
+        first = self.client.post(self.url, {'product_id': product.id, 'quantity': 2})
+        second = self.client.post(self.url, {'product_id': product.id, 'quantity': 3})
+        self.assertEqual(first.status_code, 201, first.data)
+        self.assertEqual(second.status_code, 201, second.data)
+        self.assertEqual(first.data['id'], second.data['id'])
+        self.assertEqual(second.data['quantity'], 5)
+        self.assertEqual(self.quantities(), {product.id: 5})
+
+    def test_adding_a_missing_product_is_rejected(self):
+        response = self.client.post(self.url, {'product_id': 999, 'quantity': 1})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('product_id', response.data)
+
+    def test_bulk_add_merges_repeated_products(self):
+        first, second = self.products
+        self.client.post(self.url, {'product_id': first.id, 'quantity': 1})
+        response = self.client.post(f'{self.url}bulk/', {'items': [
+            {'product_id': first.id, 'quantity': 2},
+            {'product_id': second.id, 'quantity': 1},
+            {'product_id': second.id, 'quantity': 4},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(
+            [(item['product_id'], item['quantity']) for item in response.data['items']],
+            [(first.id, 3), (second.id, 5)])
+        self.assertEqual(self.quantities(), {first.id: 3, second.id: 5})
+
+    def test_bulk_add_with_a_missing_product_adds_nothing(self):
+        response = self.client.post(f'{self.url}bulk/', {'items': [
+            {'product_id': self.products[0].id, 'quantity': 1},
+            {'product_id': 999, 'quantity': 1},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.quantities(), {})
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+class CartTotalTestCase(StoreTestCase):
+    def test_database_totals_match_the_python_totals(self):
+        collection = Collection.objects.create(title='Collection')
+        prices = ['19.99', '0.35', '7.10']
+        products = [
+            Product.objects.create(title=f'Product {i}', slug=f'product-{i}', unit_price=Decimal(price),
+                                   inventory=10, collection=collection)
+            for i, price in enumerate(prices)
+        ]
+        products[0].promotions.add(Promotion.objects.create(description='Third off', discount=0.33))
+        cart = Cart.objects.create()
+        for quantity, product in enumerate(products, start=3):
+            CartItem.objects.create(cart=cart, product=product, quantity=quantity)
+
+        response = self.client.get(f'/store/carts/{cart.id}/')
+        self.assertEqual(response.status_code, 200, response.data)
+        expected = {
+            item.id: item.quantity * item.product.effective_price
+            for item in CartItem.objects.select_related('product').filter(cart=cart)
+        }
+        self.assertNotEqual(Product.objects.get(pk=products[0].pk).effective_price, Decimal('19.99'))
+        self.assertEqual({item['id']: item['total_price'] for item in response.data['items']}, expected)
+        self.assertEqual(response.data['total_price'], sum(expected.values()))
+
+        self.assertEqual(self.client.get(f'/store/carts/{Cart.objects.create().id}/').data['total_price'], 0)
+
+
+class IterStatementsTestCase(SimpleTestCase):
+    def iter_statements(self, sql, chunk_size):
+        with tempfile.NamedTemporaryFile('w', suffix='.sql', delete=False) as file:
+            file.write(sql)
+        self.addCleanup(os.remove, file.name)
+        return list(iter_statements(file.name, chunk_size))
+
+    def test_semicolons_in_strings_and_comments_do_not_split(self):
+        sql = (
+            "-- header; with a semicolon\n"
+            "insert into t values ('a;b', \"c;d\", 'it''s; ok', 'x\\';y');\n"
+            "/* block; comment */ update t set a = 2 - 1; # trailing; comment\n"
+            "/*!40101 SET NAMES utf8 */;\n"
+            "select 1/2;\n"
+            "-- only a comment after the last statement;\n"
+        )
+        expected = [
+            "-- header; with a semicolon\n"
+            "insert into t values ('a;b', \"c;d\", 'it''s; ok', 'x\\';y')",
+            "/* block; comment */ update t set a = 2 - 1",
+            "# trailing; comment\n/*!40101 SET NAMES utf8 */",
+            "select 1/2",
+        ]
+        # Small chunks put the quotes and comment markers across chunk boundaries
+        for chunk_size in [1, 2, 3, 7, 64 * 1024]:
+            self.assertEqual(self.iter_statements(sql, chunk_size), expected, chunk_size)
+
+
+class ImageVariantsTestCase(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings = override_settings(MEDIA_ROOT=media_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        collection = Collection.objects.create(title='Collection')
+        self.product = Product.objects.create(
+            title='Product', slug='product', unit_price=10, inventory=1, collection=collection)
+
+    def create_image(self, width, height):
+        file = BytesIO()
+        Image.new('RGBA', (width, height), (255, 0, 0, 128)).save(file, 'PNG')
+        product_image = ProductImage(product=self.product)
+        product_image.image.save('photo.png', ContentFile(file.getvalue()))
+        return product_image
+
+    def test_variants_narrower_than_the_original_are_rendered_in_every_format(self):
+        variants = generate_variants(self.create_image(700, 350))
+
+        self.assertEqual(set(variants), {'webp', 'jpeg'})
+        for name, image_format in [('webp', 'WEBP'), ('jpeg', 'JPEG')]:
+            self.assertEqual(list(variants[name]), ['160', '320', '640'])
+            for width, path in variants[name].items():
+                self.assertTrue(path.endswith(f'.{name}'))
+                with default_storage.open(path) as file, Image.open(file) as image:
+                    self.assertEqual(image.format, image_format)
+                    self.assertEqual(image.size, (int(width), int(width) // 2))
+
+    def test_small_images_get_a_single_variant_at_their_own_width(self):
+        variants = generate_variants(self.create_image(100, 80))
+        self.assertEqual({name: list(widths) for name, widths in variants.items()},
+                         {'webp': ['100'], 'jpeg': ['100']})
+        self.assertLess(100, VARIANT_WIDTHS[0])
+
+    def test_names_are_content_hashed(self):
+        product_image = self.create_image(400, 300)
+        self.assertEqual(generate_variants(product_image), generate_variants(product_image))
+
+    def test_generating_the_variants_invalidates_the_product(self):
+        product_image = self.create_image(400, 300)
+        url = f'/store/products/{self.product.id}/'
+        self.assertEqual(self.client.get(url).data['images'][0]['srcset'], {})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            process_product_image(product_image.id)
+        srcset = self.client.get(url).data['images'][0]['srcset']
+        self.assertEqual(srcset['webp'].count('w, '), 1)
+        self.assertIn('320w', srcset['jpeg'])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+class CustomerStatsTestCase(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = get_user_model().objects.create_user(
+            username='user', email='user@domain.com', password='secret')
+        self.customer = Customer.objects.get(user=self.user)
+        collection = Collection.objects.create(title='Collection')
+        self.products = [
+            Product.objects.create(title=f'Product {i}', slug=f'product-{i}', unit_price=price,
+                                   inventory=100, collection=collection)
+            for i, price in enumerate([Decimal('10.00'), Decimal('2.50')])
+        ]
+
+    def place_order(self, quantities):
+        cart = Cart.objects.create()
+        for product, quantity in zip(self.products, quantities):
+            if quantity:
+                CartItem.objects.create(cart=cart, product=product, quantity=quantity)
+        self.client.force_authenticate(self.user)
+        response = self.client.post('/store/orders/', {'cart_id': str(cart.id)})
+        self.assertEqual(response.status_code, 200, response.data)
+        return Order.objects.get(pk=response.data['id'])
+
+    def test_placing_orders_updates_the_stats(self):
+        self.place_order([1, 2])
+        last = self.place_order([3, 0])
+
+        stats = CustomerStats.objects.get(customer=self.customer)
+        self.assertEqual((stats.orders_count, stats.items_count), (2, 6))
+        self.assertEqual(stats.lifetime_spend, Decimal('45.00'))
+        self.assertEqual(stats.last_order_at, last.placed_at)
+        self.assertEqual(stats.average_basket_size, 3)
+        self.assertEqual(reconcile_customer_stats(dry_run=True), [])
+
+    def test_reconcile_fixes_drifted_and_missing_stats(self):
+        self.place_order([1, 1])
+        other = Customer.objects.get(user=get_user_model().objects.create_user(
+            username='other', email='other@domain.com', password='secret'))
+        CustomerStats.objects.filter(customer=self.customer).update(orders_count=5, lifetime_spend=0)
+        CustomerStats.objects.filter(customer=other).delete()
+
+        self.assertEqual(reconcile_customer_stats(dry_run=True), sorted([self.customer.id, other.id]))
+        self.assertEqual(CustomerStats.objects.get(customer=self.customer).orders_count, 5)
+
+        self.assertEqual(reconcile_customer_stats(), sorted([self.customer.id, other.id]))
+        stats = CustomerStats.objects.get(customer=self.customer)
+        self.assertEqual((stats.orders_count, stats.items_count, stats.lifetime_spend), (1, 2, Decimal('12.50')))
+        self.assertEqual(CustomerStats.objects.get(customer=other).orders_count, 0)
+        self.assertEqual(reconcile_customer_stats(), [])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+class KeysetPaginationTestCase(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.collection = Collection.objects.create(title='Collection')
+        other = Collection.objects.create(title='Other')
+        # Few distinct values, so most pages start or end in the middle of a run of equal keys
+        for i in range(23):
+            Product.objects.create(
+                title=f'Product {i % 4}', slug=f'product-{i}', unit_price=10 + i % 3, inventory=1,
+                collection=self.collection if i % 5 else other)
+        now = timezone.now()
+        for i, product in enumerate(Product.objects.order_by('id')):
+            Product.objects.filter(pk=product.pk).update(last_update=now - timedelta(days=i % 2))
+
+    def walk(self, url, link):
+        ids = []
+        pages = 0
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, response.data)
+            ids += [product['id'] for product in response.data['results']]
+            url = response.data[link]
+            pages += 1
+        return ids, pages
+
+    def test_every_product_is_listed_once_in_every_ordering(self):
+        for ordering, order_by in [
+            (None, ['title', 'id']),
+            ('-unit_price', ['-unit_price', 'id']),
+            ('last_update', ['last_update', 'id']),
+        ]:
+            url = '/store/products/?pagination=keyset'
+            if ordering:
+                url += f'&ordering={ordering}'
+            expected = list(Product.objects.order_by(*order_by).values_list('id', flat=True))
+
+            ids, pages = self.walk(url, 'next')
+            self.assertEqual(ids, expected, ordering)
+            self.assertEqual(pages, 3)
+
+    def test_previous_links_walk_back_to_the_first_page(self):
+        url = '/store/products/?pagination=keyset&ordering=-unit_price'
+        first = self.client.get(url).data
+        self.assertIsNone(first['previous'])
+        last = self.client.get(self.client.get(first['next']).data['next']).data
+        self.assertIsNone(last['next'])
+
+        pages = []
+        url = last['previous']
+        while url:
+            page = self.client.get(url).data
+            pages.insert(0, [product['id'] for product in page['results']])
+            url = page['previous']
+        self.assertEqual(pages[0], [product['id'] for product in first['results']])
+        self.assertEqual(
+            sum(pages, []) + [product['id'] for product in last['results']],
+            list(Product.objects.order_by('-unit_price', 'id').values_list('id', flat=True)))
+
+    def test_invalid_cursors_are_not_found(self):
+        two_values = b64encode(b'{"v":["Product 1","1"],"r":0}').decode()
+        for cursor in ['garbage', 'bm90IGpzb24=', two_values]:
+            response = self.client.get(
+                '/store/products/', {'pagination': 'keyset', 'ordering': '-unit_price', 'cursor': cursor})
+            self.assertEqual(response.status_code, 404, cursor)
+
+    def test_count_is_only_returned_when_asked_for(self):
+        self.assertNotIn('count', self.client.get('/store/products/?pagination=keyset').data)
+        self.assertEqual(
+            self.client.get('/store/products/?pagination=keyset&include_count=1').data['count'], 23)
+        response = self.client.get(
+            f'/store/products/?pagination=keyset&include_count=1&collection_id={self.collection.id}')
+        self.assertEqual(response.data['count'], Product.objects.filter(collection=self.collection).count())
@@ -0,0 +1,196 @@
+import os
+import shutil
+from datetime import datetime
+from uuid import UUID, uuid4
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.db import transaction
+from django.utils import timezone
+from PIL import Image, UnidentifiedImageError
+from .models import ProductImage, ProductImageUpload
+from .tasks import generate_image_variants
+from .validators import MAX_IMAGE_SIZE_KB, validate_image_header
+
+# How much we read from the request stream at a time, the only part of the upload held in memory
+READ_SIZE = 64 * 1024
+# If Pillow still can't find an image header after this many bytes it isn't an image
+MAX_HEADER_SIZE = 1024 * 1024
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class UploadedPart(File):
+    # FileSystemStorage moves files that have a temporary_file_path() instead of copying them,
+    #so completing an upload is a rename
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def get_part_path(upload: ProductImageUpload):
+    return os.path.join(settings.STORE_IMAGE_UPLOAD_DIR, f'{upload.id}.part')
+
+
+def start_upload(product_id, filename, size):
+    if size <= 0:
+        raise UploadError('The upload size must be positive.')
+    if size > MAX_IMAGE_SIZE_KB * 1024:
+        raise UploadError(f'Files cannot be larger than {MAX_IMAGE_SIZE_KB}KB!')
+    upload = ProductImageUpload.objects.create(
+        product_id=product_id, filename=os.path.basename(filename), size=size)
+    os.makedirs(settings.STORE_IMAGE_UPLOAD_DIR, exist_ok=True)
+    open(get_part_path(upload), 'wb').close()
+    return upload
+
+
+def inspect_header(upload: ProductImageUpload, path):
+    # Image.open only parses the header, the pixels are not decoded
+    try:
+        with Image.open(path) as image:
+            validate_image_header(image)
+            upload.width, upload.height = image.size
+    except (UnidentifiedImageError, OSError, SyntaxError):
+        if upload.received >= min(upload.size, MAX_HEADER_SIZE):
+            raise UploadError('The file is not a valid image.')
+    except ValidationError as e:
+        raise UploadError(e.messages[0])
+
+
+def check_offset(upload: ProductImageUpload, offset, length):
+    if offset != upload.received:
+        raise UploadError(f'Expected offset {upload.received}.', status=409)
+    if offset + length > upload.size:
+        raise UploadError('The chunk goes past the declared upload size.')
+
+
+def append_chunk(upload_id, offset, stream, length):
+    """
+    Writes `length` bytes from the request stream at `offset`, READ_SIZE at a time. The offset
+    must be what we already received, so a client that lost a chunk asks for the offset and
+    resumes from there. Returns the updated upload.
+
+    The bytes go to a .chunk file of their own first, the upload row is only locked to move them
+    to the .part file: a slow client doesn't hold a connection and a row lock during the transfer.
+    """
+    # Failing before reading the body when we already know the offset is wrong
+    check_offset(ProductImageUpload.objects.get(pk=upload_id), offset, length)
+
+    chunk_path = os.path.join(settings.STORE_IMAGE_UPLOAD_DIR, f'{upload_id}.{uuid4().hex}.chunk')
+    try:
+        received = 0
+        try:
+            with open(chunk_path, 'wb') as chunk:
+                while received < length:
+                    data = stream.read(min(READ_SIZE, length - received))
+                    if not data:
+                        break
+                    chunk.write(data)
+                    received += len(data)
+        except FileNotFoundError:
+            raise UploadError('The upload has expired.', status=410)
+
+        with transaction.atomic():
+            try:
+                upload = ProductImageUpload.objects.select_for_update().get(pk=upload_id)
+            except ProductImageUpload.DoesNotExist:
+                raise UploadError('The upload has expired.', status=410)
+            # Another request may have sent the same chunk in the meantime
+            check_offset(upload, offset, length)
+
+            path = get_part_path(upload)
+            try:
+                with open(path, 'r+b') as file, open(chunk_path, 'rb') as chunk:
+                    # Dropping any bytes written by a request that failed before updating `received`
+                    file.truncate(offset)
+                    file.seek(offset)
+                    shutil.copyfileobj(chunk, file, READ_SIZE)
+            except FileNotFoundError:
+                raise UploadError('The upload has expired.', status=410)
+
+            upload.received += received
+            if upload.width is None:
+                inspect_header(upload, path)
+            upload.save(update_fields=['received', 'width', 'height'])
+            return upload
+    finally:
+        if os.path.exists(chunk_path):
+            os.remove(chunk_path)
+
+
+def complete_upload(upload_id):
+    with transaction.atomic():
+        upload = ProductImageUpload.objects.select_for_update().get(pk=upload_id)
+        if upload.received != upload.size:
+            raise UploadError(f'Only {upload.received} of {upload.size} bytes were received.')
+
+        path = get_part_path(upload)
+        try:
+            # verify() walks the whole file without decoding it into memory
+            with Image.open(path) as image:
+                image.verify()
+        except Exception:
+            raise UploadError('The file is not a valid image.')
+
+        product_image = ProductImage(product_id=upload.product_id)
+        with open(path, 'rb') as file:
+            product_image.image.save(upload.filename, UploadedPart(file), save=False)
+        product_image.save()
+        upload.delete()
+        if os.path.exists(path):
+            os.remove(path)
+
+        transaction.on_commit(lambda: generate_image_variants.delay(product_image.id))
+        return product_image
+
+
+def reap_expired_uploads(ttl=None):
+    """
+    Deletes the uploads started more than `ttl` ago (settings.STORE_IMAGE_UPLOAD_TTL by default)
+    and their .part files, plus the .part files left without an upload (the product was deleted,
+    or the process died between the two) and the .chunk files of requests that died. Returns the
+    number of uploads and files deleted.
+    """
+    ttl = ttl or settings.STORE_IMAGE_UPLOAD_TTL
+    cutoff = timezone.now() - ttl
+    with transaction.atomic():
+        # Waiting for a chunk that is being written rather than removing the file under it
+        upload_ids = list(ProductImageUpload.objects.select_for_update()
+                          .filter(created_at__lt=cutoff).values_list('id', flat=True))
+        ProductImageUpload.objects.filter(id__in=upload_ids).delete()
+
+    files = 0
+    try:
+        names = os.listdir(settings.STORE_IMAGE_UPLOAD_DIR)
+    except FileNotFoundError:
+        names = []
+    expired = {f'{upload_id}.part' for upload_id in upload_ids}
+    for name in names:
+        if not name.endswith(('.part', '.chunk')):
+            continue
+        path = os.path.join(settings.STORE_IMAGE_UPLOAD_DIR, name)
+        if name not in expired:
+            # The mtime check keeps us away from uploads started after the query above
+            try:
+                modified = datetime.fromtimestamp(os.path.getmtime(path), tz=timezone.utc)
+            except FileNotFoundError:
+                continue
+            if modified >= cutoff:
+                continue
+            # An old .chunk file is left by a request that died while receiving it
+            if name.endswith('.part'):
+                try:
+                    upload_id = UUID(name[:-len('.part')])
+                except ValueError:
+                    continue
+                if ProductImageUpload.objects.filter(pk=upload_id).exists():
+                    continue
+        try:
+            os.remove(path)
+            files += 1
+        except FileNotFoundError:
+            pass
+    return {'uploads': len(upload_ids), 'files': files}
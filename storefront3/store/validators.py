@@ -1,8 +1,21 @@
 from django.core.exceptions import ValidationError
 
+# Real product photos, uploads are streamed to disk (see store.uploads) so this doesn't cost memory
+MAX_IMAGE_SIZE_KB = 10 * 1024
+# Decompression bomb guard, checked from the image header before the whole file is received
+MAX_IMAGE_PIXELS = 40_000_000
+ALLOWED_IMAGE_FORMATS = ['JPEG', 'PNG', 'WEBP', 'GIF']
+
 # Validating the image file size
 def validate_file_size(file):
-  max_size_kb = 50
+  max_size_kb = MAX_IMAGE_SIZE_KB
 
   if file.size > max_size_kb * 1024:
     raise ValidationError(f'Files cannot be larger than {max_size_kb}KB!')
+
+
+def validate_image_header(image):
+  if image.format not in ALLOWED_IMAGE_FORMATS:
+    raise ValidationError(f'Unsupported image format, use one of {", ".join(ALLOWED_IMAGE_FORMATS)}.')
+  if image.width * image.height > MAX_IMAGE_PIXELS:
+    raise ValidationError(f'Images cannot have more than {MAX_IMAGE_PIXELS} pixels!')
@@ -1,34 +1,116 @@
 from store.permissions import FullDjangoModelPermissions, IsAdminOrReadOnly, ViewCustomerHistoryPermission
-from store.pagination import DefaultPagination
-from django.db.models.aggregates import Count
+from store.cache import CatalogCacheMixin
+from store.pagination import DefaultPagination, KeysetPagination
+from django.db.models import DecimalField, ExpressionWrapper, F, Prefetch, Sum, Value
+from django.db.models.functions import Coalesce
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.decorators import action, permission_classes
-from rest_framework.filters import SearchFilter, OrderingFilter
+from rest_framework.filters import OrderingFilter
 from rest_framework.mixins import CreateModelMixin, DestroyModelMixin, RetrieveModelMixin, UpdateModelMixin
 from rest_framework.permissions import AllowAny, DjangoModelPermissions, DjangoModelPermissionsOrAnonReadOnly, IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet, GenericViewSet
 from rest_framework import status
-from .filters import ProductFilter
-from .models import Cart, CartItem, Collection, Customer, Order, OrderItem, Product, ProductImage, Review
-from .serializers import AddCartItemSerializer, CartItemSerializer, CartSerializer, CollectionSerializer, CreateOrderSerializer, CustomerSerializer, OrderSerializer, ProductImageSerializer, ProductSerializer, ReviewSerializer, UpdateCartItemSerializer, UpdateOrderSerializer
-
-
-class ProductViewSet(ModelViewSet):
+from . import bulk, cachecontrol, reports, uploads
+from .cachecontrol import CacheControlMixin
+from .context import get_customer_id
+from .filters import FullTextSearchFilter, ProductFilter
+from .inventory import InsufficientInventory
+from .models import Cart, CartItem, Collection, Customer, CustomerStats, Order, OrderItem, Product, ProductImage, ProductImageUpload, Review
+from .serializers import AddCartItemSerializer, BulkAddCartItemSerializer, CartItemSerializer, CartSerializer, CollectionSerializer, CreateOrderSerializer, CustomerSerializer, CustomerStatsSerializer, OrderSerializer, ReportQuerySerializer, ProductImageSerializer, ProductImageUploadSerializer, ProductSerializer, ReviewSerializer, UpdateCartItemSerializer, UpdateOrderSerializer
+from .tax import get_rate_table, get_tax_region
+from .uploads import UploadError
+
+
+class ProductViewSet(CacheControlMixin, CatalogCacheMixin, ModelViewSet):
+    cache_namespace = 'products'
+    cache_object_namespace = 'product'
+    cache_control = {
+        'list': {'max_age': 60, 's_maxage': 300, 'stale_while_revalidate': 60},
+        'retrieve': {'max_age': 60, 's_maxage': 3600, 'stale_while_revalidate': 300},
+    }
     # Eager loading the images to not have multiple queries getting images
     queryset = Product.objects.prefetch_related('images').all()
     serializer_class = ProductSerializer
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
+    filter_backends = [DjangoFilterBackend, FullTextSearchFilter, OrderingFilter]
     filterset_class = ProductFilter
     pagination_class = DefaultPagination
     permission_classes = [IsAdminOrReadOnly]
     search_fields = ['title', 'description']
-    ordering_fields = ['unit_price', 'last_update']
+    ordering_fields = ['unit_price', 'effective_price', 'last_update']
+
+    # Clients opt in to keyset pagination with ?pagination=keyset, the cursor links keep the param
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            if self.request.query_params.get('pagination') == 'keyset':
+                self._paginator = KeysetPagination()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
 
     def get_serializer_context(self):
         return {'request': self.request}
 
+    # The URL kwargs are strings as typed, int() so /products/007/ is tagged like the purges,
+    #which use the model ids
+    def get_surrogate_keys(self):
+        # price_with_tax depends on the tax rates too
+        if self.action == 'retrieve':
+            return [cachecontrol.product_key(int(self.kwargs['pk'])), cachecontrol.TAX_RATES]
+        return [cachecontrol.PRODUCTS, cachecontrol.TAX_RATES]
+
+    def get_cache_key(self, request, versions):
+        # price_with_tax depends on the tax rates, so the key includes the version of the rate
+        #table this process renders with (it may be a few seconds behind Redis)
+        return super().get_cache_key(request, versions + [get_rate_table().version])
+
+    # Streams the body (CSV with a header row, or NDJSON) instead of parsing it into request.data
+    @action(detail=False, methods=['POST'], url_path='import', permission_classes=[IsAdminUser])
+    def import_products(self, request):
+        if request.stream is None:
+            return Response({'error': 'The request body is empty.'}, status=status.HTTP_400_BAD_REQUEST)
+        result = bulk.import_products(request.stream, request.content_type)
+        return Response(result, status=status.HTTP_200_OK)
+
+    # PATCH /store/products/bulk/?batch_size=500 with [{"id": 1, "unit_price": 9.99, "inventory": 3}, ...]
+    @action(detail=False, methods=['PATCH'], url_path='bulk', permission_classes=[IsAdminUser])
+    def bulk_update(self, request):
+        serializer = bulk.ProductBulkUpdateSerializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        batch_size = request.query_params.get('batch_size')
+        if batch_size is not None:
+            try:
+                batch_size = int(batch_size)
+            except ValueError:
+                batch_size = 0
+            if batch_size < 1:
+                return Response(
+                    {'error': 'batch_size must be a positive integer.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        missing = bulk.bulk_update_products(serializer.validated_data, batch_size)
+        if missing:
+            return Response(
+                {'error': 'No product with the given ID was found.', 'ids': missing},
+                status=status.HTTP_400_BAD_REQUEST)
+        return Response({'updated': len(serializer.validated_data)})
+
+    # /store/products/export/?export_format=csv|ndjson, accepts the same filters as the listing
+    @action(detail=False, url_path='export', permission_classes=[IsAdminUser])
+    def export_products(self, request):
+        queryset = self.filter_queryset(Product.objects.all())
+        if request.query_params.get('export_format') == 'ndjson':
+            response = StreamingHttpResponse(
+                bulk.export_ndjson(queryset), content_type='application/x-ndjson')
+            filename = 'products.ndjson'
+        else:
+            response = StreamingHttpResponse(bulk.export_csv(queryset), content_type='text/csv')
+            filename = 'products.csv'
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
     def destroy(self, request, *args, **kwargs):
         if OrderItem.objects.filter(product_id=kwargs['pk']).count() > 0:
             return Response({'error': 'Product cannot be deleted because it is associated with an order item.'}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
@@ -36,12 +118,23 @@ class ProductViewSet(ModelViewSet):
         return super().destroy(request, *args, **kwargs)
 
 
-class CollectionViewSet(ModelViewSet):
-    queryset = Collection.objects.annotate(
-        products_count=Count('products')).all()
+class CollectionViewSet(CacheControlMixin, CatalogCacheMixin, ModelViewSet):
+    cache_namespace = 'collections'
+    cache_object_namespace = 'collection'
+    cache_control = {
+        'list': {'max_age': 300, 's_maxage': 3600, 'stale_while_revalidate': 300},
+        'retrieve': {'max_age': 300, 's_maxage': 3600, 'stale_while_revalidate': 300},
+    }
+    # products_count is a stored counter, no need to aggregate the products
+    queryset = Collection.objects.all()
     serializer_class = CollectionSerializer
     permission_classes = [IsAdminOrReadOnly]
 
+    def get_surrogate_keys(self):
+        if self.action == 'retrieve':
+            return [cachecontrol.collection_key(int(self.kwargs['pk']))]
+        return [cachecontrol.COLLECTIONS]
+
     def destroy(self, request, *args, **kwargs):
         if Product.objects.filter(collection_id=kwargs['pk']):
             return Response({'error': 'Collection cannot be deleted because it includes one or more products.'}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
@@ -49,8 +142,15 @@ class CollectionViewSet(ModelViewSet):
         return super().destroy(request, *args, **kwargs)
 
 
-class ReviewViewSet(ModelViewSet):
+class ReviewViewSet(CacheControlMixin, ModelViewSet):
     serializer_class = ReviewSerializer
+    cache_control = {
+        'list': {'max_age': 60, 's_maxage': 600, 'stale_while_revalidate': 60},
+        'retrieve': {'max_age': 60, 's_maxage': 600, 'stale_while_revalidate': 60},
+    }
+
+    def get_surrogate_keys(self):
+        return [cachecontrol.reviews_key(int(self.kwargs['product_pk']))]
 
     def get_queryset(self):
         return Review.objects.filter(product_id=self.kwargs['product_pk'])
@@ -59,11 +159,28 @@ class ReviewViewSet(ModelViewSet):
         return {'product_id': self.kwargs['product_pk']}
 
 
+# Line and cart totals are computed by the database, the serializers only read the annotations
+line_total = ExpressionWrapper(
+    F('quantity') * F('product__effective_price'),
+    output_field=DecimalField(max_digits=12, decimal_places=2))
+
+
+def annotate_cart_items(queryset):
+    return queryset.select_related('product').annotate(total_price=line_total)
+
+
 class CartViewSet(CreateModelMixin,
                   RetrieveModelMixin,
                   DestroyModelMixin,
                   GenericViewSet):
-    queryset = Cart.objects.prefetch_related('items__product').all()
+    queryset = Cart.objects \
+        .prefetch_related(Prefetch('items', queryset=annotate_cart_items(CartItem.objects.all()))) \
+        .annotate(total_price=Coalesce(
+            Sum(ExpressionWrapper(
+                F('items__quantity') * F('items__product__effective_price'),
+                output_field=DecimalField(max_digits=12, decimal_places=2))),
+            Value(0),
+            output_field=DecimalField(max_digits=12, decimal_places=2)))
     serializer_class = CartSerializer
 
 
@@ -71,7 +188,9 @@ class CartItemViewSet(ModelViewSet):
     http_method_names = ['get', 'post', 'patch', 'delete']
 
     def get_serializer_class(self):
-        if self.request.method == 'POST':
+        if self.action == 'bulk':
+            return BulkAddCartItemSerializer
+        elif self.request.method == 'POST':
             return AddCartItemSerializer
         elif self.request.method == 'PATCH':
             return UpdateCartItemSerializer
@@ -81,9 +200,16 @@ class CartItemViewSet(ModelViewSet):
         return {'cart_id': self.kwargs['cart_pk']}
 
     def get_queryset(self):
-        return CartItem.objects \
-            .filter(cart_id=self.kwargs['cart_pk']) \
-            .select_related('product')
+        return annotate_cart_items(
+            CartItem.objects.filter(cart_id=self.kwargs['cart_pk']))
+
+    # Adds many products to the cart in one request and one upsert
+    @action(detail=False, methods=['POST'])
+    def bulk(self, request, cart_pk):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
 
 
 class CustomerViewSet(ModelViewSet):
@@ -93,7 +219,19 @@ class CustomerViewSet(ModelViewSet):
 
     @action(detail=True, permission_classes=[ViewCustomerHistoryPermission])
     def history(self, request, pk):
-        return Response('ok')
+        # Reads the precomputed stats plus the latest orders, the query count doesn't depend on
+        #how many orders the customer has
+        stats = CustomerStats.objects.filter(customer_id=pk).first()
+        if stats is None:
+            get_object_or_404(Customer, pk=pk)
+            stats = CustomerStats(customer_id=pk)
+        recent_orders = OrderViewSet.queryset \
+            .filter(customer_id=pk) \
+            .order_by('-placed_at')[:10]
+        return Response({
+            'stats': CustomerStatsSerializer(stats).data,
+            'recent_orders': OrderSerializer(recent_orders, many=True).data,
+        })
 
     @action(detail=False, methods=['GET', 'PUT'], permission_classes=[IsAuthenticated])
     def me(self, request):
@@ -111,6 +249,10 @@ class CustomerViewSet(ModelViewSet):
 
 class OrderViewSet(ModelViewSet):
     http_method_names = ['get', 'post', 'patch', 'delete', 'head', 'options']
+    # OrderSerializer nests items -> product, so we load all items with their product in one extra
+    #query instead of one query per order plus one per item
+    queryset = Order.objects.prefetch_related(
+        Prefetch('items', queryset=OrderItem.objects.select_related('product')))
 
     def get_permissions(self):
         if self.request.method in ['PATCH', 'DELETE']:
@@ -120,9 +262,14 @@ class OrderViewSet(ModelViewSet):
     def create(self, request, *args, **kwargs):
         serializer = CreateOrderSerializer(
             data=request.data,
-            context={'user_id': self.request.user.id})
+            context={'request': request, 'tax_region': get_tax_region(request)})
         serializer.is_valid(raise_exception=True)
-        order = serializer.save()
+        try:
+            order = serializer.save()
+        except InsufficientInventory as e:
+            # Not a ValidationError, DRF would turn the quantities and ids into strings
+            return Response({'error': str(e), 'items': e.shortages}, status=status.HTTP_409_CONFLICT)
+        order = self.queryset.get(pk=order.pk)
         serializer = OrderSerializer(order)
         return Response(serializer.data)
 
@@ -137,15 +284,21 @@ class OrderViewSet(ModelViewSet):
         user = self.request.user
 
         if user.is_staff:
-            return Order.objects.all()
+            return self.queryset.all()
 
-        customer_id = Customer.objects.only(
-            'id').get(user_id=user.id)
-        return Order.objects.filter(customer_id=customer_id)
+        return self.queryset.filter(customer_id=get_customer_id(self.request))
 
 
-class ProductImageViewSet(ModelViewSet):
+class ProductImageViewSet(CacheControlMixin, ModelViewSet):
     serializer_class = ProductImageSerializer
+    cache_control = {
+        'list': {'max_age': 300, 's_maxage': 3600, 'stale_while_revalidate': 300},
+        'retrieve': {'max_age': 300, 's_maxage': 3600, 'stale_while_revalidate': 300},
+    }
+
+    # Image changes invalidate their product, so they're purged with it
+    def get_surrogate_keys(self):
+        return [cachecontrol.product_key(int(self.kwargs['product_pk']))]
 
     # In the view set we have access to the URL params. Extracting the product_pk and using a context obj pass it to 
     #the serializer
@@ -155,4 +308,86 @@ class ProductImageViewSet(ModelViewSet):
     # Overwriting the queryset method to only return the images for a particular product
     def get_queryset(self):
         # Getting the Product ID from the URL
-        return ProductImage.objects.filter(product_id=self.kwargs['product_pk'])
\ No newline at end of file
+        return ProductImage.objects.filter(product_id=self.kwargs['product_pk'])
+
+    # Chunked uploads: POST uploads/ with {filename, size}, then PATCH uploads/<id>/ with the raw
+    #bytes and an Upload-Offset header as many times as needed, then POST uploads/<id>/complete/.
+    #GET uploads/<id>/ returns the offset to resume from.
+    def upload_error(self, error: UploadError):
+        return Response({'error': str(error)}, status=error.status)
+
+    def get_upload(self, upload_id):
+        return get_object_or_404(
+            ProductImageUpload, pk=upload_id, product_id=self.kwargs['product_pk'])
+
+    @action(detail=False, methods=['POST'], url_path='uploads')
+    def start_upload(self, request, product_pk):
+        get_object_or_404(Product, pk=product_pk)
+        serializer = ProductImageUploadSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            upload = uploads.start_upload(product_pk, **serializer.validated_data)
+        except UploadError as e:
+            return self.upload_error(e)
+        return Response(ProductImageUploadSerializer(upload).data, status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['GET', 'PATCH'], url_path=r'uploads/(?P<upload_id>[0-9a-f-]+)')
+    def upload_chunk(self, request, product_pk, upload_id):
+        upload = self.get_upload(upload_id)
+        if request.method == 'GET':
+            return Response(ProductImageUploadSerializer(upload).data)
+
+        try:
+            offset = int(request.headers['Upload-Offset'])
+            length = int(request.headers['Content-Length'])
+        except (KeyError, ValueError):
+            return Response(
+                {'error': 'Upload-Offset and Content-Length headers are required.'},
+                status=status.HTTP_400_BAD_REQUEST)
+        try:
+            # Reading the raw body stream, request.data would buffer the whole chunk
+            upload = uploads.append_chunk(upload.id, offset, request.stream, length)
+        except UploadError as e:
+            return self.upload_error(e)
+        return Response(ProductImageUploadSerializer(upload).data)
+
+    @action(detail=False, methods=['POST'], url_path=r'uploads/(?P<upload_id>[0-9a-f-]+)/complete')
+    def complete_upload(self, request, product_pk, upload_id):
+        upload = self.get_upload(upload_id)
+        try:
+            product_image = uploads.complete_upload(upload.id)
+        except UploadError as e:
+            return self.upload_error(e)
+        serializer = ProductImageSerializer(product_image, context={'request': request})
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+class ReportViewSet(GenericViewSet):
+    # Sales reports answered from the daily rollups (see store.reports), e.g.
+    #/store/reports/products/?start=2022-01-01&end=2022-01-31&ordering=-quantity&limit=10
+    permission_classes = [IsAdminUser]
+
+    def get_query(self, request):
+        serializer = ReportQuerySerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        return serializer.validated_data
+
+    @action(detail=False)
+    def products(self, request):
+        return Response(list(reports.sales_by_product(**self.get_query(request))))
+
+    @action(detail=False)
+    def collections(self, request):
+        return Response(list(reports.sales_by_collection(**self.get_query(request))))
+
+    @action(detail=False)
+    def customers(self, request):
+        query = self.get_query(request)
+        # Customers are ranked by number of orders instead of quantity
+        query['ordering'] = query['ordering'].replace('quantity', 'orders_count')
+        return Response(list(reports.sales_by_customer(**query)))
+
+    @action(detail=False)
+    def daily(self, request):
+        query = self.get_query(request)
+        return Response(list(reports.sales_by_day(query['start'], query['end'])))
@@ -13,6 +13,8 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 import os
 from pathlib import Path
 from datetime import timedelta
+from decimal import Decimal
+from celery.schedules import crontab
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -45,7 +47,6 @@ INSTALLED_APPS = [
     'rest_framework',
     'djoser',
     'playground',
-    'debug_toolbar',
     'store',
     'tags',
     'likes',
@@ -53,8 +54,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'store.middleware.RequestMetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
-    'debug_toolbar.middleware.DebugToolbarMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -70,6 +71,27 @@ INTERNAL_IPS = [
     # ...
 ]
 
+# The debug toolbar only runs in development, it slows down every request and doesn't help with
+#the JSON endpoints. store.middleware.RequestMetricsMiddleware is what we use in production.
+if DEBUG:
+    INSTALLED_APPS += ['debug_toolbar']
+    MIDDLEWARE.insert(MIDDLEWARE.index('corsheaders.middleware.CorsMiddleware') + 1,
+                      'debug_toolbar.middleware.DebugToolbarMiddleware')
+
+# Fraction of the requests whose database and render time are measured, all requests get their
+#latency recorded
+STORE_METRICS_SAMPLE_RATE = 0.1
+# Sends the measures of the sampled requests back in a Server-Timing header
+STORE_METRICS_SERVER_TIMING = True
+# Addresses allowed to scrape /metrics, none by default. Don't list 127.0.0.1 when a reverse proxy
+#runs on the same host: every proxied request comes from there, /metrics would be public.
+STORE_METRICS_ALLOWED_IPS = []
+# Required when the app server runs several worker processes: each one writes its metrics there
+#and /metrics adds them up. Empty it when the app server starts, a new worker can get the pid of
+#an old one. None supports a single worker process only.
+STORE_METRICS_DIR = None
+STORE_METRICS_FLUSH_INTERVAL = 1
+
 CORS_ALLOWED_ORIGINS = [
     'http://localhost:8001',
     'http://127.0.0.1:8001',
@@ -152,6 +174,11 @@ STATIC_URL = '/static/'
 MEDIA_URL = '/media/'
 # Telling Django where this media files are stored in the FS
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+# Where chunked image uploads are written until they are completed, must be on the same file system
+#as MEDIA_ROOT so completing an upload is a rename
+STORE_IMAGE_UPLOAD_DIR = os.path.join(MEDIA_ROOT, 'uploads')
+# Uploads not completed within this are deleted with their .part file by the upload reaper
+STORE_IMAGE_UPLOAD_TTL = timedelta(days=1)
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
@@ -161,10 +188,22 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 REST_FRAMEWORK = {
     'COERCE_DECIMAL_TO_STRING': False,
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'store.authentication.CachedJWTAuthentication',
     ),
 }
 
+# JWT requests read the user (id, flags, permissions, customer id) from a per-process LRU, then
+#Redis, instead of MySQL. Saving the user or its customer invalidates it.
+STORE_PRINCIPAL_CACHE_TIMEOUT = 5 * 60
+STORE_PRINCIPAL_LOCAL_TTL = 10
+STORE_PRINCIPAL_LOCAL_SIZE = 10_000
+
+# ModelBackend with the permission sets cached in the same way, versioned by group/permission changes
+AUTHENTICATION_BACKENDS = ['store.backends.CachedModelBackend']
+STORE_PERMISSIONS_CACHE_TIMEOUT = 60 * 60
+STORE_PERMISSIONS_LOCAL_TTL = 10
+STORE_PERMISSIONS_LOCAL_SIZE = 10_000
+
 AUTH_USER_MODEL = 'core.User'
 
 DJOSER = {
@@ -193,4 +232,54 @@ ADMINS = [
     ('Daavo', 'admin@daavo.com')
 ]
 
-CELERY_BROKER_URL = 'redis://localhost:6379/1'
\ No newline at end of file
+CELERY_BROKER_URL = 'redis://localhost:6379/1'
+
+CELERY_BEAT_SCHEDULE = {
+    'reap_abandoned_carts': {
+        'task': 'store.tasks.reap_abandoned_carts',
+        'schedule': crontab(minute=0),
+    },
+    'refresh_sales_rollups': {
+        'task': 'store.tasks.refresh_sales_rollups',
+        'schedule': crontab(minute='*/5'),
+    },
+    'refresh_promotion_prices': {
+        'task': 'store.tasks.refresh_promotion_prices',
+        'schedule': crontab(minute='*/5'),
+    },
+    'reap_image_uploads': {
+        'task': 'store.tasks.reap_image_uploads',
+        'schedule': crontab(minute=30),
+    }
+}
+
+# Carts older than this are deleted by the reaper, in batches of STORE_CART_REAPER_BATCH_SIZE
+STORE_CART_TTL = timedelta(days=30)
+STORE_CART_REAPER_BATCH_SIZE = 1000
+
+# Rows per UPDATE statement of the bulk price/inventory endpoint
+STORE_BULK_UPDATE_BATCH_SIZE = 1000
+
+# Used when the request has no ?tax_region= and when a region has no rate for a collection
+STORE_DEFAULT_TAX_REGION = 'default'
+STORE_DEFAULT_TAX_RATE = Decimal('0.1')
+# How long a process trusts its copy of the tax rate table before checking for changes in Redis
+STORE_TAX_RATES_TTL = 30
+
+# Header the reverse proxy reads the cache tags from (Surrogate-Key for Fastly/Varnish xkey,
+#Cache-Tag for Cloudflare). When STORE_CACHE_PURGE_URL is set, changed products, collections,
+#reviews and tax rates are purged by sending their keys there in that header.
+STORE_SURROGATE_KEY_HEADER = 'Surrogate-Key'
+STORE_CACHE_PURGE_URL = None
+STORE_CACHE_PURGE_METHOD = 'PURGE'
+
+# When True the store.signals events are delivered in-process on commit instead of through Celery
+STORE_EVENTS_EAGER = False
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://localhost:6379/2',
+        'TIMEOUT': 10 * 60,
+    }
+}
\ No newline at end of file
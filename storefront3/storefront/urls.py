@@ -17,7 +17,7 @@ from django.conf import settings
 from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path, include
-import debug_toolbar
+from store.metrics import metrics_view
 
 admin.site.site_header = 'Storefront Admin'
 admin.site.index_title = 'Admin'
@@ -28,9 +28,13 @@ urlpatterns = [
     path('store/', include('store.urls')),
     path('auth/', include('djoser.urls')),
     path('auth/', include('djoser.urls.jwt')),
-    path('__debug__/', include(debug_toolbar.urls)),
+    path('metrics', metrics_view),
 ]
 
+if settings.DEBUG:
+    import debug_toolbar
+    urlpatterns += [path('__debug__/', include(debug_toolbar.urls))]
+
 # Telling Django we want to expose an endpoint that is define in "MEDIA_URL" and any request that go to this endpoint
 #should be routed to the FS in the "MEDIA_ROOT" address. Good strategy for dev
 if settings.DEBUG: